@@ -0,0 +1,3 @@
+"""
+Benchmarks of the bot (run them from the app directory, e.g. `python -m bench.run`)
+"""
@@ -0,0 +1,107 @@
+"""
+A local stand-in of the Telegram Bot API, to be used with `telegram.Bot(token, base_url=...)`
+
+    server = botapi.serve(8081)
+    bot = telegram.Bot(botapi.TOKEN, base_url=server.base_url)
+
+Uploaded photos get a new file_id, photos sent by file_id are not uploaded again.
+Updates added to `server.updates` are served by getUpdates (e.g., to load test instances, see bench.run)
+"""
+
+import json
+import time
+import itertools
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# any token (well formed, as python-telegram-bot validates it)
+TOKEN = '123456:bench'
+
+
+class BotAPIServer(ThreadingHTTPServer):
+    """The stand-in server, with counters of calls and uploaded bytes"""
+
+    daemon_threads = True
+
+
+    def __init__(self, address, latency=0):
+        super().__init__(address, BotAPIHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.uploads = 0
+        self.uploaded = 0
+        self.ids = itertools.count(1)
+        self.updates = list()
+        self.base_url = f'http://{address[0]}:{self.server_address[1]}/bot'
+
+
+    def record(self, method, upload_size=0):
+        """Record a call, return a new id"""
+        with self.lock:
+            self.calls[method] += 1
+            if upload_size:
+                self.uploads += 1
+                self.uploaded += upload_size
+            return next(self.ids)
+
+
+
+class BotAPIHandler(BaseHTTPRequestHandler):
+    """Answer Bot API methods used by the app"""
+
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        multipart = self.headers.get('Content-Type', '').startswith('multipart/form-data')
+        params = {} if multipart or not body else json.loads(body)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        i = self.server.record(method, upload_size=len(body) if multipart else 0)
+
+        if method == 'getMe':
+            result = {'id' : 1, 'is_bot' : True, 'first_name' : 'stand-in', 'username' : 'stand_in_bot'}
+        elif method == 'sendChatAction':
+            result = True
+        elif method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            with self.server.lock:
+                result = [u for u in self.server.updates if u['update_id'] >= offset][:int(params.get('limit', 100))]
+            if not result: # short long polling
+                time.sleep(0.1)
+        else:
+            result = {
+                'message_id' : i,
+                'date' : int(time.time()),
+                'chat' : {'id' : int(params.get('chat_id', 0)), 'type' : 'private'},
+            }
+            if method == 'sendPhoto':
+                file_id = params.get('photo') or f'standin-file-{i}'
+                result['photo'] = [{'file_id' : file_id, 'file_unique_id' : file_id, 'width' : 640, 'height' : 480}]
+
+        payload = json.dumps({'ok' : True, 'result' : result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    # e.g., getMe (the bot username is needed to match commands)
+    do_GET = do_POST
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0, latency=0):
+    """Start the stand-in on `port` (0 for a free one) from a daemon thread"""
+    server = BotAPIServer(('127.0.0.1', port), latency=latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generate synthetic data files (nation, regions and provinces) in the upstream schema
+"""
+
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import datetime
+
+
+REGIONS = [
+    "Abruzzo", "Basilicata", "Calabria", "Campania", "Emilia-Romagna", "Friuli Venezia Giulia", "Lazio",
+    "Liguria", "Lombardia", "Marche", "Molise", "P.A. Bolzano", "P.A. Trento", "Piemonte", "Puglia",
+    "Sardegna", "Sicilia", "Toscana", "Umbria", "Valle d'Aosta", "Veneto",
+]
+
+# upstream file names
+FILES = {
+    'nation' : 'dpc-covid19-ita-andamento-nazionale.json',
+    'regions' : 'dpc-covid19-ita-regioni.json',
+    'provinces' : 'dpc-covid19-ita-province.json',
+}
+
+# cumulative and daily counters of nation and regions
+COUNTERS = [
+    'ricoverati_con_sintomi', 'terapia_intensiva', 'totale_ospedalizzati', 'isolamento_domiciliare',
+    'totale_positivi', 'variazione_totale_positivi', 'nuovi_positivi', 'dimessi_guariti', 'deceduti',
+    'totale_casi', 'tamponi', 'casi_testati',
+]
+
+
+def generate(years=1, provinces=5, seed=0, start=datetime.datetime(2020, 2, 24, 17)):
+    """Return a dict {nation, regions, provinces} of lists of documents covering `years` of history"""
+
+    rnd = random.Random(seed)
+    days = int(365 * years)
+
+    nation, regions, provs = [], [], []
+    state = {r: dict.fromkeys(COUNTERS, 0) for r in REGIONS}
+    prov_totals = {(r, p): 0 for r in REGIONS for p in range(provinces)}
+
+    for t in range(days):
+        date = (start + datetime.timedelta(days=t)).isoformat()
+        total = dict.fromkeys(COUNTERS, 0)
+
+        for c, region in enumerate(REGIONS, start=1):
+            s = state[region]
+            wave = 1 + math.sin(t / 60 + c)
+            new = int(rnd.randint(50, 150) * wave * (1 + c / 10))
+            healed = int(s['totale_positivi'] * 0.05)
+            deaths = int(s['totale_positivi'] * 0.002)
+
+            positives = s['totale_positivi'] + new - healed - deaths
+            s.update({
+                'variazione_totale_positivi' : positives - s['totale_positivi'],
+                'totale_positivi' : positives,
+                'nuovi_positivi' : new,
+                'dimessi_guariti' : s['dimessi_guariti'] + healed,
+                'deceduti' : s['deceduti'] + deaths,
+                'totale_casi' : s['totale_casi'] + new,
+                'tamponi' : s['tamponi'] + new * rnd.randint(8, 20),
+                'casi_testati' : s['casi_testati'] + new * rnd.randint(4, 10),
+                'terapia_intensiva' : positives // 200,
+                'ricoverati_con_sintomi' : positives // 30,
+            })
+            s['totale_ospedalizzati'] = s['terapia_intensiva'] + s['ricoverati_con_sintomi']
+            s['isolamento_domiciliare'] = positives - s['totale_ospedalizzati']
+
+            regions.append(dict({
+                'data' : date, 'stato' : 'ITA', 'codice_regione' : c, 'denominazione_regione' : region,
+                'lat' : 42.0, 'long' : 12.0, 'note' : None,
+            }, **s))
+            for k in COUNTERS:
+                total[k] += s[k]
+
+            # split new cases among provinces, a few of them are still to be assigned
+            shares = [rnd.random() for _ in range(provinces + 1)]
+            for p in range(provinces + 1):
+                cases = int(new * shares[p] / sum(shares))
+                if p == provinces:
+                    name, code, abbr, cumulative = 'In fase di definizione/aggiornamento', 979 + c, '', cases
+                else:
+                    prov_totals[(region, p)] += cases
+                    name, code, abbr, cumulative = f'{region} {p + 1}', c * 10 + p, f'{region[:1]}{p}', prov_totals[(region, p)]
+                provs.append({
+                    'data' : date, 'stato' : 'ITA', 'codice_regione' : c, 'denominazione_regione' : region,
+                    'codice_provincia' : code, 'denominazione_provincia' : name, 'sigla_provincia' : abbr,
+                    'lat' : 42.0, 'long' : 12.0, 'totale_casi' : cumulative, 'note' : None,
+                })
+
+        nation.append(dict({'data' : date, 'stato' : 'ITA', 'note' : None}, **total))
+
+    return {'nation' : nation, 'regions' : regions, 'provinces' : provs}
+
+
+def save(data, path):
+    """Save generated data into `path` using upstream file names"""
+    os.makedirs(path, exist_ok=True)
+    for report, file_name in FILES.items():
+        with open(f'{path}/{file_name}', 'w') as f:
+            json.dump(data[report], f)
+
+
+def main(argv=None):
+    """Generate data files"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', help='output directory')
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--provinces', type=int, default=5, help='provinces per region')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    save(generate(args.years, args.provinces, args.seed), args.path)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
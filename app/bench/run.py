@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run benchmarks against a local mongod and a stubbed Telegram bot
+
+    python -m bench.run --years 2 --mongo mongodb://localhost:27017/
+    python -m bench.run --years 2 --storage memory
+    python -m bench.run --instances 1,2,4 --latency 0.05
+    python -m bench.run --compare bench/results/a.json bench/results/b.json
+
+Results are saved as json in bench/results
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import tempfile
+import argparse
+import datetime
+import resource
+import statistics
+import multiprocessing
+from collections import Counter
+
+from . import generate
+
+
+RESULTS_PATH = os.path.dirname(__file__)+'/results'
+
+# a summary as long as the refresh notification (see Report.refresh)
+BROADCAST_MSG = (
+    "*Aggiornamento dati COVID19 Italia*\n"
+    "*Lun 01 Marzo h.17:00*\n\n"
+    "🇮🇹 *Dati nazionali*:\n"
+    "\nNuovi casi: *13.114*"
+    "\nNuovi casi ogni 100mila abitanti: *22*"
+    "\nNuovi Tamponi: *170.633*, _-20.422_ rispetto a ieri\n"
+    "\n_Dettagli_:\n"
+    "\n`Positivi:   423 mila (  +9.874)`"
+    "\n` Guariti:  2,39 Mln. (  +9.911)`"
+    "\n`Deceduti:  97,7 mila (    +246)`"
+    "\n`_____________________________`"
+    "\n`Tot.Casi:  2,93 Mln. ( +13.114)`"
+    "\n\n_(Tra parentesi le variazioni nelle ultime 24h)_"
+    "\n\n_Digita_ /help _per i dettagli_"
+)
+
+
+def setup_env(mongo, db, storage='mongo'):
+    """Set the environment required by `utils.settings` (before importing it)"""
+    os.environ['MONGO_URI'] = mongo
+    os.environ['MONGO_DB'] = db
+    os.environ['STORAGE'] = storage
+    for report, file_name in generate.FILES.items():
+        os.environ.setdefault(report.upper(), file_name)
+    os.environ.setdefault('CONTEXT', 'Benchmark')
+    os.environ.setdefault('API_KEY', '123456:bench')
+    os.environ.setdefault('DEV', '0')
+    # store monthly buckets too, to compare layouts (see bench_storage)
+    os.environ.setdefault('BUCKETED', '1')
+    # set SLIM_INGEST=1 to compare a slim ingest against the full one (see --compare)
+    os.environ.setdefault('SLIM_INGEST', '0')
+
+
+def timeit(func, repeat):
+    """Return latency stats (in ms) of `repeat` calls of `func`"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'mean' : statistics.mean(samples),
+        'p50' : samples[len(samples) // 2],
+        'p95' : samples[int(len(samples) * 0.95)],
+        'p99' : samples[int(len(samples) * 0.99)],
+        'max' : samples[-1],
+    }
+
+
+def _refresh(mongo, db, data_path, snapshot_path, queue):
+    """Run a refresh (in a child process, to measure its peak RSS)"""
+    setup_env(mongo, db)
+    from utils import settings
+    from utils.report import Report
+    from .stub import StubBot
+
+    settings.DATA_PATH = data_path
+    settings.SNAPSHOT_PATH = snapshot_path
+
+    class BenchReport(Report):
+        """Do not notify anyone"""
+        def notify_users(self, msg, aggregation_detail=False, bot=None, chats=None):
+            return super().notify_users(msg, aggregation_detail, bot=StubBot(), chats=[])
+
+    start = time.perf_counter()
+    BenchReport().refresh()
+    queue.put(time.perf_counter() - start)
+
+
+def bench_refresh(args, data_path, snapshot_path):
+    """Refresh wall time and peak RSS"""
+
+    if args.storage == 'memory':
+        # data live in this process, so refresh here (peak RSS includes the benchmark itself)
+        from utils import settings
+        from utils.report import Report
+
+        settings.DATA_PATH = data_path
+        settings.SNAPSHOT_PATH = snapshot_path
+        R = Report()
+        start = time.perf_counter()
+        R.refresh(notify=False)
+        return {
+            'wall_s' : time.perf_counter() - start,
+            'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_refresh, args=(args.mongo, args.db, data_path, snapshot_path, queue))
+    p.start()
+    wall = queue.get()
+    p.join()
+    return {
+        'wall_s' : wall,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def bench_queries(R, repeat):
+    """Latency of each Report getter"""
+    region, province = 'Lombardia', 'Lombardia 1'
+    queries = {
+        'get_national_total_cases' : lambda: R.get_national_total_cases(15),
+        'get_region_cases' : lambda: R.get_region_cases(region, 15),
+        'get_province_cases' : lambda: R.get_province_cases(province, 15),
+        'get_total_cases(regions)' : lambda: R.get_total_cases(),
+        'get_total_cases(all)' : lambda: R.get_total_cases(region='all', limit=25),
+        'get_total_cases(region)' : lambda: R.get_total_cases(region=region),
+        'get_weekly_cases' : lambda: R.get_weekly_cases(area='Italia 🇮🇹', limit=10),
+        'get_weekly_summary' : lambda: R.get_weekly_summary(),
+        'get_regional_positive_cases' : lambda: R.get_regional_positive_cases(),
+        'get_keyboards' : lambda: R.get_keyboards(),
+    }
+    return {name: timeit(query, repeat) for name, query in queries.items()}
+
+
+def bench_storage(R, repeat, days=15):
+    """
+    Daily documents vs monthly buckets (see utils/buckets.py): collection size, index size
+    and latency of a window read of `days`, per level
+    """
+    from utils import settings, buckets
+
+    def stats(name):
+        s = settings.MONGO_DB.command('collStats', name)
+        return {k: s.get(k, 0) for k in ('count', 'size', 'storageSize', 'totalIndexSize', 'avgObjSize')}
+
+    getters = {
+        'nation' : lambda: R.get_national_total_cases(days),
+        'regions' : lambda: R.get_region_cases('Lombardia', days),
+        'provinces' : lambda: R.get_province_cases('Lombardia 1', days),
+    }
+
+    results = dict()
+    bucketed = settings.BUCKETED
+    for level, getter in getters.items():
+        results[level] = {'daily' : stats(level), 'bucketed' : stats(buckets.collection_name(level))}
+        for layout in ('daily', 'bucketed'):
+            settings.BUCKETED = layout == 'bucketed'
+            results[level][layout]['read'] = timeit(getter, repeat)
+    settings.BUCKETED = bucketed
+    return results
+
+
+def bench_payload(R, repeat):
+    """
+    Decoded bytes (BSON size of returned documents) and latency per request of the getters of daily documents,
+    without and with their projections (see report.FIELDS)
+    """
+    import bson
+    from utils import settings
+
+    region, province = 'Lombardia', 'Lombardia 1'
+    getters = {
+        'get_national_total_cases' : lambda: R.get_national_total_cases(15),
+        'get_region_cases' : lambda: R.get_region_cases(region, 15),
+        'get_province_cases' : lambda: R.get_province_cases(province, 15),
+        'get_regional_positive_cases' : lambda: R.get_regional_positive_cases(),
+    }
+
+    results = dict()
+    bucketed = settings.BUCKETED
+    settings.BUCKETED = False
+    for name, getter in getters.items():
+        results[name] = dict()
+        for projections in (False, True):
+            R.storage.projections = projections
+            stats = timeit(getter, repeat)
+            stats['bytes'] = sum(len(bson.BSON.encode(d)) for d in getter())
+            results[name]['projected' if projections else 'full'] = stats
+    settings.BUCKETED = bucketed
+    return results
+
+
+def bench_charts(R, repeat):
+    """Chart render time and size, per render preset"""
+    from utils import misc, charts as renderer
+
+    data = R.get_national_total_cases(15)
+    weekly = R.get_weekly_cases(area='Italia 🇮🇹', limit=10)
+    charts = {
+        'plotify' : lambda preset: misc.plotify(title='Trend Attualmente Positivi (Italia)', data=data, key='totale_positivi', preset=preset),
+        'plotify_bar' : lambda preset: misc.plotify_bar(title='Trend nuovi casi per settimana (Italia)', data=weekly, preset=preset),
+    }
+
+    results = dict()
+    for name, chart in charts.items():
+        for preset in renderer.RENDER_PRESETS:
+            results[f'{name}/{preset}'] = timeit(lambda: chart(preset), repeat)
+            results[f'{name}/{preset}']['bytes'] = len(chart(preset).getvalue())
+            gc.collect()
+    return results
+
+
+def bench_broadcast(R, chats, latency, botapi=False, merge=True):
+    """
+    Broadcast throughput against the stubbed bot (or the local Bot API stand-in),
+    with the summary as the chart caption (`merge`) or as a separate message
+    """
+    # start without uploaded charts
+    R.storage.drop_file_ids()
+
+    if botapi:
+        import telegram
+        from . import botapi as standin
+        server = standin.serve(latency=latency)
+        bot = telegram.Bot(standin.TOKEN, base_url=server.base_url)
+    else:
+        from .stub import StubBot
+        bot = StubBot(latency=latency)
+
+    start = time.perf_counter()
+    R.notify_users(BROADCAST_MSG, aggregation_detail=True, bot=bot, chats=range(chats), merge=merge)
+    wall = time.perf_counter() - start
+
+    results = {
+        'chats' : chats,
+        'wall_s' : wall,
+        'chats_per_s' : chats / wall,
+        'msg_chars' : len(BROADCAST_MSG),
+    }
+    if botapi:
+        results.update({'api_calls' : sum(server.calls.values()), 'uploads' : server.uploads, 'uploaded_bytes' : server.uploaded})
+        server.shutdown()
+    else:
+        results.update({'api_calls' : len(bot.calls), 'uploaded_bytes' : bot.uploaded})
+    return results
+
+
+def _instance(mongo, db, base_url, ready, stop):
+    """Run a bot instance in multi-instance mode (in a child process) until `stop` is set"""
+    setup_env(mongo, db)
+    os.environ['CLUSTER'] = '1'
+    from telegram.ext import Updater
+    from utils import cluster
+    import bot
+    from . import botapi as standin
+
+    updater = Updater(standin.TOKEN, base_url=base_url, persistence=cluster.MongoPersistence(), use_context=True)
+    bot.setup(updater)
+    instance = cluster.Instance(updater, rebalance_interval=0.5)
+    ready.set()
+    try:
+        instance.run(stop=stop.is_set)
+    finally:
+        updater.stop()
+
+
+def _help_updates(n, chats):
+    """Return `n` /help updates from `chats` chats (in turn, within the rate limit)"""
+    now = int(time.time())
+    return [
+        {
+            'update_id' : i,
+            'message' : {
+                'message_id' : i,
+                'date' : now,
+                'chat' : {'id' : 1 + i % chats, 'type' : 'private'},
+                'from' : {'id' : 1 + i % chats, 'is_bot' : False, 'first_name' : 'bench'},
+                'text' : '/help',
+                'entities' : [{'type' : 'bot_command', 'offset' : 0, 'length' : 5}],
+            },
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+def _balanced(db, instances, partitions):
+    """Return True if each of the `instances` leases its share of the `partitions`"""
+    leases = db['leases'].find({'_id' : {'$regex' : '^partition-'}, 'expires' : {'$gt' : datetime.datetime.utcnow()}})
+    owners = Counter(l['owner'] for l in leases)
+    share = -(-partitions // instances)
+    return len(owners) == instances and sum(owners.values()) == partitions and max(owners.values()) <= share
+
+
+def bench_cluster(args, timeout=600):
+    """
+    Throughput of bot instances in multi-instance mode: each run starts `n` instances,
+    then the Bot API stand-in serves /help updates, polled into the shared queue and
+    processed by all the instances. Bot API round trips (`latency`) dominate, as in production
+    """
+    import pymongo
+    from utils import settings
+    from . import botapi as standin
+
+    db = pymongo.MongoClient(args.mongo)[args.db]
+    ctx = multiprocessing.get_context('spawn')
+    latency = args.latency or 0.05
+
+    results = dict()
+    for n in args.instances:
+        for name in ('updates', 'leases', 'instances', 'chat_data', 'user_data', 'bot_data', 'conversations'):
+            db.drop_collection(name)
+
+        server = standin.serve(latency=latency)
+        ready = [ctx.Event() for _ in range(n)]
+        stop = ctx.Event()
+        processes = [ctx.Process(target=_instance, args=(args.mongo, args.db, server.base_url, e, stop)) for e in ready]
+        for p in processes:
+            p.start()
+        for e in ready:
+            e.wait()
+        while not _balanced(db, n, settings.PARTITIONS):
+            time.sleep(0.1)
+
+        # two updates per chat, to keep conversations in order
+        start = time.perf_counter()
+        with server.lock:
+            server.updates.extend(_help_updates(args.updates, max(args.updates // 2, 1)))
+        while server.calls['sendMessage'] < args.updates:
+            if time.perf_counter() - start > timeout or not all(p.is_alive() for p in processes):
+                raise RuntimeError(f'{n} instances processed {server.calls["sendMessage"]} of {args.updates} updates')
+            time.sleep(0.01)
+        wall = time.perf_counter() - start
+
+        stop.set()
+        for p in processes:
+            p.join()
+        server.shutdown()
+
+        results[str(n)] = {
+            'updates' : args.updates,
+            'wall_s' : wall,
+            'updates_per_s' : args.updates / wall,
+            'api_calls' : sum(server.calls.values()),
+        }
+
+    # throughput per instance, relative to the first run (1.0 is linear scaling)
+    first = args.instances[0]
+    base = results[str(first)]['updates_per_s'] / first
+    for n in args.instances:
+        results[str(n)]['scaling'] = results[str(n)]['updates_per_s'] / n / base
+    return results
+
+
+def bench_alerts(n_rules, repeat, seed=0):
+    """Compile and evaluation time of `n_rules` random alert rules on Italia and the regions"""
+    import random
+    from utils import alerts, settings
+
+    rnd = random.Random(seed)
+    areas = [settings.NATION] + generate.REGIONS
+    weeks = {area: [{'nuovi_positivi' : rnd.randint(0, 50000)} for _ in range(alerts.WEEKS)] for area in areas}
+
+    conditions = list(alerts.CONDITIONS)
+    rules = [{
+        'chat' : i,
+        'area' : rnd.choice(areas),
+        'metric' : rnd.choice(alerts.METRICS),
+        'condition' : rnd.choice(conditions),
+        'threshold' : rnd.randint(0, 50000),
+    } for i in range(n_rules)]
+
+    names, values = alerts.get_values(weeks)
+    compiled = alerts.compile_rules(rules, names)
+
+    return {
+        'rules' : n_rules,
+        'compile' : timeit(lambda: alerts.compile_rules(rules, names), repeat),
+        'evaluate' : timeit(lambda: alerts.evaluate(values, *compiled), repeat),
+        'matches' : int(alerts.evaluate(values, *compiled).sum()),
+    }
+
+
+def inline_fixture(provinces):
+    """
+    Return inline results of synthetic areas (`provinces` per region), the file_ids of half of their charts,
+    and queries (partial names as typed, typos and misses)
+    """
+    from utils.names import NameIndex
+    from utils.inline import InlineResults
+    from utils import settings
+
+    keyboards = {region: [f'{region} {p}' for p in range(provinces)] for region in generate.REGIONS}
+    names = NameIndex(keyboards)
+
+    areas = dict()
+    file_ids = dict()
+    for i, area in enumerate([('nation', settings.NATION)] + names.areas()):
+        areas[area] = (BROADCAST_MSG, 'Dati', f'chart-{i}')
+        if i % 2:
+            file_ids[f'chart-{i}'] = f'file-{i}'
+
+    queries = ['', 'it', 'lom', 'Lombardia', 'Lombrdia', 'ven', 'Emilia Romagna 3', 'valle daosta', 'sicil', 'xyz']
+    return InlineResults(names, areas), file_ids, queries
+
+
+def bench_inline(provinces, repeat):
+    """
+    Inline query answer time (name lookup + results with cached charts), which must stay under 10ms
+    (see test_inline). Half of the areas have a cached chart
+    """
+    results, file_ids, queries = inline_fixture(provinces)
+    queries = iter(queries * repeat)
+
+    stats = timeit(lambda: results.answer(next(queries), file_ids), 10 * repeat)
+    stats['under_10ms'] = stats['p99'] < 10
+    return stats
+
+
+def run(args):
+    """Run all the benchmarks and return results"""
+    setup_env(args.mongo, args.db, args.storage)
+
+    # start from an empty database
+    if args.storage == 'mongo':
+        import pymongo
+        pymongo.MongoClient(args.mongo).drop_database(args.db)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = f'{tmp}/dati-json'
+        generate.save(generate.generate(args.years, args.provinces, args.seed), data_path)
+
+        results = {
+            'timestamp' : datetime.datetime.now().isoformat(),
+            'params' : vars(args),
+            'refresh' : bench_refresh(args, data_path, f'{tmp}/snapshot.bin'),
+        }
+
+        # import after the refresh, so that the client is not shared with the child
+        from utils.report import Report
+        R = Report()
+
+        results['queries'] = bench_queries(R, args.repeat)
+        # MongoDB layouts and projections
+        if args.storage == 'mongo':
+            results['storage'] = bench_storage(R, args.repeat)
+            results['payload'] = bench_payload(R, args.repeat)
+        results['charts'] = bench_charts(R, max(args.repeat // 10, 1))
+        results['alerts'] = bench_alerts(args.rules, max(args.repeat // 10, 1), args.seed)
+        results['inline'] = bench_inline(args.provinces, args.repeat)
+        results['broadcast'] = {
+            'merged' : bench_broadcast(R, args.chats, args.latency, args.botapi, merge=True),
+            'split' : bench_broadcast(R, args.chats, args.latency, args.botapi, merge=False),
+        }
+
+        # multi-instance mode needs MongoDB
+        if args.instances and args.storage == 'mongo':
+            results['cluster'] = bench_cluster(args)
+
+        if args.storage == 'mongo':
+            from utils import settings
+            settings.MONGO_CLIENT.drop_database(args.db)
+
+    return results
+
+
+def flatten(results, prefix=''):
+    """Flatten nested results into {'a.b.c': value}"""
+    flat = dict()
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, f'{prefix}{k}.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[f'{prefix}{k}'] = v
+    return flat
+
+
+def compare(old, new):
+    """Print the ratio new/old of every measure of two result files"""
+    with open(old) as f:
+        a = flatten(json.load(f))
+    with open(new) as f:
+        b = flatten(json.load(f))
+
+    for k in sorted(a.keys() & b.keys()):
+        if k.startswith('params.'):
+            continue
+        ratio = b[k] / a[k] if a[k] else float('nan')
+        print(f'{k:<60} {a[k]:>12.3f} {b[k]:>12.3f} {ratio:>7.2f}x')
+
+
+def main(argv=None):
+    """Run benchmarks or compare results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo', default='mongodb://localhost:27017/')
+    parser.add_argument('--db', default='covid19_bench')
+    parser.add_argument('--storage', default='mongo', choices=['mongo', 'memory'], help='storage backend (memory needs no mongod)')
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--provinces', type=int, default=5, help='provinces per region')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=100, help='repetitions per query')
+    parser.add_argument('--chats', type=int, default=90, help='broadcast recipients')
+    parser.add_argument('--rules', type=int, default=100000, help='alert rules')
+    parser.add_argument('--latency', type=float, default=0, help='simulated Bot API latency (s)')
+    parser.add_argument('--botapi', action='store_true', help='broadcast through a local Bot API stand-in')
+    parser.add_argument('--instances', type=lambda v: [int(n) for n in v.split(',')], help='instance counts to load test in multi-instance mode (e.g., 1,2,4)')
+    parser.add_argument('--updates', type=int, default=400, help='updates per multi-instance load test')
+    parser.add_argument('--output', help='results file (default: bench/results/<timestamp>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run(args)
+
+    output = args.output or f'{RESULTS_PATH}/{datetime.datetime.now():%Y%m%d-%H%M%S}.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+
+    print(json.dumps(results, indent=2, default=str))
+    print(f'Results saved in {output}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+"""
+A stubbed Telegram bot recording calls instead of hitting the Bot API
+"""
+
+import time
+import itertools
+from types import SimpleNamespace
+
+
+class StubBot(object):
+    """Drop-in replacement of `telegram.Bot` for the methods used by the app"""
+
+
+    def __init__(self, latency=0):
+        """`latency` (in seconds) is slept on every call to simulate the network"""
+        self.latency = latency
+        self.calls = list()
+        self.uploaded = 0
+        self._ids = itertools.count(1)
+
+
+    def _call(self, method, **kwargs):
+        """Record a call and return a message-like object"""
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls.append((method, kwargs.get('chat_id')))
+        return SimpleNamespace(message_id=len(self.calls), chat_id=kwargs.get('chat_id'), photo=[])
+
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call('send_message', chat_id=chat_id)
+
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        message = self._call('send_photo', chat_id=chat_id)
+        if hasattr(photo, 'read'):
+            self.uploaded += len(photo.getvalue())
+            photo = f'stub-file-{next(self._ids)}'
+        message.photo = [SimpleNamespace(file_id=photo)]
+        return message
+
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        return self._call('send_chat_action', chat_id=chat_id)
@@ -1,15 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import io
 import logging
 import locale
 import time
+import threading
 from functools import wraps
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, ParseMode, ChatAction
-from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters, PicklePersistence
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, ParseMode, ChatAction, Update
+from telegram.error import BadRequest
+from telegram.ext.dispatcher import run_async
+from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters, PicklePersistence, TypeHandler, DispatcherHandlerStop, InlineQueryHandler
 
 from utils import misc
+from utils import settings
+from utils import instrument
+from utils import population
+from utils import alerts
+from utils import inline
+from utils import export
+from utils import cluster
+from utils.throttle import RateLimiter, Deduplicator
+from utils.singleflight import SingleFlight
+from utils.shedding import LoadShedder
 from utils.report import Report
+from utils.snapshot import Snapshot
+from utils.names import NameIndex, normalize
 
 
 if misc.get_env_variable('CONTEXT') == 'Production':
@@ -34,13 +51,19 @@ SEND_REPLY = 0
 
 # Commands rendering
 COMMANDS = (
-    "/italia - Dati aggregati a livello nazionale\n"
+    "/italia - Dati aggregati a livello nazionale (grafico di lungo periodo con es. /italia 6m)\n"
     "/settimanale - Andamento settimanale dei nuovi casi\n"
     "/semaforo - Variazione settimanale dei nuovi casi sul territorio\n"
-    "/regione - Dati per regione\n"
-    "/provincia - Dati per provincia\n"
-    "/positivi\_regione - Attualmente positivi per ogni regione\n"
-    "/nuovi\_regione - Casi per ogni regione\n"
+    "/regione - Dati per regione (es. /regione Lombardia, /regione Lombardia 1a)\n"
+    "/provincia - Dati per provincia (es. /provincia Milano)\n"
+    "/indicatori - Medie, crescita e positività (Italia)\n"
+    "/iscrivi - Ricevi gli aggiornamenti di regioni o province (es. /iscrivi Lombardia, Milano)\n"
+    "/disiscrivi - Non ricevere più gli aggiornamenti di un'area (es. /disiscrivi Milano)\n"
+    "/allerta - Avvisi sui nuovi casi settimanali (es. /allerta Lombardia sale, /allerta Italia sopra 50000)\n"
+    "/confronta - Confronta più aree (es. /confronta Lombardia, Veneto, Milano 100k)\n"
+    "/esporta - Scarica i dati di un'area in CSV (es. /esporta Lombardia 6m, /esporta province tutto)\n"
+    "/positivi\_regione - Attualmente positivi per ogni regione (anche /positivi\_regione 100k)\n"
+    "/nuovi\_regione - Casi per ogni regione (anche /nuovi\_regione 100k)\n"
     "/nuovi\_provincia - Casi per ogni provincia\n"
     "/feedback - invia un feedback o segnala un problema\n"
     "/help - Istruzioni di utilizzo\n"
@@ -51,6 +74,72 @@ COMMANDS = (
 # the main report object
 R = Report()
 
+# the memory-mapped snapshot of the series
+S = Snapshot()
+
+# keyboards and index of area names as (data version, cache), see get_cache
+CACHE = (None, None)
+
+# inline query results as (data version, results), built aside when data change, see build_inline_results
+INLINE = (None, None)
+
+# per-chat rate limiting and deduplication
+LIMITER = RateLimiter(rate=1/3, burst=5)
+DEDUPLICATOR = Deduplicator(window=30)
+
+# coalesces identical concurrent queries and renders
+FLIGHT = SingleFlight()
+
+# switches charts to ASCII when renders pile up (e.g., at the 18:00 spike)
+SHEDDER = LoadShedder(high_backlog=4, low_backlog=1, high_latency=2, hold=30)
+
+# maximum number of subscriptions and of alert rules per chat
+MAX_SUBSCRIPTIONS = 10
+MAX_ALERTS = 10
+
+# days and maximum number of areas of /confronta charts
+COMPARE_DAYS = 60
+COMPARE_MAX_AREAS = 6
+
+# levels exported as a whole by /esporta
+EXPORT_LEVELS = {'regioni' : 'regions', 'province' : 'provinces'}
+
+# commands whose repetitions (same arguments, same data) are dropped
+EXPENSIVE_COMMANDS = ('/italia', '/indicatori', '/confronta', '/esporta', '/positivi_regione', '/nuovi_regione', '/semaforo', '/regione', '/provincia')
+
+
+def throttle(update, context):
+    """
+    Middleware (handler group -1): stop updates of chats exceeding their rate
+    and repetitions of expensive commands on the same data
+    """
+
+    message = update.effective_message
+    if not message or not message.text:
+        return
+
+    chat = message.chat_id
+    allowed = LIMITER.allow(chat)
+
+    if not allowed:
+        instrument.inc('throttled_requests')
+        if allowed is False: # warn just once
+            message.reply_text('Troppe richieste, riprova tra qualche secondo ⏳', reply_markup=ReplyKeyboardRemove())
+        raise DispatcherHandlerStop
+
+    words = message.text.lower().split()
+    command = words[0].split('@')[0]
+
+    # /regione and /provincia are expensive just with an area as argument
+    expensive = command in EXPENSIVE_COMMANDS and (len(words) > 1 or command not in ('/regione', '/provincia'))
+
+    if expensive:
+        key = (command, ' '.join(words[1:]), data_version())
+        if DEDUPLICATOR.is_duplicate(chat, key):
+            instrument.inc('deduplicated_requests')
+            message.reply_text('Dati già inviati, attendi qualche secondo ⏳', reply_markup=ReplyKeyboardRemove())
+            raise DispatcherHandlerStop
+
 
 def send_typing_action(func):
     """Sends typing action while processing func command."""
@@ -63,28 +152,236 @@ def send_typing_action(func):
     return command_func
 
 
+def layout_keyboard(options, header=None):
+    """Compile a list of options into an (immutable) keyboard markup, two keys per line"""
+
+    keyboard = [header] if header else []
+    options = [o for o in options if o.lower() != 'in fase di definizione/aggiornamento']
+
+    # display two keys per line
+    for i in range(0, len(options), 2):
+        keyboard.append(options[i:i+2])
+
+    return ReplyKeyboardMarkup(tuple(tuple(line) for line in keyboard), one_time_keyboard=True)
+
+
+def data_version():
+    """Return the version of current data (i.e., the md5 of data files)"""
+
+    S.refresh()
+    if S.version:
+        return S.version
+
+    # no snapshot available: the last version completely stored (`md5` is set when a refresh starts)
+    meta = R.get_meta()
+    return meta.get('ready') if meta else None
+
+
+def get_cache():
+    """
+    Return the in-memory cache of the current data version, i.e., a dict with:
+    - keyboards: ready-to-send keyboard markups ('italy', 'weekly' and one per region)
+    - names: the index of area names
+    - file_ids: Telegram file_ids of uploaded charts
+    The cache is (re)built when data change, then inline results are built aside (see build_inline_results)
+    """
+    global CACHE
+
+    version = data_version()
+    if CACHE[0] != version or CACHE[1] is None:
+        options = R.get_keyboards()
+
+        keyboards = {name: layout_keyboard(values) for name, values in options.items()}
+        keyboards['weekly'] = layout_keyboard(options.get('italy', []), header=("Italia 🇮🇹",))
+
+        regions = {r: options.get(r, []) for r in options.get('italy', [])}
+
+        # swap the whole tuple at once
+        CACHE = (version, {'keyboards': keyboards, 'names': NameIndex(regions), 'file_ids': dict()})
+
+        # inline results render every area, so they are built in the background (the previous ones are served meanwhile)
+        threading.Thread(target=build_inline_results, args=(version, CACHE[1]), daemon=True).start()
+
+    return CACHE[1]
+
+
 def get_keyboard(keyboard_name):
-    """get an generate a keyboard using stored data"""
+    """Return a prebuilt keyboard markup by name (None if missing)"""
+    return get_cache()['keyboards'].get(keyboard_name)
 
-    # Build the keyboard dynamically
-    data_kb = R.get_keyboard(keyboard_name)
 
-    if not data_kb:
-        return None
+def get_name_index():
+    """Return the index of area names"""
+    return get_cache()['names']
 
-    keyboard = []
-    i = 0
-    for option in data_kb:
-        if option.lower() == 'in fase di definizione/aggiornamento':
-            continue
-        line, remainder = divmod(i, 2)
-        # display two keys per line
-        if remainder == 0:
-            # create new line
-            keyboard.append([])
-        keyboard[line].append(option)
-        i += 1
-    return keyboard
+
+def get_inline_results():
+    """Return the latest inline query results (of the previous data version while the current ones are built, None before the first build)"""
+    get_cache()
+    return INLINE[1]
+
+
+def build_inline_results(version, cache):
+    """
+    Build the inline results of every area for a data `version` (in the background), and load the file_ids of the charts
+    uploaded so far into the `cache` (answers look charts up there, so charts uploaded later show up as well)
+    """
+    global INLINE
+
+    def build():
+        for key, file_id in R.get_file_ids(version).items():
+            cache['file_ids'].setdefault(key, file_id)
+
+        descriptions = {'nation' : 'Dati nazionali', 'regions' : 'Dati della regione', 'provinces' : 'Dati della provincia'}
+        areas = dict()
+        for level, name in [('nation', 'Italia 🇮🇹')] + cache['names'].areas():
+            update = render_area_update(level, name)
+            if not update:
+                continue
+            msg, title, _, key = update
+            # charts uploaded by notify_subscribers
+            areas[(level, name)] = (msg, descriptions[level], misc.chart_key('plotify', title, key=key, preset=misc.BROADCAST_PRESET))
+
+        return inline.InlineResults(cache['names'], areas)
+
+    try:
+        results = FLIGHT.do('inline', version, build)
+    except Exception as e:
+        print(f'Cannot build inline results: {e}') # Move this print to the logger
+        return
+
+    # unless data changed again meanwhile
+    if CACHE[0] == version or INLINE[1] is None:
+        INLINE = (version, results)
+
+
+def refresh_cache(context):
+    """Rebuild caches as soon as data change (job), not on the first request"""
+    get_cache()
+
+
+def resolve_area(text, level):
+    """Return the canonical name of a region or of a province (`level`) matching `text`"""
+    match = get_name_index().resolve(text, level)
+    return match[1] if match else None
+
+
+def query(method, *args, **kwargs):
+    """Run a Report query (by `method` name), sharing its result with identical concurrent requests"""
+    key = (args, tuple(sorted(kwargs.items())), data_version())
+    return FLIGHT.do(method, key, getattr(R, method), *args, **kwargs)
+
+
+def render(chart, title, data, **kwargs):
+    """
+    Render a chart (by `chart` name, e.g., 'plotify'), sharing it with identical concurrent requests.
+    Return a new buffer for each caller
+    """
+    key = (title, tuple(sorted(kwargs.items())), data_version())
+
+    def draw():
+        # just actual renders count as backlog (not requests waiting for the same chart)
+        with SHEDDER.track():
+            return getattr(misc, chart)(title=title, data=data, **kwargs).getvalue()
+
+    return io.BytesIO(FLIGHT.do(chart, key, draw))
+
+
+def render_ascii(chart, title, data, **kwargs):
+    """Render a chart as text (see misc.chartify), the fallback of `render` under load"""
+
+    if chart == 'plotify':
+        return plot_cases(title, data, kwargs['key'])
+
+    if chart == 'plotify_bar':
+        return misc.chartify(title, [(f"{d['settimana_del']:%d/%m}", int(d['nuovi_positivi'])) for d in reversed(data[:len(data) - 1])])
+
+    # plotify_multi, the last value of each series (with a decimal if small, e.g., per-capita rates)
+    points = [
+        (name[:6], round(values[-1], 1) if abs(values[-1]) < 10 else round(values[-1]))
+        for name, values in data['series'] if values[-1] == values[-1] # NaN check
+    ]
+    if not points:
+        return f'{title}\n\nNessun dato disponibile'
+    return misc.chartify(title, points)
+
+
+def send_chart(message, caption, chart, title, data, **kwargs):
+    """
+    Reply to `message` with a chart. The chart is rendered and uploaded just once per data version,
+    then it is sent by its file_id (cached in memory and in MongoDB).
+    Charts not uploaded yet are sent as text while shedding load
+    """
+
+    version = data_version()
+    key = misc.chart_key(chart, title, **kwargs)
+    file_ids = get_cache()['file_ids']
+
+    file_id = file_ids.get(key) or R.get_file_id(key, version)
+    if file_id:
+        try:
+            message.reply_photo(caption=caption, photo=file_id, reply_markup=ReplyKeyboardRemove())
+            file_ids[key] = file_id
+            instrument.inc('charts_sent', by='file_id')
+            return
+        except BadRequest: # unknown or expired file_id, upload it again
+            file_ids.pop(key, None)
+
+    if SHEDDER.overloaded():
+        text = render_ascii(chart, title, data, **kwargs)
+        message.reply_text(f"*{caption}*\n\n`{text}`", parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        instrument.inc('charts_sent', by='ascii')
+        return
+
+    sent = message.reply_photo(caption=caption, photo=render(chart, title, data, **kwargs), reply_markup=ReplyKeyboardRemove())
+    file_ids[key] = sent.photo[-1].file_id
+    R.set_file_id(key, version, file_ids[key])
+    instrument.inc('charts_sent', by='upload')
+
+
+def get_cases(level, name, days):
+    """Get the last `days` of an area from the snapshot, fall back to MongoDB"""
+
+    S.refresh()
+    data = S.get_documents(level, name, days)
+
+    if data:
+        return data
+
+    if level == 'nation':
+        return R.get_national_total_cases(days)
+    if level == 'regions':
+        return R.get_region_cases(name, days)
+    return R.get_province_cases(name, days)
+
+
+def get_range(level, name, days):
+    """Get the last `days` of an area downsampled for charts (see misc.get_bucket), from the snapshot or MongoDB"""
+
+    bucket = misc.get_bucket(days)
+
+    S.refresh()
+    data = S.get_range(level, name, days, bucket)
+
+    if data:
+        return data
+    return query('get_cases_range', level, name, days, bucket=bucket)
+
+
+def split_range(args):
+    """
+    Split a trailing time range (e.g., /italia 6m) from command `args`.
+    Return (remaining args, days), days is None without a range
+    """
+    days = misc.parse_range(args[-1]) if args else None
+    if not days:
+        return args, None
+    return args[:-1], days
+
+
+def chart_title(title, name, days=None):
+    """Return the title of a chart of an area, with its range (if any)"""
+    return f"{title} ({name}, ultimi {days:n} giorni)" if days else f"{title} ({name})"
 
 
 def plot_cases(title, data, key):
@@ -138,6 +435,9 @@ def render_data_and_chart(data, ascii=False):
 
     # Recap
     msg += f"\nNuovi casi: *{int(today['nuovi_positivi']):n}*"
+    # Per-capita new cases (areas with a known population)
+    if today.get(population.rate_key('nuovi_positivi')) is not None:
+        msg += f"\nNuovi casi ogni 100mila abitanti: *{round(today[population.rate_key('nuovi_positivi')], 1):n}*"
     # Number of tests
     msg += f"\nNuovi Tamponi: *{outline['Tamponi']['today']:n}*, _{outline['Tamponi']['diff']:+n}_ rispetto a ieri\n"
 
@@ -159,19 +459,105 @@ def render_data_and_chart(data, ascii=False):
     return msg
 
 
+def render_indicators(level, name):
+    """Render the last values of derived metrics of an area (None if not available)"""
+
+    snap = S.get()
+    if (level, name) not in snap.areas:
+        return None
+
+    def last(metric):
+        value = snap.get_series(level, name, metric, days=1)[0]
+        return None if value != value else value # NaN check
+
+    average = last('nuovi_casi_media_7gg')
+    ratio = last('rapporto_settimanale')
+    positivity = last('tasso_positivita')
+    doubling = last('tempo_raddoppio')
+
+    msg = f"\nNuovi casi (media 7gg): *{round(average):n}*" if average is not None else "\nNuovi casi (media 7gg): *n.d.*"
+    msg += f"\nVariazione settimanale: *{(ratio - 1) * 100:+.1f}%*" if ratio is not None else "\nVariazione settimanale: *n.d.*"
+    msg += f"\nTasso di positività: *{positivity * 100:.1f}%*" if positivity is not None else "\nTasso di positività: *n.d.*"
+    msg += f"\nTempo di raddoppio: *{doubling:.0f} giorni*" if doubling is not None else "\nTempo di raddoppio: *n.d.* _(casi non in crescita)_"
+
+    return msg
+
+
+def resolve_areas(text):
+    """
+    Resolve a comma-separated list of areas (Italia, regions or provinces).
+    Return the list of (level, name) found and the list of unknown names
+    """
+
+    areas, unknown = list(), list()
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        match = ('nation', 'Italia 🇮🇹') if normalize(part) == 'italia' else get_name_index().resolve(part)
+        if not match:
+            unknown.append(part.strip())
+        elif match not in areas:
+            areas.append(match)
+    return areas, unknown
+
+
+def is_per_capita(args):
+    """Return True if command `args` ask for values per 100k inhabitants"""
+    return bool(args) and args[0].lower() in ('100k', 'procapite')
+
+
+def render_area_update(level, name):
+    """
+    Render the update of an area (Italia, a region or a province), e.g., for subscribers and inline queries.
+    Return (message, chart title, chart data, chart key), None if no data are available
+    """
+
+    days = 15
+    data = get_cases(level, name, days)
+
+    if not data or len(data) < 3:
+        return None
+
+    if level == 'nation':
+        msg = "🇮🇹 *Dati nazionali*\n"
+        msg += f"_{data[-1]['data']:%a %d %B h.%H:%M}_\n"
+        msg += render_data_and_chart(data)
+        key = 'totale_positivi'
+        title = chart_title('Trend Attualmente Positivi', 'Italia')
+    elif level == 'regions':
+        msg = f"*Aggiornamento della regione: {name}*\n"
+        msg += f"_{data[-1]['data']:%a %d %B h.%H:%M}_\n"
+        msg += render_data_and_chart(data)
+        key = 'totale_positivi'
+        title = chart_title('Trend Attualmente Positivi', name)
+    else:
+        msg = f"*Aggiornamento della provincia: {name}*\n"
+        msg += f"_{data[-1]['data']:%a %d %B h.%H:%M}_\n"
+        delta = data[-1]['totale_casi'] - data[-2]['totale_casi']
+        msg += f"\n`{'Tot. Casi':>8}: {misc.human_format(data[-1]['totale_casi']):>9} ({f'{delta:+n}':>7})`"
+        msg += '\n\n_(Tra parentesi i nuovi casi nelle ultime 24h)_'
+        key = 'totale_casi'
+        title = chart_title('Trend Totale Casi', name)
+
+    return msg, title, data, key
+
+
 def render_table(data, label, tot_key, diff_key):
-    """ render a dynamic data table """
+    """ render a dynamic data table (rates, i.e., floats, with one decimal) """
     table = ''
 
     for d in data:
         item = d[label][:7] + (d[label][7:] and '.')
         tot = d[tot_key]
         diff = d[diff_key]
-        table += f"\n`{item:>8}: {misc.human_format(tot):>9} ({f'{diff:+n}':>7})`"
+        tot = f'{round(tot, 1):n}' if isinstance(tot, float) else misc.human_format(tot)
+        diff = f'{round(diff, 1):+n}' if isinstance(diff, float) else f'{diff:+n}'
+        table += f"\n`{item:>8}: {tot:>9} ({diff:>7})`"
 
     return table
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def start(update, context):
     """Getting started with this bot"""
@@ -190,12 +576,19 @@ def start(update, context):
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN,reply_markup=ReplyKeyboardRemove(), disable_web_page_preview=True)
 
 
+@run_async
+@instrument.timed('bot_handler')
 @send_typing_action
 def nation(update, context):
     """Render national data"""
     logger.info(f"User {update.message.from_user} requested national data")
     days = 15
-    data = R.get_national_total_cases(days)
+    data = get_cases('nation', 'Italia 🇮🇹', days)
+
+    # long ranges (e.g., /italia 6m) are charted downsampled
+    _, chart_days = split_range(context.args)
+    chart_data = get_range('nation', 'Italia 🇮🇹', chart_days) if chart_days else data
+    title = chart_title('Trend Attualmente Positivi', 'Italia', chart_days)
 
     msg = (
         f"🇮🇹 *Dati nazionali*\n\n"
@@ -204,53 +597,171 @@ def nation(update, context):
 
     msg += render_data_and_chart(data = data)
 
-    # get plot
-    plot = misc.plotify(title='Trend Attualmente Positivi (Italia)', data = data, key = 'totale_positivi')
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+    send_chart(update.message, caption=title, chart='plotify', title=title, data=chart_data, key='totale_positivi')
+
+
+@run_async
+@instrument.timed('bot_handler')
+@send_typing_action
+def indicators(update, context):
+    """Render national derived metrics"""
+    logger.info(f"User {update.message.from_user} requested national indicators")
+
+    details = render_indicators('nation', 'Italia 🇮🇹')
+
+    if not details:
+        # exit and use ReplyKeyboardRemove() to clear stale keys
+        update.message.reply_text('Nessun dato disponibile', reply_markup=ReplyKeyboardRemove())
+        return
+
+    msg = "🇮🇹 *Indicatori nazionali*\n"
+    msg += details
+    msg += "\n\n_(Variazione della media 7gg rispetto alla settimana precedente, positività sui nuovi tamponi)_"
 
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
-    update.message.reply_photo(caption='Trend Attualmente Positivi (Italia)', photo=plot, reply_markup=ReplyKeyboardRemove())
 
 
+@run_async
+@instrument.timed('bot_handler')
+@send_typing_action
+def compare(update, context):
+    """
+    Compare new cases (7-day average) of several areas in one chart.
+    End the list with `100k` to compare values per 100k inhabitants
+    """
+    logger.info(f"User {update.message.from_user} requested a comparison: {context.args}")
+
+    args = context.args
+    per_capita = is_per_capita(args[-1:])
+    areas, unknown = resolve_areas(' '.join(args[:-1] if per_capita else args))
+
+    if unknown:
+        update.message.reply_text(f"Non ho trovato: {', '.join(unknown)}", reply_markup=ReplyKeyboardRemove())
+    if not areas:
+        update.message.reply_text('Indica le aree da confrontare, separate da virgole (es. /confronta Lombardia, Veneto, Milano 100k)', reply_markup=ReplyKeyboardRemove())
+        return
+
+    areas = areas[:COMPARE_MAX_AREAS]
+
+    snap = S.get()
+    if any(a not in snap.areas for a in areas) or (per_capita and not all(population.get(*a) for a in areas)):
+        update.message.reply_text('Nessun dato disponibile', reply_markup=ReplyKeyboardRemove())
+        return
+
+    def series(level, name):
+        values = snap.get_series(level, name, 'nuovi_casi_media_7gg', days=COMPARE_DAYS)
+        return population.rate(values, population.get(level, name)) if per_capita else values
+
+    # all the series come from the snapshot, the chart is rendered in one pass
+    data = {
+        'dates' : snap.get_dates(COMPARE_DAYS),
+        'series' : [(name.split(' ')[0] if level == 'nation' else name, series(level, name).tolist()) for level, name in areas],
+    }
+
+    names = ', '.join(name for _, name in data['series'])
+    label = 'Nuovi casi ogni 100mila abitanti, media 7gg' if per_capita else 'Nuovi casi, media 7gg'
+    send_chart(update.message, caption=f'Confronto {label[0].lower()}{label[1:]} ({names})', chart='plotify_multi', title=f'{label} ({names})', data=data)
+
+
+@run_async
+@instrument.timed('bot_handler')
+def export_series(update, context):
+    """
+    Send the series of an area (or of all the regions or provinces) as a gzip CSV document, e.g., /esporta Lombardia 6m.
+    Exports are written and uploaded once per data version, then sent by file_id
+    """
+    logger.info(f"User {update.message.from_user} requested an export: {context.args}")
+
+    args, days = split_range(context.args)
+    text = ' '.join(args)
+    if days == misc.RANGE_MAX:
+        days = None # all the history
+
+    if normalize(text) in EXPORT_LEVELS:
+        level, name = EXPORT_LEVELS[normalize(text)], None
+    else:
+        areas, _ = resolve_areas(text)
+        if not areas:
+            update.message.reply_text("Indica un'area (o regioni, province) ed eventualmente un intervallo (es. /esporta Lombardia 6m, /esporta province tutto)", reply_markup=ReplyKeyboardRemove())
+            return
+        level, name = areas[0]
+
+    context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+
+    version = data_version()
+    filename = export.get_filename(level, name, days)
+    caption = f"Dati di {name or 'tutte le ' + normalize(text)} ({f'ultimi {days:n} giorni' if days else 'tutto lo storico'}), CSV compresso con gzip"
+    key = f'export|{filename}'
+    file_ids = get_cache()['file_ids']
+
+    file_id = file_ids.get(key) or R.get_file_id(key, version)
+    if file_id:
+        try:
+            update.message.reply_document(document=file_id, caption=caption, reply_markup=ReplyKeyboardRemove())
+            file_ids[key] = file_id
+            instrument.inc('exports_sent', by='file_id')
+            return
+        except BadRequest: # unknown or expired file_id, upload it again
+            file_ids.pop(key, None)
+
+    # concurrent requests of the same export wait for a single writer
+    path = FLIGHT.do('export', (version, filename), export.export, R, version, level, name, days)
+    with open(path, 'rb') as f:
+        sent = update.message.reply_document(document=f, filename=filename, caption=caption, reply_markup=ReplyKeyboardRemove())
+    file_ids[key] = sent.document.file_id
+    R.set_file_id(key, version, file_ids[key])
+    instrument.inc('exports_sent', by='upload')
+
+
+@run_async
+@instrument.timed('bot_handler')
 @send_typing_action
 def positive_cases_per_region(update, context):
-    """Today's positive cases per region"""
+    """Today's positive cases per region (per 100k inhabitants with the `100k` argument)"""
     logger.info(f"User {update.message.from_user} requested positive cases per region")
-    data = R.get_regional_positive_cases()
+    per_capita = is_per_capita(context.args)
+    data = query('get_regional_positive_cases', per_capita=per_capita)
 
     if not data:
         # exit and use ReplyKeyboardRemove() to clear stale keys
         update.message.reply_text('Nessun dato disponibile', reply_markup=ReplyKeyboardRemove())
 
     msg = (
-        f"*Attualmente positivi per regione*\n\n"
+        f"*Attualmente positivi per regione{' (ogni 100mila abitanti)' if per_capita else ''}*\n\n"
         f"Aggiornamento: *{data[0]['data']:%a %d %B h.%H:%M}*\n" # take the date from the first returned doc
     )
 
     msg += render_table(
         data=data,
         label='denominazione_regione', 
-        tot_key = "totale_positivi",
-        diff_key = "variazione_totale_positivi"
+        tot_key = population.rate_key("totale_positivi") if per_capita else "totale_positivi",
+        diff_key = population.rate_key("variazione_totale_positivi") if per_capita else "variazione_totale_positivi"
         )
 
     msg += "\n\n_(Tra parentesi l'incremento nelle ultime 24h)_"
+    if not per_capita:
+        msg += "\n_Digita_ /positivi\_regione 100k _per i valori ogni 100mila abitanti_"
 
     # use ReplyKeyboardRemove() to clear stale keys
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
 
 
+@run_async
+@instrument.timed('bot_handler')
 @send_typing_action
 def new_cases_per_region(update, context):
-    """Today's new cases per region"""
+    """Today's new cases per region (per 100k inhabitants with the `100k` argument)"""
     logger.info(f"User {update.message.from_user} requested new cases per region")
-    data = R.get_total_cases()
+    per_capita = is_per_capita(context.args)
+    data = query('get_total_cases', per_capita=per_capita)
 
     if not data:
         # exit and use ReplyKeyboardRemove() to clear stale keys
         update.message.reply_text('Nessun dato disponibile', reply_markup=ReplyKeyboardRemove())
 
     msg = (
-        f"*Casi per regione*\n\n"
+        f"*Casi per regione{' (ogni 100mila abitanti)' if per_capita else ''}*\n\n"
         f"Aggiornamento: *{data[0]['data']:%a %d %B h.%H:%M}*\n" # take the date from the first returned doc
     )
 
@@ -262,36 +773,38 @@ def new_cases_per_region(update, context):
         )
 
     msg += '\n\n_(Tra parentesi i nuovi casi nelle ultime 24h)_'
+    if not per_capita:
+        msg += "\n_Digita_ /nuovi\_regione 100k _per i valori ogni 100mila abitanti_"
 
     # use ReplyKeyboardRemove() to clear stale keys
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def weekly_aggregation(update, context):
     """New cases per week"""
     text = update.message.text
     logger.info(f"User {update.message.from_user} requested weekly aggregation for {text}")
-    data = R.get_weekly_cases(area=text, limit=10)
+    data = query('get_weekly_cases', area=text, limit=10)
 
     if not data:
         # exit and use ReplyKeyboardRemove() to clear stale keys
         update.message.reply_text(f'Nessun dato disponibile per {text}', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END 
 
-    # get plot
     area_in_title = text.encode("ascii", "ignore").decode('utf-8').rstrip() # remove non-ascii trailing characters (e.g., Emoji)
-    plot = misc.plotify_bar(title=f'Trend nuovi casi per settimana ({area_in_title})', data = data)
 
-    # use ReplyKeyboardRemove() to clear stale keys
-    update.message.reply_photo(caption=f'Nuovi casi raggruppati per settimana ({area_in_title})', photo=plot, reply_markup=ReplyKeyboardRemove())
+    # send plot (and use ReplyKeyboardRemove() to clear stale keys)
+    send_chart(update.message, caption=f'Nuovi casi raggruppati per settimana ({area_in_title})', chart='plotify_bar', title=f'Trend nuovi casi per settimana ({area_in_title})', data=data)
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def weekly_summary(update, context, current=False):
     """New cases per week, summary"""
     logger.info(f"User {update.message.from_user} requested weekly summary")
-    data = R.get_weekly_summary(current=current)
+    data = query('get_weekly_summary', current=current)
 
     msg = f'*Crescita settimanale dei nuovi casi*\n_dal {data["totale"]["settimana_del"]:%d-%b} al {data["totale"]["settimana_fino_al"]:%d-%b}_\n\n'
     icons = misc.get_icons(data["totale"]["delta"], data["totale"]["delta_delta"])
@@ -311,11 +824,13 @@ def weekly_summary(update, context, current=False):
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
     
     
+@instrument.timed('bot_handler')
 def weekly_summary_partial(update, context):
     """New cases per week, summary with partial data"""
     weekly_summary(update, context, current=True)
     
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def new_cases_per_province(update, context):
     """Today's new cases per province"""
@@ -330,7 +845,7 @@ def new_cases_per_province(update, context):
         logger.info(f"User {update.message.from_user} requested new cases per province")
 
         context.chat_data['offset'] = page_size
-        data = R.get_total_cases(region='all', limit = page_size)
+        data = query('get_total_cases', region='all', limit=page_size)
         if not data:
             # exit and use ReplyKeyboardRemove() to clear stale keys
             update.message.reply_text('Nessun altro dato disponibile', reply_markup=ReplyKeyboardRemove())
@@ -343,7 +858,7 @@ def new_cases_per_province(update, context):
     else:
         logger.info(f"User {update.message.from_user} requested /next {context.chat_data['offset']}")
 
-        data = R.get_total_cases(region='all', limit = page_size, offset=context.chat_data['offset'] )
+        data = query('get_total_cases', region='all', limit=page_size, offset=context.chat_data['offset'])
 
         if not data:
             # exit and use ReplyKeyboardRemove() to clear stale keys
@@ -373,20 +888,30 @@ def new_cases_per_province(update, context):
     return IT
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def choose_region(update, context):
     """A function for managing the first step of a conversation for regions and provinces data"""
 
-    # Build the keyboard dynamically
-    keyboard = get_keyboard('italy')
-
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-
     # save the user choice for the conversation
     text = update.message.text
-    context.chat_data['choice'] = text
+    choice = text.split()[0]
+    context.chat_data['choice'] = choice
+
+    # a time range for the chart (e.g., /regione Lombardia 6m) holds for the whole conversation
+    args, days = split_range(context.args)
+    context.chat_data['days'] = days
+
+    # the area has been passed as argument (e.g., /provincia Milano)
+    if args:
+        name = ' '.join(args)
+        if choice == '/regione':
+            return send_region(update, name, days)
+        return send_province(update, name, days)
 
-    if text == '/regione':
+    reply_markup = get_keyboard('italy')
+
+    if choice == '/regione':
         msg = 'Selezionare una regione'
     else: # = '/provincia
         msg = 'Selezionare la regione della provincia desiderata'
@@ -395,15 +920,12 @@ def choose_region(update, context):
     return REGION
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def choose_area(update, context):
     """A function for managing the first step of a conversation for weekly data"""
 
-    # Build the keyboard dynamically
-    keyboard = get_keyboard('italy')
-    keyboard.insert(0, ["Italia 🇮🇹"])
-
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+    reply_markup = get_keyboard('weekly')
 
     # save the user choice for the conversation
     text = update.message.text
@@ -413,97 +935,88 @@ def choose_area(update, context):
     return AREA
 
 
-@send_typing_action  
-def region(update, context):
-    """Function for handling data of a region"""
-    choice = context.chat_data['choice']
-    text = update.message.text
+def send_region(update, text, chart_days=None):
+    """Send data of the region matching `text`, chart the last `chart_days` (downsampled) if set"""
 
-    if choice == '/regione':
-        # return regional data
-        logger.info(f"User {update.message.from_user} requested data of {text}")
-
-        days = 15
-        data = R.get_region_cases(text, days)
-        details = R.get_total_cases(region=text)
+    name = resolve_area(text, 'regions')
 
-        if not data:
-            # exit and use ReplyKeyboardRemove() to clear stale keys
-            update.message.reply_text(f'Nessun dato disponibile per {text}', reply_markup=ReplyKeyboardRemove())
-            return ConversationHandler.END 
+    if not name:
+        # exit and use ReplyKeyboardRemove() to clear stale keys
+        update.message.reply_text(f"Nessuna corrispondenza per {text}", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
 
-        msg = (
-            f"Dati della regione: *{text}*\n\n"
-            f"Aggiornamento: *{data[-1]['data']:%a %d %B h.%H:%M}*\n"
-        )
+    # return regional data
+    logger.info(f"User {update.message.from_user} requested data of {name}")
 
-        msg += render_data_and_chart(data)
+    days = 15
+    data = get_cases('regions', name, days)
+    details = query('get_total_cases', region=name)
 
-        msg += '\n\n\n\n*Totale Casi per provincia*\*\n'
+    if not data:
+        # exit and use ReplyKeyboardRemove() to clear stale keys
+        update.message.reply_text(f'Nessun dato disponibile per {name}', reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END 
 
-        remainder = None # 'in fase di definizione/aggiornamento'
-        for d in details:
-            if d['_id'].lower() == 'in fase di definizione/aggiornamento':
-                remainder = d['totale_casi']
-                continue
-            elif len(d['_id']) > 8:
-                prov = d['_id'][:7] + '.'
-            else:
-                prov = d['_id']
-        
-            cases = d['totale_casi']
-            diff = d['diff']
+    msg = (
+        f"Dati della regione: *{name}*\n\n"
+        f"Aggiornamento: *{data[-1]['data']:%a %d %B h.%H:%M}*\n"
+    )
 
-            msg += f"\n`{prov:>8}: {misc.human_format(cases):>9} ({f'{diff:+n}':>7})`"
+    msg += render_data_and_chart(data)
 
-        msg += '\n\n_(Tra parentesi i nuovi casi nelle ultime 24h)_'
+    msg += '\n\n\n\n*Totale Casi per provincia*\*\n'
 
-        msg +=f'\n\n_*{remainder:n} casi in fase di aggiornamento_'
+    remainder = None # 'in fase di definizione/aggiornamento'
+    for d in details:
+        if d['_id'].lower() == 'in fase di definizione/aggiornamento':
+            remainder = d['totale_casi']
+            continue
+        elif len(d['_id']) > 8:
+            prov = d['_id'][:7] + '.'
+        else:
+            prov = d['_id']
+    
+        cases = d['totale_casi']
+        diff = d['diff']
 
+        msg += f"\n`{prov:>8}: {misc.human_format(cases):>9} ({f'{diff:+n}':>7})`"
 
-        # get plot
-        plot = misc.plotify(title=f'Trend Attualmente Positivi ({text})', data = data, key = 'totale_positivi')
+    msg += '\n\n_(Tra parentesi i nuovi casi nelle ultime 24h)_'
 
-        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
-        update.message.reply_photo(caption=f'Trend Attualmente Positivi ({text})', photo=plot, reply_markup=ReplyKeyboardRemove())
+    msg +=f'\n\n_*{remainder:n} casi in fase di aggiornamento_'
 
-        return ConversationHandler.END
 
-    # if we get here, then user is interested in data of a province
-    keyboard = get_keyboard(text)
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+    chart_data = get_range('regions', name, chart_days) if chart_days else data
+    title = chart_title('Trend Attualmente Positivi', name, chart_days)
+    send_chart(update.message, caption=title, chart='plotify', title=title, data=chart_data, key='totale_positivi')
 
-    if not keyboard:
-        # user entered wrong text
-        update.message.reply_text(f"Nessuna corrispondenza per {text}", reply_markup=ReplyKeyboardRemove())
-        return ConversationHandler.END
+    return ConversationHandler.END
 
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
 
-    update.message.reply_text(
-        'Selezionare una provincia',
-        reply_markup=reply_markup
-        )
+def send_province(update, text, chart_days=None):
+    """Send data of the province matching `text`, chart the last `chart_days` (downsampled) if set"""
 
-    return PROVINCE
+    name = resolve_area(text, 'provinces')
 
+    if not name:
+        # exit and use ReplyKeyboardRemove() to clear stale keys
+        update.message.reply_text(f"Nessuna corrispondenza per {text}", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
 
-@send_typing_action
-def province(update, context):
-    """A function for getting data of a province"""
-    text = update.message.text
-    logger.info(f"User {update.message.from_user} requested data of {text}")
+    logger.info(f"User {update.message.from_user} requested data of {name}")
     
     days = 15
-    data = R.get_province_cases(text, days)
+    data = get_cases('provinces', name, days)
     
 
     if not data:
         # exit and use ReplyKeyboardRemove() to clear stale keys
-        update.message.reply_text(f'Nessun dato disponibile per {text}', reply_markup=ReplyKeyboardRemove())
+        update.message.reply_text(f'Nessun dato disponibile per {name}', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
     msg = (
-        f"Dati della provincia: *{text}*\n\n"
+        f"Dati della provincia: *{name}*\n\n"
         f"Aggiornamento: *{data[-1]['data']:%a %d %B h.%H:%M}*\n"
     )
 
@@ -515,16 +1028,48 @@ def province(update, context):
     msg += '\n\n_(Tra parentesi i nuovi casi nelle ultime 24h)_'
     
 
-    # get plot
-    plot = misc.plotify(title=f'Trend Totale Casi ({text})', data = data, key = 'totale_casi')
-
-
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
-    update.message.reply_photo(caption=f'Trend Totale Casi ({text})', photo=plot, reply_markup=ReplyKeyboardRemove())
+    chart_data = get_range('provinces', name, chart_days) if chart_days else data
+    title = chart_title('Trend Totale Casi', name, chart_days)
+    send_chart(update.message, caption=title, chart='plotify', title=title, data=chart_data, key='totale_casi')
 
     return ConversationHandler.END
 
 
+@instrument.timed('bot_handler')
+@send_typing_action  
+def region(update, context):
+    """Function for handling data of a region"""
+    choice = context.chat_data['choice']
+    text = update.message.text
+
+    if choice == '/regione':
+        return send_region(update, text, context.chat_data.get('days'))
+
+    # if we get here, then user is interested in data of a province
+    name = resolve_area(text, 'regions')
+    reply_markup = get_keyboard(name) if name else None
+
+    if not reply_markup:
+        # user entered wrong text
+        update.message.reply_text(f"Nessuna corrispondenza per {text}", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    update.message.reply_text(
+        'Selezionare una provincia',
+        reply_markup=reply_markup
+        )
+
+    return PROVINCE
+
+
+@instrument.timed('bot_handler')
+@send_typing_action
+def province(update, context):
+    """A function for getting data of a province"""
+    return send_province(update, update.message.text, context.chat_data.get('days'))
+
+@instrument.timed('bot_handler')
 @send_typing_action
 def key(update, context):
     """Return the data key"""
@@ -543,6 +1088,7 @@ def key(update, context):
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove(), disable_web_page_preview=True)
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def help(update, context):
     """Help function"""
@@ -555,6 +1101,7 @@ def help(update, context):
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove(), disable_web_page_preview=True)
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def credits(update, context):
     """Return credits"""
@@ -570,12 +1117,14 @@ def credits(update, context):
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove(), disable_web_page_preview=True)
 
 
+@instrument.timed('bot_handler')
 def cancel(update, context):
     """Stop a conversation (generic fallback)"""
     logger.info(f"User {update.message.from_user} cancelled the conversation.")
     return ConversationHandler.END
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def error(update, context):
     """Log Errors caused by Updates."""
@@ -589,6 +1138,7 @@ def error(update, context):
 
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def msg(update, context):
     """Broadcast handler"""
@@ -596,6 +1146,7 @@ def msg(update, context):
     return CHECK
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def check(update, context):
     """ Check the secret """
@@ -607,12 +1158,16 @@ def check(update, context):
         return ConversationHandler.END
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def broadcast(update, context):
     """Actual sending function (broadcast)"""
 
+    # in multi-instance mode, chats are known by MongoDB (this instance just knows the chats it served)
+    chats = context.dispatcher.persistence.get_chat_ids() if settings.CLUSTER else context.dispatcher.chat_data.keys()
+
     i = 0
-    for i,chat in enumerate(context.dispatcher.chat_data.keys(), start=1):
+    for i,chat in enumerate(chats, start=1):
         if i != 0 and i % 30 == 0:
             time.sleep(1) # avoids the bot ban :)
         logger.info(f"Sending data to {chat}...")
@@ -627,6 +1182,157 @@ def broadcast(update, context):
     
 
 
+@instrument.timed('bot_handler')
+@send_typing_action
+def subscribe(update, context):
+    """Subscribe the chat to the updates of regions and provinces"""
+    logger.info(f"User {update.message.from_user} requested a subscription: {context.args}")
+
+    chat = update.message.chat_id
+    areas, unknown = resolve_areas(' '.join(context.args))
+    areas = [a for a in areas if a[0] != 'nation'] # every chat gets national updates
+
+    msg = ''
+    if unknown:
+        msg += f"Non ho trovato: {', '.join(unknown)}\n\n"
+
+    if not areas:
+        msg += 'Indica le regioni o le province di cui vuoi ricevere gli aggiornamenti, separate da virgole (es. /iscrivi Lombardia, Milano)'
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+        return
+
+    subscriptions = R.get_subscriptions(chat)
+    for level, name in areas:
+        if (level, name) in subscriptions:
+            continue
+        if len(subscriptions) >= MAX_SUBSCRIPTIONS:
+            msg += f"Puoi seguire al massimo {MAX_SUBSCRIPTIONS} aree\n"
+            break
+        R.subscribe(chat, level, name)
+        subscriptions.append((level, name))
+
+    msg += render_subscriptions(subscriptions)
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+
+
+@instrument.timed('bot_handler')
+@send_typing_action
+def unsubscribe(update, context):
+    """Unsubscribe the chat from the updates of regions and provinces (or list its subscriptions)"""
+    logger.info(f"User {update.message.from_user} requested an unsubscription: {context.args}")
+
+    chat = update.message.chat_id
+    subscriptions = R.get_subscriptions(chat)
+    areas, unknown = resolve_areas(' '.join(context.args))
+
+    msg = ''
+    if unknown:
+        msg += f"Non ho trovato: {', '.join(unknown)}\n\n"
+
+    for area in areas:
+        if area in subscriptions:
+            R.unsubscribe(chat, *area)
+            subscriptions.remove(area)
+
+    msg += render_subscriptions(subscriptions)
+    if subscriptions:
+        msg += "\n\n_Digita_ /disiscrivi _seguito dal nome di un'area per non ricevere più i suoi aggiornamenti_"
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+
+
+@instrument.timed('bot_handler')
+@send_typing_action
+def alert(update, context):
+    """
+    Add an alert rule: /allerta <area> sale|scende|sopra N|sotto N [100k].
+    List the rules without arguments, remove them with /allerta off
+    """
+    logger.info(f"User {update.message.from_user} requested an alert: {context.args}")
+
+    chat = update.message.chat_id
+    args = [a.lower() for a in context.args]
+
+    if args == ['off']:
+        R.remove_alerts(chat)
+        update.message.reply_text('Allerte rimosse', reply_markup=ReplyKeyboardRemove())
+        return
+
+    rules = R.get_alerts(chat)
+
+    if not args:
+        msg = render_alerts(rules)
+        update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        return
+
+    rule = parse_alert(args)
+
+    if not rule:
+        msg = (
+            "Non ho capito l'allerta, alcuni esempi:\n\n"
+            "/allerta Lombardia sale\n"
+            "/allerta Veneto scende\n"
+            "/allerta Italia sopra 50000\n"
+            "/allerta Lazio sotto 100 100k"
+        )
+        update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
+        return
+
+    if len(rules) >= MAX_ALERTS:
+        update.message.reply_text(f"Puoi impostare al massimo {MAX_ALERTS} allerte (/allerta off per rimuoverle)", reply_markup=ReplyKeyboardRemove())
+        return
+
+    R.add_alert(chat, **rule)
+    msg = f"Allerta impostata: {alerts.describe(rule)}\n\n"
+    msg += render_alerts(R.get_alerts(chat))
+    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+
+
+def parse_alert(args):
+    """Parse the (lowercase) `args` of /allerta into a rule, return None if they are not valid"""
+
+    # the area is the text before the condition
+    position = next((i for i, a in enumerate(args) if a in alerts.CONDITIONS), None)
+    if not position:
+        return None
+
+    text = ' '.join(args[:position])
+    area = 'Italia 🇮🇹' if normalize(text) == 'italia' else resolve_area(text, 'regions')
+    if not area:
+        return None
+
+    condition = args[position]
+    rest = args[position + 1:]
+    threshold = None
+
+    if condition in alerts.THRESHOLD_CONDITIONS:
+        try:
+            threshold = float(rest[0].replace('.', '').replace(',', '.'))
+        except (IndexError, ValueError):
+            return None
+        rest = rest[1:]
+
+    metric = alerts.METRICS[1] if is_per_capita(rest) else alerts.METRICS[0]
+
+    return {'area' : area, 'metric' : metric, 'condition' : condition, 'threshold' : threshold}
+
+
+def render_alerts(rules):
+    """Render the list of alert rules"""
+    if not rules:
+        return "Nessuna allerta impostata (es. /allerta Lombardia sale)"
+    msg = '*Allerte*:\n' + '\n'.join(f"- {alerts.describe(r)}" for r in rules)
+    msg += '\n\n_Le allerte vengono valutate a ogni settimana completa. Digita_ /allerta off _per rimuoverle_'
+    return msg
+
+
+def render_subscriptions(subscriptions):
+    """Render the list of subscribed areas"""
+    if not subscriptions:
+        return 'Non segui nessuna regione o provincia'
+    return '*Aree seguite*:\n' + '\n'.join(f"- {name}" for _, name in subscriptions)
+
+
+@instrument.timed('bot_handler')
 @send_typing_action
 def feedback(update, context):
     """Feedback handler"""
@@ -635,6 +1341,7 @@ def feedback(update, context):
     return FEEDBACK
     
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def send_feedback(update, context):
     """Send a feedback"""
@@ -646,6 +1353,7 @@ def send_feedback(update, context):
     return ConversationHandler.END
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def reply(update, context):
     """Reply handler"""
@@ -663,6 +1371,7 @@ def reply(update, context):
     return SEND_REPLY
 
 
+@instrument.timed('bot_handler')
 @send_typing_action
 def send_reply(update, context):
     """Send a reply"""
@@ -675,6 +1384,7 @@ def send_reply(update, context):
 
 
 # This handler must be added last. 
+@instrument.timed('bot_handler')
 @send_typing_action
 def unknown(update, context):
     """Unknown handler"""
@@ -688,21 +1398,51 @@ def unknown(update, context):
     update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove(), disable_web_page_preview=True)
 
 
-def main():
+@instrument.timed('bot_handler')
+def inline_query(update, context):
+    """Answer inline queries (e.g., @bot Lombardia) with prebuilt results and the charts uploaded so far"""
+    query = update.inline_query
+    results = get_inline_results()
+    if results is None: # first build in progress
+        query.answer([], cache_time=0)
+        return
+    query.answer(results.answer(query.query, get_cache()['file_ids']), cache_time=inline.CACHE_TIME)
 
-    # Create the Updater and pass it your bot's token.
-    pp = PicklePersistence(filename='_data/conversationbot')
 
-    # Create the Updater and pass it your bot's token.
-    # Make sure to set use_context=True to use the new context based callbacks
-    # Post version 12 this will no longer be necessary
-    updater = Updater(misc.get_env_variable('API_KEY'), persistence=pp, use_context=True)
+def send_metrics_summary(context):
+    """Send a summary of metrics to the DEV chat (job)"""
+    summary = instrument.REGISTRY.summary() or 'No metrics yet'
+    context.bot.send_message(chat_id=misc.get_env_variable('DEV'), text=summary)
+
+
+def refresh_storage(context):
+    """Refresh the in-memory storage from data files (job), notifying users as the downloader would do"""
+    # notify through this bot and its chats (a second Updater would load the persistence file again)
+    R.refresh(bot=context.bot, chats=list(context.dispatcher.chat_data.keys()))
+
+
+def setup(updater):
+    """Add the handlers to the dispatcher of an `updater`"""
 
     dp = updater.dispatcher
 
+    # Rate limiting and deduplication run before any other handler
+    dp.add_handler(TypeHandler(Update, throttle), -1)
+
     # Basic command handlers
     dp.add_handler(CommandHandler('start', start))
     dp.add_handler(CommandHandler('italia', nation))
+    dp.add_handler(CommandHandler('indicatori', indicators))
+    dp.add_handler(CommandHandler('confronta', compare))
+    dp.add_handler(CommandHandler('esporta', export_series))
+
+    # subscriptions and alerts
+    dp.add_handler(CommandHandler('iscrivi', subscribe))
+    dp.add_handler(CommandHandler('disiscrivi', unsubscribe))
+    dp.add_handler(CommandHandler('allerta', alert))
+
+    # Inline queries (inline mode must be enabled through @BotFather)
+    dp.add_handler(InlineQueryHandler(inline_query))
     dp.add_handler(CommandHandler('semaforo', weekly_summary))
     dp.add_handler(CommandHandler('test', weekly_summary_partial)) # not listed
     dp.add_handler(CommandHandler('positivi_regione', positive_cases_per_region))
@@ -721,7 +1461,10 @@ def main():
             IT: [CommandHandler('next', new_cases_per_province)],
         },
         fallbacks=[MessageHandler(Filters.command, cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='new_cases',
+        # conversations go on across instances
+        persistent=settings.CLUSTER
     )
 
     # Command handlers GROUP 1
@@ -740,7 +1483,9 @@ def main():
             AREA : [MessageHandler(Filters.text & (~ Filters.command), weekly_aggregation)],
         },
         fallbacks=[MessageHandler(Filters.command, cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='areas',
+        persistent=settings.CLUSTER
     )
 
     # Command handlers GROUP 2
@@ -756,7 +1501,9 @@ def main():
             BROADCAST: [MessageHandler(Filters.text & (~ Filters.command), broadcast)],
         },
         fallbacks=[MessageHandler(Filters.command, cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='broadcast',
+        persistent=settings.CLUSTER
     )
 
     # Command handlers GROUP 3
@@ -772,7 +1519,9 @@ def main():
             FEEDBACK: [MessageHandler(Filters.text & (~ Filters.command), send_feedback)],
         },
         fallbacks=[MessageHandler(Filters.command, cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='feedback',
+        persistent=settings.CLUSTER
     )
 
     # Command handlers GROUP 4
@@ -788,7 +1537,9 @@ def main():
             SEND_REPLY: [MessageHandler(Filters.text & (~ Filters.command), send_reply)],
         },
         fallbacks=[MessageHandler(Filters.command, cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='reply',
+        persistent=settings.CLUSTER
     )
 
     # Command handlers GROUP 5
@@ -797,7 +1548,52 @@ def main():
     if misc.get_env_variable('CONTEXT') == 'Production':
         dp.add_error_handler(error)
 
-    dp.add_handler(MessageHandler(Filters.command & (~ Filters.regex('^(\/regione|\/provincia|\/nuovi_provincia|\/settimanale|\/next|\/msg|\/feedback|\/reply|\/test)$')), unknown))
+    dp.add_handler(MessageHandler(Filters.command & (~ Filters.regex('^(\/regione|\/provincia|\/nuovi_provincia|\/settimanale|\/next|\/msg|\/feedback|\/reply|\/test|\/confronta|\/esporta)( .*)?$')), unknown))
+
+
+def main():
+
+    # several instances share updates, conversations and caches through MongoDB (see utils/cluster.py)
+    if settings.CLUSTER and settings.STORAGE != 'mongo':
+        raise SystemExit('CLUSTER=1 requires STORAGE=mongo')
+
+    # Chat data, user data and conversations are persisted (in MongoDB to be shared by instances)
+    if settings.CLUSTER:
+        pp = cluster.MongoPersistence()
+    else:
+        pp = PicklePersistence(filename='_data/conversationbot')
+
+    # Create the Updater and pass it your bot's token.
+    # Make sure to set use_context=True to use the new context based callbacks
+    # Post version 12 this will no longer be necessary
+    updater = Updater(misc.get_env_variable('API_KEY'), persistence=pp, use_context=True)
+
+    setup(updater)
+
+    # expose metrics on http://0.0.0.0:METRICS_PORT/metrics (optional)
+    if os.environ.get('METRICS_PORT'):
+        instrument.serve(int(os.environ['METRICS_PORT']))
+
+    # rebuild caches (and inline results) when data change
+    updater.job_queue.run_repeating(refresh_cache, interval=60, first=0)
+
+    # send a summary of metrics to the DEV chat every METRICS_SUMMARY minutes (optional)
+    if os.environ.get('METRICS_SUMMARY'):
+        updater.job_queue.run_repeating(send_metrics_summary, interval=int(os.environ['METRICS_SUMMARY']) * 60)
+
+    # with the in-memory storage the bot loads data by itself (the downloader just pulls them)
+    if settings.STORAGE == 'memory':
+        try:
+            R.refresh(notify=False)
+        except Exception as e:
+            print(f'Cannot load data: {e}') # Move this print to the logger
+        updater.job_queue.run_repeating(refresh_storage, interval=int(os.environ.get('REFRESH_INTERVAL', 10)) * 60)
+
+    # in multi-instance mode updates are consumed from the shared queue
+    if settings.CLUSTER:
+        updater.job_queue.start()
+        cluster.Instance(updater).run()
+        return
 
     # Start the Bot
     updater.start_polling()
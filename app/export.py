@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Export the series of an area (or of all the regions or provinces) as a gzip CSV
+
+    python export.py Lombardia --days 180 -o lombardia.csv.gz
+    python export.py province > province.csv.gz
+"""
+
+import sys
+import shutil
+import argparse
+
+from utils import settings
+from utils import export
+from utils.report import Report
+from utils.names import NameIndex, normalize
+
+
+LEVELS = {'italia' : 'nation', 'regioni' : 'regions', 'province' : 'provinces'}
+
+
+def main(argv=None):
+    """Export data"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('area', help='a region, a province, italia, regioni or province')
+    parser.add_argument('--days', type=int, help='last days (default: all the history)')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    r = Report()
+
+    # the in-memory storage of this process starts empty
+    if settings.STORAGE == 'memory':
+        r.refresh(notify=False)
+
+    # the last version completely stored (see Report.refresh)
+    meta = r.get_meta()
+    version = meta.get('ready') if meta else None
+    if not version:
+        sys.exit('No data available yet: run refresh.py first')
+
+    key = normalize(args.area)
+    if key == 'italia':
+        level, name = 'nation', settings.NATION
+    elif key in LEVELS:
+        level, name = LEVELS[key], None
+    else:
+        match = NameIndex(r.get_keyboards()).resolve(args.area)
+        if not match:
+            sys.exit(f'Unknown area: {args.area}')
+        level, name = match
+
+    # exports are cached per data version, copy them in chunks
+    path = export.export(r, version, level, name, args.days)
+    with open(path, 'rb') as src:
+        if args.output:
+            with open(args.output, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            shutil.copyfileobj(src, sys.stdout.buffer)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 
 
+from utils import settings
 from utils.report import Report
 
 def main():
     """Refresh data"""
+    if settings.STORAGE == 'memory':
+        print('In-memory storage: the bot refreshes data by itself') # Move this print to the logger
+        return
     r = Report()
     r.refresh()
 
@@ -0,0 +1,12 @@
+"""
+Unit tests, run them from the `app` directory:
+
+    python -m unittest
+
+Tests of the MongoDB storage run on mongomock (skipped if it is not installed)
+"""
+
+from bench.run import setup_env
+
+# the environment required by `utils.settings`, before any test imports it
+setup_env('mongodb://localhost:27017/', 'covid19_test', 'memory')
@@ -0,0 +1,67 @@
+"""
+Alerts: rules fire only when their condition starts to hold, in bulk, and never on unknown areas or missing weeks
+"""
+
+import unittest
+import numpy as np
+from utils import alerts
+from utils import population
+from utils import settings
+
+
+def make_weeks(**cases):
+    """Return {area: weekly documents, oldest first} from the weekly new cases of each area"""
+    return {area : [{'nuovi_positivi' : c} for c in values] for area, values in cases.items()}
+
+
+def rule(area, condition, threshold=None, metric=alerts.METRICS[0]):
+    return {'chat' : 1, 'area' : area, 'metric' : metric, 'condition' : condition, 'threshold' : threshold}
+
+
+class TestAlerts(unittest.TestCase):
+
+
+    def evaluate(self, weeks, rules):
+        areas, values = alerts.get_values(weeks)
+        return list(alerts.evaluate(values, *alerts.compile_rules(rules, areas)))
+
+
+    def test_trend(self):
+        weeks = make_weeks(Lazio=[10, 5, 8], Molise=[5, 8, 10], Umbria=[5, 8, 6])
+        rules = [rule('Lazio', 'sale'), rule('Molise', 'sale'), rule('Umbria', 'scende'), rule('Molise', 'scende')]
+        self.assertEqual(self.evaluate(weeks, rules), [True, False, True, False])
+
+
+    def test_threshold(self):
+        weeks = make_weeks(Lazio=[1, 5, 8], Molise=[1, 8, 9], Umbria=[1, 9, 6])
+        rules = [rule('Lazio', 'sopra', 7), rule('Molise', 'sopra', 7), rule('Umbria', 'sotto', 7), rule('Umbria', 'sotto', 5)]
+        self.assertEqual(self.evaluate(weeks, rules), [True, False, True, False])
+
+
+    def test_missing(self):
+        weeks = make_weeks(Lazio=[5, 8], Molise=[8])
+        rules = [rule('Lazio', 'sopra', 7), rule('Lazio', 'sale'), rule('Molise', 'sopra', 7), rule('Atlantide', 'sopra', 7)]
+        self.assertEqual(self.evaluate(weeks, rules), [True, False, False, False])
+
+
+    def test_per_capita(self):
+        inhabitants = population.get('regions', 'Lazio')
+        weeks = make_weeks(Lazio=[0, 0.5 * inhabitants / population.PER, 2 * inhabitants / population.PER])
+        areas, values = alerts.get_values(weeks)
+        self.assertTrue(np.allclose(values[1, 0, 1:], [0.5, 2]))
+        rules = [rule('Lazio', 'sopra', 1, alerts.METRICS[1]), rule('Lazio', 'sopra', 1)]
+        self.assertEqual(self.evaluate(weeks, rules), [True, False])
+
+
+    def test_nation(self):
+        weeks = {settings.NATION : [{'nuovi_positivi' : c} for c in (10, 5, 8)]}
+        self.assertEqual(self.evaluate(weeks, [rule(settings.NATION, 'sale')]), [True])
+
+
+    def test_describe(self):
+        self.assertEqual(alerts.describe(rule('Lazio', 'sale')), 'Lazio: nuovi casi settimanali in aumento')
+        self.assertIn('ogni 100mila abitanti', alerts.describe(rule('Lazio', 'sopra', 7, alerts.METRICS[1])))
+
+
+if __name__ == '__main__':
+    unittest.main()
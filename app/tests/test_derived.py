@@ -0,0 +1,61 @@
+"""
+Derived metrics: moving averages, weekly ratios, positivity and doubling time, NaN where undefined
+"""
+
+import unittest
+import numpy as np
+from utils import derived
+
+
+METRICS = ['totale_casi', 'tamponi', 'nuovi_positivi']
+
+
+def make_cube(total, tests, new):
+    """Return a cube (metric x area x day) of a single area"""
+    return np.array([[total], [tests], [new]], dtype=float)
+
+
+class TestDerived(unittest.TestCase):
+
+
+    def get(self, result, metric):
+        return result[derived.METRICS.index(metric), 0]
+
+
+    def test_linear(self):
+        days = np.arange(30, dtype=float)
+        result = derived.compute(make_cube(100 + 10 * days, 50 * days, np.full(30, 10.)), METRICS)
+        self.assertEqual(result.shape, (len(derived.METRICS), 1, 30))
+
+        average = self.get(result, 'nuovi_casi_media_7gg')
+        self.assertTrue(np.isnan(average[:7]).all())
+        self.assertTrue(np.allclose(average[7:], 10))
+
+        ratio = self.get(result, 'rapporto_settimanale')
+        self.assertTrue(np.isnan(ratio[:14]).all())
+        self.assertTrue(np.allclose(ratio[14:], 1))
+
+        self.assertTrue(np.allclose(self.get(result, 'tamponi_nuovi')[1:], 50))
+        self.assertTrue(np.allclose(self.get(result, 'tasso_positivita')[1:], 0.2))
+
+
+    def test_doubling(self):
+        days = np.arange(30, dtype=float)
+        result = derived.compute(make_cube(100 * 2 ** (days / 7), 50 * days, np.full(30, 10.)), METRICS)
+        doubling = self.get(result, 'tempo_raddoppio')
+        self.assertTrue(np.isnan(doubling[:7]).all())
+        self.assertTrue(np.allclose(doubling[7:], 7))
+
+
+    def test_undefined(self):
+        # flat totals never double, no tests give no positivity, missing days stay missing
+        total = np.full(20, 100.)
+        total[10] = np.nan
+        result = derived.compute(make_cube(total, np.zeros(20), np.zeros(20)), METRICS)
+        self.assertTrue(np.isnan(self.get(result, 'tempo_raddoppio')).all())
+        self.assertTrue(np.isnan(self.get(result, 'tasso_positivita')).all())
+        self.assertTrue(np.isnan(self.get(result, 'nuovi_casi_media_7gg')[10:17]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+"""
+Inline query answers must stay under 10ms and show charts uploaded after results are built
+
+    python -m unittest tests.test_inline
+"""
+
+import unittest
+from bench.run import timeit, inline_fixture
+
+
+class TestInline(unittest.TestCase):
+
+
+    def test_latency(self):
+        results, file_ids, queries = inline_fixture(provinces=10)
+        queries = iter(queries * 100)
+        stats = timeit(lambda: results.answer(next(queries), file_ids), 1000)
+        self.assertLess(stats['p99'], 10)
+
+
+    def test_late_charts(self):
+        results, file_ids, _ = inline_fixture(provinces=1)
+        self.assertFalse(hasattr(results.answer('')[0], 'photo_file_id'))
+        # the national chart is uploaded after results are built
+        file_ids['chart-0'] = 'file-0'
+        self.assertEqual(results.answer('', file_ids)[0].photo_file_id, 'file-0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Chart ranges: parsing of time ranges and buckets keeping the number of points bounded
+"""
+
+import datetime
+import unittest
+from utils import misc
+
+
+class TestRanges(unittest.TestCase):
+
+
+    def test_parse_range(self):
+        self.assertEqual(misc.parse_range('30g'), 30)
+        self.assertEqual(misc.parse_range('8s'), 56)
+        self.assertEqual(misc.parse_range(' 6 M '), 180)
+        self.assertEqual(misc.parse_range('1a'), 365)
+        self.assertEqual(misc.parse_range('tutto'), misc.RANGE_MAX)
+
+
+    def test_parse_range_bounds(self):
+        self.assertEqual(misc.parse_range('100a'), misc.RANGE_MAX)
+        self.assertIsNone(misc.parse_range('0g'))
+        self.assertIsNone(misc.parse_range('30'))
+        self.assertIsNone(misc.parse_range('lombardia'))
+
+
+    def test_get_bucket(self):
+        self.assertIsNone(misc.get_bucket(1))
+        self.assertIsNone(misc.get_bucket(31))
+        self.assertEqual(misc.get_bucket(32), 'week')
+        self.assertEqual(misc.get_bucket(200), 'week')
+        self.assertEqual(misc.get_bucket(201), 'month')
+        self.assertEqual(misc.get_bucket(misc.RANGE_MAX), 'month')
+
+
+    def test_points(self):
+        # points charted for the last `days` (see get_bucket): at most 31 daily, 30 weekly or 121 monthly ones
+        last = datetime.date(2021, 12, 31)
+        for days in (1, 31, 32, 200, 201, 365, misc.RANGE_MAX):
+            bucket = misc.get_bucket(days)
+            dates = [last - datetime.timedelta(days=t) for t in range(days)]
+            if bucket == 'week':
+                points = len({d.isocalendar()[:2] for d in dates})
+            elif bucket == 'month':
+                points = len({(d.year, d.month) for d in dates})
+            else:
+                points = len(dates)
+            self.assertLessEqual(points, {None : 31, 'week' : 30, 'month' : 121}[bucket])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Area names: normalization, exact and fuzzy resolution (above THRESHOLD only) and prefix search
+"""
+
+import unittest
+from utils.names import NameIndex, normalize
+
+
+KEYBOARDS = {
+    'Lombardia' : ['Milano', 'Monza e della Brianza', 'In fase di definizione/aggiornamento'],
+    "Valle d'Aosta" : ['Aosta'],
+    'Emilia-Romagna' : ["Reggio nell'Emilia", 'Forlì-Cesena'],
+    'Calabria' : ['Reggio di Calabria', 'In fase di definizione/aggiornamento'],
+}
+
+
+class TestNames(unittest.TestCase):
+
+
+    def setUp(self):
+        self.index = NameIndex(KEYBOARDS)
+
+
+    def test_normalize(self):
+        self.assertEqual(normalize('Forlì-Cesena'), 'forli cesena')
+        self.assertEqual(normalize("  Reggio nell'Emilia "), 'reggio nell emilia')
+
+
+    def test_exact(self):
+        self.assertEqual(self.index.resolve('MILANO'), ('provinces', 'Milano'))
+        self.assertEqual(self.index.resolve('forli cesena'), ('provinces', 'Forlì-Cesena'))
+        self.assertEqual(self.index.resolve("valle d'aosta"), ('regions', "Valle d'Aosta"))
+
+
+    def test_fuzzy(self):
+        self.assertEqual(self.index.resolve('lombadia'), ('regions', 'Lombardia'))
+        self.assertEqual(self.index.resolve('monza brianza'), ('provinces', 'Monza e della Brianza'))
+
+
+    def test_threshold(self):
+        self.assertIsNone(self.index.resolve('xyz'))
+        self.assertIsNone(self.index.resolve('roma'))
+        self.assertIsNone(self.index.resolve(''))
+
+
+    def test_level(self):
+        self.assertEqual(self.index.resolve('aosta'), ('provinces', 'Aosta'))
+        self.assertEqual(self.index.resolve('aosta', level='regions'), ('regions', "Valle d'Aosta"))
+        self.assertIsNone(self.index.resolve('milano', level='regions'))
+
+
+    def test_pending_area(self):
+        self.assertNotIn('In fase di definizione/aggiornamento', [name for _, name in self.index.areas()])
+        self.assertEqual(len(self.index.areas()), 10)
+
+
+    def test_search(self):
+        matches = self.index.search('reggio')
+        self.assertEqual(set(matches[:2]), {('provinces', "Reggio nell'Emilia"), ('provinces', 'Reggio di Calabria')})
+        self.assertEqual(self.index.search('mil')[0], ('provinces', 'Milano'))
+        self.assertEqual(self.index.search('reggio', level='regions'), [])
+        self.assertEqual(self.index.search(''), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
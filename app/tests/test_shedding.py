@@ -0,0 +1,70 @@
+"""
+Load shedding: start on backlog or latency, stop only once the backlog has stayed low for `hold` seconds
+"""
+
+import unittest
+from unittest import mock
+from utils.shedding import LoadShedder
+
+
+class TestShedding(unittest.TestCase):
+
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('utils.shedding.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shedder = LoadShedder(high_backlog=4, low_backlog=1, high_latency=2, hold=30)
+
+
+    def at(self, now, backlog):
+        """Return whether load is shed at time `now` with a given `backlog`"""
+        self.now = now
+        self.shedder.backlog = backlog
+        return self.shedder.overloaded()
+
+
+    def test_backlog(self):
+        self.assertFalse(self.at(1000, 3))
+        self.assertTrue(self.at(1001, 4))
+        self.assertTrue(self.at(1002, 2))
+
+
+    def test_hold_after_spike(self):
+        self.assertTrue(self.at(1000, 5))
+        # a long spike, then the backlog dips: keep shedding for `hold` seconds from the dip
+        self.assertTrue(self.at(1100, 1))
+        self.assertTrue(self.at(1129, 0))
+        self.assertFalse(self.at(1130, 0))
+
+
+    def test_hold_restarts(self):
+        self.assertTrue(self.at(1000, 5))
+        self.assertTrue(self.at(1100, 1))
+        # the backlog rises again before the hold expires
+        self.assertTrue(self.at(1110, 3))
+        self.assertTrue(self.at(1115, 0))
+        self.assertTrue(self.at(1140, 0))
+        self.assertFalse(self.at(1145, 0))
+
+
+    def test_latency(self):
+        self.shedder.latency = 3
+        self.assertTrue(self.at(1000, 0))
+        self.assertTrue(self.at(1029, 0))
+        self.assertFalse(self.at(1030, 0))
+        # no renders while shedding, the latency estimate restarts
+        self.assertEqual(self.shedder.latency, 0)
+
+
+    def test_track(self):
+        with self.shedder.track():
+            self.assertEqual(self.shedder.backlog, 1)
+            self.now += 4
+        self.assertEqual(self.shedder.backlog, 0)
+        self.assertAlmostEqual(self.shedder.latency, 0.3 * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Single flight: concurrent calls with the same key share one computation, and its errors
+"""
+
+import time
+import threading
+import unittest
+from utils.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+
+    def run_concurrently(self, flight, func, key='k', callers=5):
+        """Call `func` through `flight` from several threads while the first call runs, return results or errors"""
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def leader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return func()
+
+        results = [None] * callers
+
+        def call(i):
+            try:
+                results[i] = flight.do('test', key, leader)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(0,))]
+        threads[0].start()
+        started.wait(5)
+        threads += [threading.Thread(target=call, args=(i,)) for i in range(1, callers)]
+        for t in threads[1:]:
+            t.start()
+        # let followers reach the in-flight call
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        return calls, results
+
+
+    def test_shared(self):
+        flight = SingleFlight()
+        result = object()
+        calls, results = self.run_concurrently(flight, lambda: result)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is result for r in results))
+        self.assertEqual(flight.calls, {})
+
+
+    def test_error(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        calls, results = self.run_concurrently(flight, fail)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        # the next call runs again
+        self.assertEqual(flight.do('test', 'k', lambda: 1), 1)
+
+
+    def test_keys(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('test', 'a', lambda: 1), 1)
+        self.assertEqual(flight.do('test', 'b', lambda: 2), 2)
+        self.assertEqual(flight.do('other', 'a', lambda: 3), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Snapshot: write/read round trip, remapping on change, bad files and range bucketing
+"""
+
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+import numpy as np
+from utils import settings
+from utils import snapshot
+from utils.snapshot import Snapshot
+
+
+FIRST = datetime.datetime(2020, 3, 1, 17)
+DAYS = 61 # March and April 2020
+PENDING = 'In fase di definizione/aggiornamento'
+
+
+def make_data(skip=()):
+    """Return the data of Italia, Lazio and Roma (plus a pending area in two regions), without the days in `skip`"""
+    data = {'nation' : [], 'regions' : [], 'provinces' : []}
+    for t in range(DAYS):
+        if t in skip:
+            continue
+        date = FIRST + datetime.timedelta(days=t)
+        data['nation'].append({'data' : date, 'totale_casi' : 100 * t, 'nuovi_positivi' : 100, 'tamponi' : 1000 * t})
+        data['regions'].append({'data' : date, 'denominazione_regione' : 'Lazio', 'totale_casi' : 10 * t, 'nuovi_positivi' : 10, 'tamponi' : 100 * t})
+        data['provinces'].append({'data' : date, 'denominazione_regione' : 'Lazio', 'denominazione_provincia' : 'Roma', 'totale_casi' : 5 * t})
+        for region in ('Lazio', 'Molise'):
+            data['provinces'].append({'data' : date, 'denominazione_regione' : region, 'denominazione_provincia' : PENDING, 'totale_casi' : 1})
+    return data
+
+
+class TestSnapshot(unittest.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot.bin')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_round_trip(self):
+        snapshot.write(make_data(), 'a' * 32, self.path)
+        s = Snapshot(self.path)
+        self.assertTrue(s.refresh())
+        self.assertFalse(s.refresh())
+        self.assertEqual(s.version, 'a' * 32)
+
+        docs = s.get_documents('regions', 'Lazio', 3)
+        self.assertEqual([d['data'] for d in docs], [FIRST + datetime.timedelta(days=t) for t in (58, 59, 60)])
+        self.assertEqual([d['totale_casi'] for d in docs], [580, 590, 600])
+        self.assertEqual(docs[-1]['denominazione_regione'], 'Lazio')
+        self.assertIsInstance(docs[-1]['totale_casi'], int)
+        self.assertEqual(list(s.get_series('provinces', 'Roma', 'totale_casi', 2)), [295, 300])
+        self.assertEqual(s.get_names('provinces'), ['Roma'])
+        self.assertIsNone(s.get_documents('provinces', PENDING, 3))
+
+
+    def test_rewrite(self):
+        snapshot.write(make_data(), 'a' * 32, self.path)
+        s = Snapshot(self.path)
+        data = s.get()
+        snapshot.write(make_data(), 'b' * 32, self.path)
+        self.assertTrue(s.refresh())
+        self.assertEqual(s.version, 'b' * 32)
+        # readers of the previous version keep a consistent view
+        self.assertEqual(data.version, 'a' * 32)
+        self.assertEqual(data.get_documents('nation', settings.NATION, 1)[0]['totale_casi'], 6000)
+
+
+    def test_bad_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'XXXX' + b'\0' * 100)
+        s = Snapshot(self.path)
+        self.assertFalse(s.refresh())
+        self.assertIsNone(s.get_documents('nation', settings.NATION, 1))
+        self.assertFalse(Snapshot(os.path.join(self.dir, 'missing.bin')).refresh())
+
+
+    def test_range(self):
+        # March 31st is missing: the bucket of March ends on the 30th
+        snapshot.write(make_data(skip={30}), 'a' * 32, self.path)
+        s = Snapshot(self.path)
+        s.refresh()
+        docs = s.get_range('regions', 'Lazio', DAYS, 'month')
+        self.assertEqual([d['data'].date() for d in docs], [datetime.date(2020, 3, 30), datetime.date(2020, 4, 30)])
+        self.assertEqual([d['totale_casi'] for d in docs], [290, 600])
+
+        weeks = s.get_range('regions', 'Lazio', DAYS, 'week')
+        self.assertEqual(len(weeks), len({(FIRST + datetime.timedelta(days=t)).isocalendar()[:2] for t in range(DAYS)}))
+        self.assertTrue(all(d['data'].weekday() == 6 for d in weeks[:-1]))
+        self.assertEqual(len(s.get_range('regions', 'Lazio', 10)), 10)
+        self.assertIsNone(s.get_range('regions', 'Molise', DAYS, 'month'))
+
+
+    def test_derived(self):
+        snapshot.write(make_data(), 'a' * 32, self.path)
+        s = Snapshot(self.path)
+        s.refresh()
+        self.assertTrue(np.allclose(s.get_series('regions', 'Lazio', 'nuovi_casi_media_7gg', 5), 10))
+        self.assertTrue(np.allclose(s.get_series('regions', 'Lazio', 'tasso_positivita', 5), 0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+Storage backends: MemoryStorage must answer like MongoStorage (run on mongomock, skipped if not installed)
+"""
+
+import io
+import os
+import copy
+import contextlib
+import shutil
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+from bson import ObjectId
+from utils import settings
+from utils import storage
+from tests.test_snapshot import make_data, FIRST, DAYS, PENDING
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+# the date of the last report
+DATE = FIRST + datetime.timedelta(days=DAYS - 1)
+
+
+def strip(docs):
+    """Return `docs` without the ids generated by MongoDB"""
+    return [{k: v for k, v in d.items() if not isinstance(v, ObjectId)} if isinstance(d, dict) else d for d in docs]
+
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class TestStorage(unittest.TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for patcher in [
+            mock.patch.object(settings, 'MONGO_DB', mongomock.MongoClient()['test']),
+            mock.patch.object(settings, 'BUCKETED', False),
+            # weekly aggregates use date operators mongomock lacks
+            mock.patch.object(storage.MongoStorage, '_compute_aggregates'),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.mongo = storage.MongoStorage()
+        self.memory = storage.MemoryStorage(os.path.join(self.dir, 'users'))
+        data = make_data()
+        for s in (self.mongo, self.memory):
+            s.set_meta('a' * 32, DATE)
+            with contextlib.redirect_stdout(io.StringIO()):
+                s.ingest(copy.deepcopy(data), DATE)
+            s.unlock()
+
+
+    def assertSame(self, method, *args, **kwargs):
+        """Assert that both storages return the same result of a `method`"""
+        expected = getattr(self.mongo, method)(*args, **kwargs)
+        actual = getattr(self.memory, method)(*args, **kwargs)
+        if isinstance(expected, list) or not isinstance(expected, dict):
+            expected, actual = strip(list(expected)), strip(list(actual))
+        self.assertEqual(actual, expected, method)
+        return actual
+
+
+    def test_meta(self):
+        for s in (self.mongo, self.memory):
+            self.assertEqual(s.get_meta()['ready'], 'a' * 32)
+            s.set_meta('b' * 32, DATE)
+            # the previous version stays ready until the new one is stored
+            self.assertEqual(s.get_meta()['ready'], 'a' * 32)
+            self.assertTrue(s.get_meta()['locked'])
+            s.unlock()
+            self.assertEqual(s.get_meta()['ready'], 'b' * 32)
+
+
+    def test_keyboards(self):
+        keyboards = self.assertSame('get_keyboards')
+        self.assertEqual(keyboards['italy'], ['Lazio', 'Molise'])
+        self.assertEqual(keyboards['Molise'], [PENDING])
+        self.assertEqual(keyboards['Lazio'], [PENDING, 'Roma'])
+
+
+    def test_window(self):
+        self.assertSame('get_window', 'regions', 'Lazio', 5)
+        docs = self.assertSame('get_window', 'provinces', 'Roma', 3, fields=['data', 'totale_casi'])
+        self.assertEqual(docs[-1], {'data' : DATE, 'totale_casi' : 300})
+        self.assertSame('get_window', 'nation', settings.NATION, 2, fields=['totale_casi'])
+
+
+    def test_range(self):
+        self.assertSame('get_range', 'regions', 'Lazio', FIRST + datetime.timedelta(days=50))
+        docs = self.assertSame('get_range', 'regions', 'Lazio', FIRST, 'month')
+        self.assertEqual(len(docs), 2)
+
+
+    def test_iter_documents(self):
+        since = FIRST + datetime.timedelta(days=55)
+        self.assertEqual(len(self.assertSame('iter_documents', 'provinces', 'Roma', since, ['data', 'totale_casi'])), 6)
+        self.assertSame('iter_documents', 'regions', since=since, fields=['data', 'denominazione_regione'])
+
+
+    def test_ranking(self):
+        ranking = self.assertSame('get_ranking', 'regions', DATE, 'totale_casi', ['denominazione_regione', 'totale_casi'])
+        self.assertEqual(ranking, [{'denominazione_regione' : 'Lazio', 'totale_casi' : 600}])
+
+
+    def test_totals(self):
+        since = datetime.datetime(DATE.year, DATE.month, DATE.day) - datetime.timedelta(days=1)
+        self.assertSame('get_totals', None, since)
+        totals = self.assertSame('get_totals', 'Lazio', since)
+        self.assertNotIn(PENDING, [d['_id'] for d in self.assertSame('get_totals', 'all', since)])
+        self.assertEqual(len(totals), 2)
+
+
+    def test_file_ids(self):
+        for s in (self.mongo, self.memory):
+            s.set_file_id('chart', 'v1', 'file-1')
+            self.assertEqual(s.get_file_id('chart', 'v1'), 'file-1')
+            self.assertIsNone(s.get_file_id('chart', 'v2'))
+            s.drop_file_ids()
+            self.assertEqual(s.get_file_ids('v1'), {})
+
+
+    def test_subscriptions(self):
+        for s in (self.mongo, self.memory):
+            s.subscribe(1, 'regions', 'Lazio')
+            s.subscribe(1, 'regions', 'Lazio')
+            s.subscribe(2, 'regions', 'Lazio')
+            s.subscribe(1, 'provinces', 'Roma')
+            s.unsubscribe(1, 'provinces', 'Roma')
+        self.assertSame('get_subscriptions', 1)
+        self.assertEqual(self.memory.get_subscribers(), {('regions', 'Lazio') : [1, 2]})
+        self.assertSame('get_subscribers')
+
+
+    def test_alerts(self):
+        for s in (self.mongo, self.memory):
+            s.add_alert(1, 'Lazio', 'nuovi_positivi', 'sopra', 10)
+            s.add_alert(1, 'Lazio', 'nuovi_positivi', 'sopra', 20)
+            s.add_alert(2, 'Lazio', 'nuovi_positivi', 'sale')
+            s.add_alert(3, settings.NATION, 'nuovi_positivi', 'scende')
+            s.remove_alerts(3)
+            self.assertIsNone(s.get_alerts_week())
+            s.set_alerts_week(12)
+            self.assertEqual(s.get_alerts_week(), 12)
+        alerts = self.assertSame('get_alerts')
+        self.assertEqual([a['threshold'] for a in alerts], [20, None])
+        self.assertSame('get_alerts', 2)
+
+
+    def test_users_file(self):
+        self.memory.subscribe(1, 'regions', 'Lazio')
+        self.memory.add_alert(1, 'Lazio', 'nuovi_positivi', 'sale')
+        self.memory.set_alerts_week(12)
+        # a restarted bot keeps subscriptions and alerts
+        restarted = storage.MemoryStorage(self.memory.users_path)
+        self.assertEqual(restarted.get_subscriptions(1), [('regions', 'Lazio')])
+        self.assertEqual(restarted.get_alerts(1), self.memory.get_alerts(1))
+        self.assertEqual(restarted.get_alerts_week(), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Throttling: token buckets per chat (warning once when empty) and deduplication of repeated requests
+"""
+
+import unittest
+from unittest import mock
+from utils.throttle import RateLimiter, Deduplicator
+
+
+class Clock(object):
+    """A fake time.monotonic"""
+
+
+    def __init__(self):
+        self.now = 1000.0
+
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestThrottle(unittest.TestCase):
+
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('utils.throttle.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=0.5, burst=2)
+        self.assertEqual([limiter.allow(1) for _ in range(4)], [True, True, False, None])
+        # other chats have their own bucket
+        self.assertTrue(limiter.allow(2))
+        # a token every 2 seconds
+        self.clock.now += 2
+        self.assertEqual([limiter.allow(1), limiter.allow(1)], [True, False])
+        self.clock.now += 10
+        self.assertEqual([limiter.allow(1) for _ in range(3)], [True, True, False])
+
+
+    def test_rate_limiter_prune(self):
+        limiter = RateLimiter(rate=1, burst=2, max_chats=2)
+        for chat in range(3):
+            limiter.allow(chat)
+        self.clock.now += 5
+        limiter.allow(3)
+        self.assertEqual(list(limiter.buckets), [3])
+
+
+    def test_deduplicator(self):
+        dedup = Deduplicator(window=30)
+        self.assertFalse(dedup.is_duplicate(1, 'italia'))
+        self.assertTrue(dedup.is_duplicate(1, 'italia'))
+        self.assertFalse(dedup.is_duplicate(2, 'italia'))
+        self.assertFalse(dedup.is_duplicate(1, 'lazio'))
+        self.assertFalse(dedup.is_duplicate(1, 'italia'))
+        self.clock.now += 31
+        self.assertFalse(dedup.is_duplicate(1, 'italia'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Threshold alerts on weekly new cases (Italia and regions)
+
+A rule is an area, a metric, a condition and an optional threshold. At refresh,
+all the rules are evaluated at once against the last complete weeks, as numpy
+arrays, and fire only when their condition starts to hold (e.g., cases start rising)
+"""
+
+import numpy as np
+from . import settings
+from . import population
+
+
+# rule conditions (stored as codes), i.e., weekly new cases:
+# - sale: start rising (weekly change turns positive)
+# - scende: start falling (weekly change turns non-positive)
+# - sopra: go above the threshold
+# - sotto: go below the threshold
+CONDITIONS = {'sale' : 0, 'scende' : 1, 'sopra' : 2, 'sotto' : 3}
+THRESHOLD_CONDITIONS = ('sopra', 'sotto')
+
+# rule metrics, i.e., weekly new cases (absolute or per 100k inhabitants)
+METRICS = ['nuovi_positivi', population.rate_key('nuovi_positivi')]
+
+# complete weeks needed to evaluate rules
+WEEKS = 3
+
+
+def get_values(weeks):
+    """
+    Return the list of areas and a cube (metric x area x week) of their last complete weeks (oldest first)
+    from `weeks`, i.e., {area: [weekly documents, oldest first]}. NaN if missing
+    """
+
+    areas = sorted(weeks)
+    values = np.full((len(METRICS), len(areas), WEEKS), np.nan)
+
+    for a, area in enumerate(areas):
+        cases = [w['nuovi_positivi'] for w in weeks[area]][-WEEKS:]
+        values[0, a, WEEKS - len(cases):] = cases
+        inhabitants = population.get('nation' if area == settings.NATION else 'regions', area)
+        if inhabitants:
+            values[1, a] = population.rate(values[0, a], inhabitants)
+
+    return areas, values
+
+
+def compile_rules(rules, areas):
+    """
+    Compile `rules` (as stored in MongoDB) on a list of `areas` into parallel arrays, i.e.,
+    (area index, metric index, condition code, threshold). Rules on unknown areas never match
+    """
+
+    index = {a: i for i, a in enumerate(areas)}
+    metrics = {m: i for i, m in enumerate(METRICS)}
+    n = len(rules)
+
+    area = np.fromiter((index.get(r['area'], -1) for r in rules), dtype=np.intp, count=n)
+    metric = np.fromiter((metrics[r['metric']] for r in rules), dtype=np.intp, count=n)
+    condition = np.fromiter((CONDITIONS[r['condition']] if r['area'] in index else -1 for r in rules), dtype=np.int8, count=n)
+    threshold = np.fromiter((r.get('threshold') or 0 for r in rules), dtype=np.float64, count=n)
+
+    return area, metric, condition, threshold
+
+
+def evaluate(values, area, metric, condition, threshold):
+    """
+    Evaluate rules given as parallel arrays of area and metric indexes (see get_values), condition codes and thresholds
+    (see compile_rules). Return a boolean mask of the matching rules
+    """
+
+    v = values[metric, area] # rule x week
+    before, previous, current = v[:, -3], v[:, -2], v[:, -1]
+    delta = current - previous
+    previous_delta = previous - before
+
+    # comparisons with NaN (missing weeks) are False
+    with np.errstate(invalid='ignore'):
+        return np.select(
+            [condition == 0, condition == 1, condition == 2, condition == 3],
+            [
+                (delta > 0) & (previous_delta <= 0),
+                (delta <= 0) & (previous_delta > 0),
+                (current > threshold) & (previous <= threshold),
+                (current < threshold) & (previous >= threshold),
+            ],
+            False
+        )
+
+
+def describe(rule):
+    """Describe a rule (as stored in MongoDB)"""
+
+    what = 'nuovi casi settimanali'
+    if rule['metric'] != METRICS[0]:
+        what += ' ogni 100mila abitanti'
+
+    condition = rule['condition']
+    if condition == 'sale':
+        return f'{rule["area"]}: {what} in aumento'
+    if condition == 'scende':
+        return f'{rule["area"]}: {what} in calo'
+    return f'{rule["area"]}: {what} {condition} {rule["threshold"]:n}'
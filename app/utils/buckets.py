@@ -0,0 +1,94 @@
+"""
+Bucketed time-series layout: one document per area per month with parallel arrays
+
+    {
+        '_id' : {'area' : 'Milano', 'month' : datetime(2020, 3, 1)},
+        'area' : 'Milano',
+        'month' : datetime(2020, 3, 1),
+        'data' : [datetime(2020, 3, 1, 18), datetime(2020, 3, 2, 18), ...],
+        'totale_casi' : [406, 506, ...],
+        ...
+    }
+
+Area names and the other repeated strings are stored once per month, so a window
+of days is read from one or two documents. Days are appended with $push
+"""
+
+import pymongo
+from . import settings
+from . import population
+
+
+# metrics stored per level (and their per-capita rates)
+METRICS = {
+    level: info['metrics'] + [population.rate_key(m) for m in population.METRICS[level]]
+    for level, info in settings.DATA.items()
+}
+
+INDEXES = [
+    pymongo.IndexModel([("area", pymongo.ASCENDING), ("month", pymongo.DESCENDING)]),
+]
+
+
+def collection_name(level):
+    """Return the name of the bucketed collection of a `level`"""
+    return f'{level}_buckets'
+
+
+def _month(date):
+    """Return the first day of the month of `date`"""
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def ingest(collection, level, docs):
+    """
+    Append daily `docs` of a `level` (as loaded from data files, sorted by date) to their monthly buckets,
+    with a single $push (of all the days of a bucket) per bucket. Missing values are stored as None
+    """
+
+    field = settings.DATA[level]['area']
+    metrics = METRICS[level]
+
+    # group days per bucket, keeping their order
+    buckets = dict()
+    for d in docs:
+        area = d[field] if field else settings.NATION
+        bucket = buckets.setdefault((area, _month(d['data'])), {'data' : []})
+        bucket['data'].append(d['data'])
+        for metric in metrics:
+            bucket.setdefault(metric, []).append(d.get(metric))
+
+    requests = [
+        pymongo.UpdateOne(
+            {'_id' : {'area' : area, 'month' : month}},
+            {
+                '$setOnInsert' : {'area' : area, 'month' : month},
+                '$push' : {k: {'$each' : v} for k, v in values.items()},
+            },
+            upsert=True
+        )
+        for (area, month), values in buckets.items()
+    ]
+
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+
+
+def to_documents(buckets, level, days):
+    """Flatten `buckets` (any order) into the last `days` daily documents, shaped like the daily layout"""
+
+    field = settings.DATA[level]['area']
+    data = list()
+
+    for b in sorted(buckets, key=lambda b: b['month']):
+        keys = [k for k in METRICS[level] if k in b]
+        for i, date in enumerate(b['data']):
+            d = {'data' : date}
+            if field:
+                d[field] = b['area']
+            for k in keys:
+                if b[k][i] is not None:
+                    d[k] = b[k][i]
+            data.append(d)
+
+    return data[-days:]
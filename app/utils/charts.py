@@ -0,0 +1,241 @@
+"""
+Chart rendering with reusable figure templates (no pyplot)
+
+A template owns a Figure, its Agg canvas and its artists. A render updates the data of
+the artists and redraws, so figures, axes and styles are built once per chart type and preset.
+"""
+
+import io
+import locale
+import threading
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.ticker import FuncFormatter
+from PIL import Image
+from . import instrument
+
+
+# Chart render presets:
+# - figsize (inches) and dpi set the resolution
+# - format is the output format, 'png' or 'jpeg'
+# - colors reduces png charts to a palette (None to keep RGBA)
+# - quality is the jpeg quality
+RENDER_PRESETS = {
+    'original' : {'figsize' : (6.4, 4.8), 'dpi' : 100, 'format' : 'png', 'colors' : None}, # matplotlib defaults
+    'mobile' : {'figsize' : (6, 4.5), 'dpi' : 90, 'format' : 'png', 'colors' : 64},
+    'mobile_jpeg' : {'figsize' : (6, 4.5), 'dpi' : 90, 'format' : 'jpeg', 'quality' : 85},
+    'small' : {'figsize' : (5, 3.75), 'dpi' : 90, 'format' : 'png', 'colors' : 32},
+}
+
+# charts of commands (i.e., matplotlib defaults)
+DEFAULT_PRESET = 'original'
+
+# charts of broadcasts, sent to every user: the smallest preset still readable on phones
+BROADCAST_PRESET = 'mobile'
+
+# matplotlib is not thread-safe (e.g., its font cache), so renders are serialized
+RENDER_LOCK = threading.Lock()
+
+
+def encode(figure, preset):
+    """Draw a `figure` and encode it according to a render `preset`, return a buffer"""
+
+    options = RENDER_PRESETS[preset]
+    buf = io.BytesIO()
+
+    figure.canvas.draw()
+
+    if options['format'] == 'png' and not options.get('colors'):
+        figure.canvas.print_png(buf)
+        buf.seek(0)
+        return buf
+
+    # encode the raw RGBA buffer with Pillow
+    image = Image.frombuffer('RGBA', figure.canvas.get_width_height(), figure.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1).convert('RGB')
+
+    if options['format'] == 'jpeg':
+        image.save(buf, format='JPEG', quality=options['quality'], optimize=True)
+    else:
+        image.quantize(colors=options['colors']).save(buf, format='PNG', optimize=True)
+
+    buf.seek(0)
+    return buf
+
+
+def _format_thousands(value, position):
+    """Format y values with the locale thousands separator (and decimals, e.g., for rates per 100k inhabitants)"""
+    if value % 1:
+        return locale.format_string('%.2f', value, grouping=True)
+    return '{:n}'.format(int(value))
+
+
+
+class Template(object):
+    """A reusable figure with a single axes"""
+
+
+    def __init__(self, preset):
+        options = RENDER_PRESETS[preset]
+        self.preset = preset
+        self.figure = Figure(figsize=options['figsize'], dpi=options['dpi'])
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+        self.ax.yaxis.set_major_formatter(FuncFormatter(_format_thousands))
+        self.title = self.ax.set_title('')
+        self._layout = None
+
+
+    def layout(self, labels):
+        """
+        Fit the layout (i.e., tight_layout) only when the size of labels changes,
+        otherwise keep the margins of the previous render
+        """
+        ticks = [_format_thousands(v, None) for v in self.ax.get_yticks()]
+        key = (len(labels), max((len(l) for l in labels), default=0), max((len(t) for t in ticks), default=0))
+        if key != self._layout:
+            self.figure.tight_layout()
+            self._layout = key
+
+
+
+class LineTemplate(Template):
+    """A line chart with markers"""
+
+
+    def __init__(self, preset):
+        super().__init__(preset)
+        self.line, = self.ax.plot([], [], marker='o', linewidth=3)
+        self.ax.grid()
+
+
+    def render(self, title, labels, values, color):
+        """Render the chart, return a buffer"""
+        x = range(len(values))
+
+        self.title.set_text(title)
+        self.line.set_data(x, values)
+        self.line.set_color(color)
+
+        self.ax.set_xticks(x)
+        self.ax.set_xticklabels(labels, rotation=45)
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+        self.layout(labels)
+        return encode(self.figure, self.preset)
+
+
+
+class BarTemplate(Template):
+    """A bar chart with a text on the top of each bar"""
+
+
+    def __init__(self, preset):
+        super().__init__(preset)
+        self.bars = None
+        self.texts = []
+
+
+    def render(self, title, labels, values, colors, texts):
+        """Render the chart, return a buffer"""
+        x = range(len(values))
+
+        self.title.set_text(title)
+
+        # bars are rebuilt only if their number changes
+        if self.bars is None or len(self.bars) != len(values):
+            if self.bars is not None:
+                self.bars.remove()
+            for t in self.texts:
+                t.remove()
+            self.bars = self.ax.bar(x, values)
+            self.texts = [self.ax.text(i, 0, '', size=9, horizontalalignment='center', verticalalignment='bottom') for i in x]
+
+        for bar, text, value, color, s in zip(self.bars, self.texts, values, colors, texts):
+            bar.set_height(value)
+            bar.set_color(color)
+            text.set_y(value + 5)
+            text.set_text(s)
+
+        self.ax.set_xticks(x)
+        self.ax.set_xticklabels(labels, rotation=40)
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+        self.layout(labels)
+        return encode(self.figure, self.preset)
+
+
+class MultiLineTemplate(Template):
+    """Several line series on the same axes, with a legend"""
+
+
+    def __init__(self, preset):
+        super().__init__(preset)
+        self.lines = []
+        self.ax.grid()
+
+
+    def render(self, title, labels, series):
+        """Render the chart of `series`, i.e., a list of (name, values), return a buffer"""
+        x = range(len(labels))
+
+        self.title.set_text(title)
+
+        # reuse line artists, add the missing ones
+        while len(self.lines) < len(series):
+            line, = self.ax.plot([], [], linewidth=2)
+            self.lines.append(line)
+
+        for i, line in enumerate(self.lines):
+            if i < len(series):
+                name, values = series[i]
+                line.set_data(x, values)
+                line.set_label(name)
+                line.set_visible(True)
+            else:
+                line.set_visible(False)
+
+        self.ax.legend(handles=self.lines[:len(series)], fontsize=8, loc='upper left')
+
+        # show a label every few days
+        step = max(len(labels) // 10, 1)
+        self.ax.set_xticks(x[::step])
+        self.ax.set_xticklabels(labels[::step], rotation=45)
+        self.ax.relim(visible_only=True)
+        self.ax.autoscale_view()
+
+        self.layout(labels[::step])
+        return encode(self.figure, self.preset)
+
+
+# templates per (chart type, preset), built on first use
+TEMPLATES = dict()
+
+
+def _get_template(cls, preset):
+    """Return the template of a chart type for a `preset`"""
+    if (cls, preset) not in TEMPLATES:
+        TEMPLATES[(cls, preset)] = cls(preset)
+    return TEMPLATES[(cls, preset)]
+
+
+def line_chart(title, labels, values, color, preset=DEFAULT_PRESET):
+    """Render a line chart, return a buffer"""
+    # time the render only, not the wait for the lock
+    with RENDER_LOCK, instrument.timed('chart_render', name='line_chart'):
+        return _get_template(LineTemplate, preset).render(title, labels, values, color)
+
+
+def bar_chart(title, labels, values, colors, texts, preset=DEFAULT_PRESET):
+    """Render a bar chart, return a buffer"""
+    # time the render only, not the wait for the lock
+    with RENDER_LOCK, instrument.timed('chart_render', name='bar_chart'):
+        return _get_template(BarTemplate, preset).render(title, labels, values, colors, texts)
+
+
+def multi_line_chart(title, labels, series, preset=DEFAULT_PRESET):
+    """Render several line series in one chart, return a buffer"""
+    # time the render only, not the wait for the lock
+    with RENDER_LOCK, instrument.timed('chart_render', name='multi_line_chart'):
+        return _get_template(MultiLineTemplate, preset).render(title, labels, series)
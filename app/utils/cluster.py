@@ -0,0 +1,451 @@
+"""
+Multi-instance mode: several bot processes (on one or more nodes) share Telegram updates through MongoDB
+
+- one instance at a time (the poller, elected by a lease) fetches updates from Telegram and enqueues them
+- the queue is split into partitions by chat id. Every instance leases a fair share of the partitions
+  and processes their updates in order, so the updates of a chat are handled in order, by one instance at a time
+- chat data, user data and conversation states are stored in MongoDB (see MongoPersistence) and reloaded
+  before each update, so chats can move to another instance when partitions are rebalanced
+
+Per-chat state kept in memory (e.g., rate limits) stays correct, since chats stick to the owner of their partition.
+Charts and exports are shared by their file_ids (see Report.get_file_id)
+
+Delivery is at-least-once: handlers run to completion (even @run_async ones, see Instance) before their update
+is acked, while the lease of the partition is held. An update is processed again if its instance dies before
+the ack, or if its handlers outlast the lease (i.e., take over LEASE_MARGIN seconds while renewals fail)
+"""
+
+import os
+import json
+import math
+import time
+import pickle
+import socket
+import uuid
+import datetime
+import threading
+from copy import deepcopy
+from collections import defaultdict
+from bson.binary import Binary
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.utils.promise import Promise
+from . import settings
+from . import instrument
+
+
+# seconds a lease (of the poller or of a partition) lasts if not renewed
+LEASE_TTL = 30
+
+# seconds before expiry when an instance stops using a lease (longer than an update takes)
+LEASE_MARGIN = 10
+
+# seconds between lease renewals and rebalances
+REBALANCE_INTERVAL = 5
+
+# updates processed per partition in a row (then the next partition)
+BATCH = 20
+
+# seconds to wait when there are no updates
+IDLE = 0.1
+
+# seconds processed updates are kept, to skip them if fetched again (Telegram keeps updates for 24 hours)
+DONE_TTL = 24 * 60 * 60
+
+# getUpdates long polling timeout (seconds)
+POLL_TIMEOUT = 10
+
+
+
+class MongoPersistence(BasePersistence):
+    """
+    Store chat data, user data, bot data and conversation states in MongoDB, shared by all the instances.
+    Like PicklePersistence, data are pickled and just changed values are written
+    """
+
+
+    def __init__(self, db=None):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.db = db if db is not None else settings.MONGO_DB
+        self.chat_data = None
+        self.user_data = None
+        self.bot_data = None
+        self.conversations = defaultdict(dict)
+
+
+    def _load_all(self, collection):
+        """Return all the data of a `collection` as {id: data}"""
+        data = defaultdict(dict)
+        for d in self.db[collection].find():
+            data[d['_id']] = pickle.loads(d['data'])
+        return data
+
+
+    def _load(self, collection, _id):
+        """Return the data of an `_id` from a `collection` (None if missing)"""
+        doc = self.db[collection].find_one({'_id' : _id})
+        return pickle.loads(doc['data']) if doc else None
+
+
+    def _reload(self, collection, cache, data, _id):
+        """Reload the data of an `_id` into the dispatcher `data` and the `cache` of written values"""
+        value = self._load(collection, _id)
+        if value is None:
+            # new chats and users are written even if empty (e.g., to be notified)
+            data[_id] = dict()
+            cache.pop(_id, None)
+        else:
+            data[_id] = value
+            cache[_id] = deepcopy(value)
+
+
+    def _write(self, collection, cache, _id, data):
+        """Write the data of an `_id`, unless unchanged since the last write"""
+        if _id in cache and cache[_id] == data:
+            return
+        cache[_id] = deepcopy(data)
+        self.db[collection].update_one({'_id' : _id}, {'$set' : {'data' : Binary(pickle.dumps(data))}}, upsert=True)
+
+
+    def get_chat_data(self):
+        if self.chat_data is None:
+            self.chat_data = self._load_all('chat_data')
+        return deepcopy(self.chat_data)
+
+
+    def get_user_data(self):
+        if self.user_data is None:
+            self.user_data = self._load_all('user_data')
+        return deepcopy(self.user_data)
+
+
+    def get_bot_data(self):
+        if self.bot_data is None:
+            self.bot_data = self._load('bot_data', 'bot') or dict()
+        return deepcopy(self.bot_data)
+
+
+    def get_conversations(self, name):
+        states = {tuple(d['key']): d['state'] for d in self.db['conversations'].find({'name' : name})}
+        self.conversations[name] = dict(states)
+        return states
+
+
+    def update_chat_data(self, chat_id, data):
+        self._write('chat_data', self.chat_data, chat_id, data)
+
+
+    def update_user_data(self, user_id, data):
+        self._write('user_data', self.user_data, user_id, data)
+
+
+    def update_bot_data(self, data):
+        if self.bot_data == data:
+            return
+        self.bot_data = deepcopy(data)
+        self.db['bot_data'].update_one({'_id' : 'bot'}, {'$set' : {'data' : Binary(pickle.dumps(data))}}, upsert=True)
+
+
+    def update_conversation(self, name, key, new_state):
+        # a state pending on an async handler, i.e., (old state, promise): keep the old one until resolved
+        if isinstance(new_state, tuple):
+            new_state = new_state[0]
+        if key in self.conversations[name] and self.conversations[name][key] == new_state:
+            return
+        self.conversations[name][key] = new_state
+
+        _id = f'{name}|{json.dumps(list(key))}'
+        if new_state is None:
+            self.db['conversations'].delete_one({'_id' : _id})
+        else:
+            self.db['conversations'].update_one({'_id' : _id}, {'$set' : {'name' : name, 'key' : list(key), 'state' : new_state}}, upsert=True)
+
+
+    def flush(self):
+        # every change is already written
+        pass
+
+
+    def get_chat_ids(self):
+        """Return the ids of all the chats (e.g., to notify users)"""
+        return self.db['chat_data'].distinct('_id')
+
+
+    def load(self, dispatcher, update):
+        """Reload the chat data, user data and conversation states of the chat and user of `update` (last written by any instance)"""
+
+        chat, user = update.effective_chat, update.effective_user
+
+        if chat:
+            self._reload('chat_data', self.chat_data, dispatcher.chat_data, chat.id)
+        if user:
+            self._reload('user_data', self.user_data, dispatcher.user_data, user.id)
+
+        if not (chat and user):
+            return
+
+        # the states of the chat in all the persistent conversations, in one round trip
+        conversations = dict()
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and handler.persistent:
+                    key = handler._get_key(update)
+                    conversations[f'{handler.name}|{json.dumps(list(key))}'] = (handler, key)
+        if not conversations:
+            return
+        states = {d['_id'] : d['state'] for d in self.db['conversations'].find({'_id' : {'$in' : list(conversations)}})}
+
+        for _id, (handler, key) in conversations.items():
+            state = states.get(_id)
+            with handler._conversations_lock:
+                if state is not None:
+                    handler.conversations[key] = state
+                else:
+                    handler.conversations.pop(key, None)
+            if state is not None:
+                self.conversations[handler.name][key] = state
+            else:
+                self.conversations[handler.name].pop(key, None)
+
+
+
+class UpdateQueue(object):
+    """Telegram updates stored in MongoDB, partitioned by chat id, and the leases of the instances"""
+
+
+    def __init__(self, db=None, partitions=None):
+        self.db = db if db is not None else settings.MONGO_DB
+        self.partitions = partitions or settings.PARTITIONS
+        self.updates = self.db['updates']
+        self.leases = self.db['leases']
+        self.instances = self.db['instances']
+        self.updates.create_index([('partition', 1), ('done', 1), ('_id', 1)])
+        # processed updates expire (pending ones have no expiry)
+        self.updates.create_index('expires', expireAfterSeconds=0)
+
+
+    def partition(self, update):
+        """Return the partition of an `update` (by chat, by user without a chat, e.g., inline queries)"""
+        owner = update.effective_chat or update.effective_user
+        return owner.id % self.partitions if owner else 0
+
+
+    def push(self, updates):
+        """Enqueue Telegram `updates` (already enqueued ones, even if processed, are skipped)"""
+        docs = [{'_id' : u.update_id, 'partition' : self.partition(u), 'done' : False, 'update' : u.to_dict()} for u in updates]
+        if not docs:
+            return
+        try:
+            self.updates.insert_many(docs, ordered=False)
+        except BulkWriteError:
+            pass # duplicates, e.g., fetched again by a new poller
+        instrument.inc('cluster_updates', state='enqueued', value=len(docs))
+
+
+    def claim(self, partition, owner, limit=BATCH):
+        """Return the oldest updates of a `partition`, in order, claimed by `owner` (the owner of the partition)"""
+        docs = list(self.updates.find({'partition' : partition, 'done' : False}).sort([('_id', 1)]).limit(limit))
+        if docs:
+            self.updates.update_many({'_id' : {'$in' : [d['_id'] for d in docs]}, 'done' : False}, {'$set' : {'owner' : owner}})
+        return docs
+
+
+    def ack(self, update_id, owner):
+        """
+        Mark as processed an update claimed by `owner` (kept for DONE_TTL seconds, so it is not enqueued again).
+        Return False if claimed by another owner meanwhile
+        """
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=DONE_TTL)
+        result = self.updates.update_one({'_id' : update_id, 'owner' : owner, 'done' : False}, {'$set' : {'done' : True, 'expires' : expires}})
+        return result.modified_count == 1
+
+
+    def acquire(self, name, owner, ttl=LEASE_TTL):
+        """Acquire or renew the lease `name` for `owner`. Return the lease document, None if held by another owner"""
+        now = datetime.datetime.utcnow()
+        try:
+            return self.leases.find_one_and_update(
+                {'_id' : name, '$or' : [{'owner' : owner}, {'expires' : {'$lt' : now}}]},
+                {'$set' : {'owner' : owner, 'expires' : now + datetime.timedelta(seconds=ttl)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError: # held by another owner
+            return None
+
+
+    def release(self, name, owner):
+        """Release the lease `name` of `owner` (others can acquire it at once)"""
+        self.leases.update_one({'_id' : name, 'owner' : owner}, {'$set' : {'expires' : datetime.datetime.min}})
+
+
+    def heartbeat(self, owner, ttl=LEASE_TTL):
+        """Record that `owner` is alive, return the number of live instances"""
+        now = datetime.datetime.utcnow()
+        self.instances.update_one({'_id' : owner}, {'$set' : {'expires' : now + datetime.timedelta(seconds=ttl)}}, upsert=True)
+        return self.instances.count_documents({'expires' : {'$gt' : now}})
+
+
+    def leave(self, owner):
+        """Remove `owner` from live instances"""
+        self.instances.delete_one({'_id' : owner})
+
+
+
+class Instance(object):
+    """
+    A bot instance: it leases a fair share of the partitions (i.e., partitions / live instances),
+    processes their updates through its dispatcher (one update at a time, as a single Updater does)
+    and, if elected, polls Telegram for new updates.
+    @run_async handlers run synchronously, so an update is acked (and the next one of its chat is handled)
+    only once its handlers are done
+    """
+
+
+    def __init__(self, updater, queue=None, poll=True, rebalance_interval=REBALANCE_INTERVAL):
+        self.updater = updater
+        self.dispatcher = updater.dispatcher
+        self.queue = queue or UpdateQueue()
+        self.poll = poll
+        self.rebalance_interval = rebalance_interval
+        self.owner = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        # owned partitions and when to stop using them (time.monotonic), unless renewed
+        self.owned = dict()
+        self.lock = threading.Lock()
+        self.live = 1
+        self.running = False
+        self.dispatcher.run_async = self._run_async
+
+
+    def _run_async(self, func, *args, **kwargs):
+        """Run a function queued by @run_async at once, return its (resolved) Promise"""
+        promise = Promise(func, args, kwargs)
+        promise.run()
+        return promise
+
+
+    def _lease(self, partition):
+        """Acquire or renew the lease of a `partition` (holding the lock), return True if held"""
+        start = time.monotonic()
+        if self.queue.acquire(f'partition-{partition}', self.owner):
+            self.owned[partition] = start + LEASE_TTL - LEASE_MARGIN
+            return True
+        self.owned.pop(partition, None)
+        return False
+
+
+    def holds(self, partition):
+        """Return True if the lease of a `partition` is held (and not about to expire)"""
+        return time.monotonic() < self.owned.get(partition, 0)
+
+
+    def renew(self):
+        """Record this instance as alive and renew its leases"""
+        self.live = self.queue.heartbeat(self.owner)
+        with self.lock:
+            for p in list(self.owned):
+                self._lease(p)
+
+
+    def _keep_alive(self):
+        """Renew leases while running, apart from processing (so that long batches do not lose them)"""
+        while self.running:
+            time.sleep(self.rebalance_interval)
+            try:
+                self.renew()
+            except Exception as e:
+                print(f'Cannot renew leases: {e}') # Move this print to the logger
+
+
+    def rebalance(self):
+        """Release or acquire partitions to own a fair share (between updates, so released partitions are idle)"""
+
+        share = math.ceil(self.queue.partitions / max(self.live, 1))
+
+        with self.lock:
+            while len(self.owned) > share:
+                p = list(self.owned)[-1]
+                del self.owned[p]
+                self.queue.release(f'partition-{p}', self.owner)
+
+            # start from a different partition on each instance
+            start = hash(self.owner) % self.queue.partitions
+            for i in range(self.queue.partitions):
+                if len(self.owned) >= share:
+                    break
+                p = (start + i) % self.queue.partitions
+                if p not in self.owned:
+                    self._lease(p)
+
+
+    def process(self, partition):
+        """Process a batch of updates of a `partition`, in order, while holding its lease. Return the number of processed updates"""
+
+        processed = 0
+        for doc in self.queue.claim(partition, self.owner):
+            update = Update.de_json(doc['update'], self.updater.bot)
+            self.dispatcher.persistence.load(self.dispatcher, update)
+            # checked right before the handlers (i.e., their replies), after the round trips above
+            if not self.holds(partition):
+                break
+            with instrument.timed('cluster_update'):
+                self.dispatcher.process_update(update)
+            if not self.queue.ack(doc['_id'], self.owner):
+                instrument.inc('cluster_updates', state='lost')
+                break
+            processed += 1
+        if processed:
+            instrument.inc('cluster_updates', state='processed', value=processed)
+        return processed
+
+
+    def _poll(self):
+        """Fetch updates from Telegram into the queue while holding the poller lease"""
+
+        while self.running:
+            lease = self.queue.acquire('poller', self.owner)
+            if not lease:
+                time.sleep(self.rebalance_interval)
+                continue
+            try:
+                updates = self.updater.bot.get_updates(offset=lease.get('offset'), timeout=POLL_TIMEOUT)
+            except Exception as e:
+                print(f'Cannot get updates: {e}') # Move this print to the logger
+                time.sleep(1)
+                continue
+            if updates:
+                # updates fetched again (e.g., by the next poller, before the offset is saved) are skipped by push
+                self.queue.push(updates)
+                self.queue.leases.update_one({'_id' : 'poller'}, {'$max' : {'offset' : updates[-1].update_id + 1}})
+
+
+    def run(self, stop=None):
+        """Run until `stop()` returns True (forever if None)"""
+
+        self.running = True
+        self.renew()
+        threading.Thread(target=self._keep_alive, daemon=True).start()
+        if self.poll:
+            threading.Thread(target=self._poll, daemon=True).start()
+
+        last = 0
+        try:
+            while not (stop and stop()):
+                if time.monotonic() - last >= self.rebalance_interval:
+                    self.rebalance()
+                    last = time.monotonic()
+
+                # round robin on owned partitions
+                processed = sum(self.process(p) for p in list(self.owned) if self.holds(p))
+                if not processed:
+                    time.sleep(IDLE)
+        finally:
+            self.running = False
+            with self.lock:
+                for p in list(self.owned):
+                    del self.owned[p]
+                    self.queue.release(f'partition-{p}', self.owner)
+            self.queue.release('poller', self.owner)
+            self.queue.leave(self.owner)
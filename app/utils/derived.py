@@ -0,0 +1,62 @@
+"""
+Derived metrics, computed for every area in one vectorized pass
+"""
+
+import numpy as np
+
+
+# name of derived metrics, in the order returned by `compute`
+METRICS = [
+    'nuovi_casi_media_7gg',     # 7-day moving average of new cases
+    'rapporto_settimanale',     # moving average vs. the one of 7 days before
+    'tamponi_nuovi',            # new tests
+    'tasso_positivita',         # nuovi_positivi / new tests
+    'tempo_raddoppio',          # doubling time of total cases (in days)
+]
+
+
+def _shift(a, n):
+    """Shift `a` of `n` days along the last axis, padding with NaN"""
+    out = np.full_like(a, np.nan)
+    out[..., n:] = a[..., :-n]
+    return out
+
+
+def _moving_average(a, window):
+    """Moving average along the last axis (NaN for the first `window - 1` days)"""
+    out = np.full_like(a, np.nan)
+    out[..., window - 1:] = np.lib.stride_tricks.sliding_window_view(a, window, axis=-1).mean(axis=-1)
+    return out
+
+
+def _divide(a, b):
+    """Element-wise a / b, NaN where b is not positive"""
+    out = np.full_like(a, np.nan)
+    np.divide(a, b, out=out, where=b > 0)
+    return out
+
+
+def compute(cube, metrics):
+    """
+    Compute derived metrics from a `cube` (metric x area x day) whose rows are named in `metrics`.
+    Return a cube (derived metric x area x day), see METRICS
+    """
+
+    m = {name: i for i, name in enumerate(metrics)}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        # new cases from the cumulative ones (provinces do not report `nuovi_positivi`)
+        total = cube[m['totale_casi']]
+        new = total - _shift(total, 1)
+        average = _moving_average(new, 7)
+        ratio = _divide(average, _shift(average, 7))
+
+        tests = cube[m['tamponi']] - _shift(cube[m['tamponi']], 1)
+        positivity = _divide(cube[m['nuovi_positivi']], tests)
+
+        growth = _divide(total, _shift(total, 7))
+        doubling = 7 * np.log(2) / np.log(growth)
+        doubling[~(growth > 1)] = np.nan
+
+    return np.stack([average, ratio, tests, positivity, doubling])
@@ -0,0 +1,88 @@
+"""
+CSV exports of the series (gzip), for /esporta and export.py
+
+Documents are streamed from the storage through a generator of rows into the gzip file,
+so memory stays bounded even for all the provinces over all the history.
+Exports are written once per data version (see get_path), then reused.
+Exports of previous versions are pruned once no longer used (see prune)
+"""
+
+import os
+import io
+import csv
+import gzip
+import time
+import shutil
+import threading
+from . import settings
+from . import population
+from .names import normalize
+
+
+# seconds an export directory of a previous version is kept since its last change (e.g., for requests still serving it)
+PRUNE_AFTER = 10 * 60
+
+
+def get_columns(level):
+    """Return the columns of the export of a `level`, i.e., date, labels, metrics and their per-capita rates"""
+    info = settings.DATA[level]
+    return ['data'] + info['labels'] + info['metrics'] + [population.rate_key(m) for m in population.METRICS[level]]
+
+
+def rows(docs, columns):
+    """Yield the header and a row per document of `docs`, with `columns` (empty if missing)"""
+    yield columns
+    for d in docs:
+        yield [d['data'].isoformat() if c == 'data' else d.get(c, '') for c in columns]
+
+
+def write(docs, columns, f):
+    """Write `docs` to a binary file `f` as a gzip CSV, row by row"""
+    with gzip.GzipFile(fileobj=f, mode='wb') as z:
+        with io.TextIOWrapper(z, encoding='utf-8', newline='') as text:
+            csv.writer(text).writerows(rows(docs, columns))
+
+
+def get_filename(level, name=None, days=None):
+    """Return the file name of the export of an area (all the areas of a `level` if `name` is None) of last `days`"""
+    area = normalize(name).replace(' ', '_') if name else level
+    return f"covid19-{area}-{f'{days}g' if days else 'tutto'}.csv.gz"
+
+
+def get_path(version, filename):
+    """Return the path of an export of a data `version`"""
+    return f'{settings.EXPORT_PATH}/{version}/{filename}'
+
+
+def export(report, version, level, name=None, days=None):
+    """
+    Export an area (all the areas of a `level` if `name` is None) of last `days` (all the history if None)
+    for a data `version`, unless already exported. Return its path
+    """
+
+    path = get_path(version, get_filename(level, name, days))
+    if os.path.exists(path):
+        return path
+
+    # write aside, then move at once (concurrent requests never read partial files)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    columns = get_columns(level)
+    with open(tmp, 'wb') as f:
+        write(report.iter_cases(level, name, days, columns), columns, f)
+    os.replace(tmp, path)
+
+    prune(version)
+    return path
+
+
+def prune(version):
+    """Remove exports of versions other than `version` unchanged for PRUNE_AFTER seconds (i.e., no longer written or served)"""
+    for old in os.listdir(settings.EXPORT_PATH):
+        directory = f'{settings.EXPORT_PATH}/{old}'
+        try:
+            stale = old != version and time.time() - os.path.getmtime(directory) > PRUNE_AFTER
+        except FileNotFoundError: # pruned meanwhile
+            continue
+        if stale:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,86 @@
+"""
+Inline query answers (e.g., @bot Lombardia in any chat)
+
+Summaries of every area are built once per data version (in the background, see bot.py),
+so answering a query is just a lookup in the in-memory name index (no database, no rendering).
+Charts are looked up among the file_ids uploaded so far
+"""
+
+from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent, ParseMode
+from . import misc
+from .names import normalize
+
+
+# results per answer
+LIMIT = 5
+
+# seconds Telegram may cache an answer
+CACHE_TIME = 300
+
+
+def build_result(result_id, name, summary, description, file_id=None):
+    """
+    Build the inline result of an area: its chart (by file_id) captioned with `summary` if available
+    and if the summary fits the caption, a text message otherwise
+    """
+
+    if file_id and len(summary) <= misc.CAPTION_LIMIT:
+        return InlineQueryResultCachedPhoto(
+            id=result_id,
+            photo_file_id=file_id,
+            title=name,
+            description=description,
+            caption=summary,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=name,
+        description=description,
+        input_message_content=InputTextMessageContent(summary, parse_mode=ParseMode.MARKDOWN),
+    )
+
+
+
+class InlineResults(object):
+    """Inline results of every area, looked up through the name index"""
+
+
+    def __init__(self, names, areas):
+        """
+        Build results from `names` (a NameIndex) and `areas`, i.e.,
+        {(level, name): (summary, description, chart key)}
+        """
+        self.names = names
+        self.areas = dict()
+        self.nation = list()
+
+        for i, ((level, name), (summary, description, key)) in enumerate(areas.items()):
+            self.areas[(level, name)] = (str(i), name, summary, description, key)
+            if level == 'nation':
+                self.nation.append((level, name))
+
+
+    def _build(self, areas, file_ids):
+        """Return the results of `areas`, with their charts if in `file_ids`"""
+        return [
+            build_result(result_id, name, summary, description, file_ids.get(key))
+            for result_id, name, summary, description, key in (self.areas[a] for a in areas)
+        ]
+
+
+    def answer(self, text, file_ids=None):
+        """
+        Return the results matching `text` (national data for an empty query),
+        with charts among `file_ids` ({chart key: file_id}, e.g., the uploaded ones)
+        """
+
+        file_ids = file_ids or dict()
+        key = normalize(text)
+        if not key:
+            return self._build(self.nation, file_ids)
+
+        areas = self.nation if 'italia'.startswith(key) else []
+        areas = areas + [m for m in self.names.search(key, limit=LIMIT) if m in self.areas]
+        return self._build(areas[:LIMIT], file_ids)
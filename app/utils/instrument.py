@@ -0,0 +1,211 @@
+"""
+Hot-path instrumentation: latency histograms, counters and MongoDB round trips
+
+Use `timed` as a decorator or as a context manager:
+
+    @instrument.timed('bot_handler')
+    def nation(update, context): ...
+
+    with instrument.timed('refresh_stage', name='keyboards'):
+        ...
+
+Metrics are exposed in the Prometheus text format (see `serve`) or as a short summary (see `summary`)
+"""
+
+import time
+import threading
+from functools import wraps
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import monitoring
+
+
+# upper bounds of histogram buckets (in seconds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram(object):
+    """A cumulative histogram of observations"""
+
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe(self, value):
+        """Add an observation"""
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+    def quantile(self, q):
+        """Approximate the `q` quantile with the upper bound of its bucket"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BUCKETS[-1]
+
+
+
+class Registry(object):
+    """A thread-safe registry of histograms and counters"""
+
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(Histogram) # (metric, labels) -> Histogram
+        self.counters = defaultdict(int)         # (metric, labels) -> value
+
+
+    def observe(self, metric, value, **labels):
+        """Add an observation to an histogram"""
+        with self.lock:
+            self.histograms[(metric, tuple(sorted(labels.items())))].observe(value)
+
+
+    def inc(self, metric, value=1, **labels):
+        """Increment a counter"""
+        with self.lock:
+            self.counters[(metric, tuple(sorted(labels.items())))] += value
+
+
+    def get_counter(self, metric, **labels):
+        """Return the value of a counter"""
+        return self.counters.get((metric, tuple(sorted(labels.items()))), 0)
+
+
+    def render(self):
+        """Render all the metrics in the Prometheus text format"""
+
+        def fmt(labels, **extra):
+            items = list(labels) + list(extra.items())
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}' if items else ''
+
+        lines = []
+        with self.lock:
+            for (metric, labels), value in sorted(self.counters.items()):
+                lines.append(f'{metric}_total{fmt(labels)} {value}')
+
+            for (metric, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                seen = 0
+                for bound, n in zip(BUCKETS, h.buckets):
+                    seen += n
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append(f'{metric}_seconds_bucket{fmt(labels, le=le)} {seen}')
+                lines.append(f'{metric}_seconds_sum{fmt(labels)} {h.sum}')
+                lines.append(f'{metric}_seconds_count{fmt(labels)} {h.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def summary(self):
+        """Render a short, human readable summary (count, p50 and p99 per histogram)"""
+        lines = []
+        with self.lock:
+            for (metric, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                name = metric + ''.join(f' {v}' for _, v in labels)
+                lines.append(f'{name}: n={h.count} p50<={h.quantile(0.5) * 1000:g}ms p99<={h.quantile(0.99) * 1000:g}ms')
+            for (metric, labels), value in sorted(self.counters.items()):
+                name = metric + ''.join(f' {v}' for _, v in labels)
+                lines.append(f'{name}: {value}')
+        return '\n'.join(lines)
+
+
+# the registry of this process
+REGISTRY = Registry()
+
+
+
+class timed(object):
+    """Time a block (context manager) or a function (decorator) into the `metric` histogram"""
+
+
+    def __init__(self, metric, **labels):
+        self.metric = metric
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        REGISTRY.observe(self.metric, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+    def __call__(self, func):
+        # label functions with their name
+        labels = dict({'name': func.__name__}, **self.labels)
+
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                REGISTRY.observe(self.metric, time.perf_counter() - start, **labels)
+
+        return timed_func
+
+
+def inc(metric, value=1, **labels):
+    """Increment a counter of the registry"""
+    REGISTRY.inc(metric, value, **labels)
+
+
+
+class MongoListener(monitoring.CommandListener):
+    """Count MongoDB round trips and their latency (pass it to MongoClient `event_listeners`)"""
+
+
+    def started(self, event):
+        pass
+
+
+    def succeeded(self, event):
+        REGISTRY.observe('mongo_command', event.duration_micros / 1e6, command=event.command_name)
+
+
+    def failed(self, event):
+        REGISTRY.observe('mongo_command', event.duration_micros / 1e6, command=event.command_name)
+        REGISTRY.inc('mongo_command_failures', command=event.command_name)
+
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serve /metrics"""
+
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # do not log every scrape
+        pass
+
+
+def serve(port):
+    """Expose metrics on http://0.0.0.0:`port`/metrics from a daemon thread"""
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -4,22 +4,29 @@ Collection of utils
 """
 
 import os
-import gc
 import requests
 import json
 import hashlib
 import dateparser
 from ascii_graph import Pyasciigraph
-import matplotlib.pyplot as plt
-import numpy as np
-import io
 import locale
+import re
+from . import charts
+from .charts import DEFAULT_PRESET, BROADCAST_PRESET
 
 
 
 locale.setlocale(locale.LC_ALL, "it_IT.UTF-8")
 
 
+# maximum length of a photo caption (Bot API)
+CAPTION_LIMIT = 1024
+
+# time ranges (e.g., 30g, 8s, 6m, 1a) and their unit in days
+RANGE_UNITS = {'g' : 1, 's' : 7, 'm' : 30, 'a' : 365}
+RANGE_MAX = 10 * 365
+
+
 
 def get_env_variable(var_name):
     """Get the environment variable or return an exception."""
@@ -80,6 +87,23 @@ def json_dates_hook(dict):
         return dict
 
 
+def slim(docs, fields):
+    """
+    Keep only `fields` of `docs` (missing ones are skipped), storing integral counters as native ints
+    (e.g., 12.0 as 12)
+    """
+
+    data = list()
+    for d in docs:
+        doc = dict()
+        for f in fields:
+            if f in d:
+                v = d[f]
+                doc[f] = int(v) if isinstance(v, float) and v.is_integer() else v
+        data.append(doc)
+    return data
+
+
 def chartify(title, data, auto=False):
     """Create an ascii chart passing a list of tuples [('label', int)]"""
 
@@ -107,7 +131,7 @@ def chartify(title, data, auto=False):
 
     max_value = max(count for _, count in data)
     min_value = min(count for _, count in data)
-    increment = (max_value - min_value) / 12
+    increment = (max_value - min_value) / 12 or 1 # flat series
 
     for label, count in data:
 
@@ -128,7 +152,7 @@ def chartify(title, data, auto=False):
     return chart
 
 
-def plotify(title, data, key):
+def plotify(title, data, key, preset=DEFAULT_PRESET):
     """Return a line chart (in raw bytes)"""
 
     color_map = {
@@ -136,9 +160,6 @@ def plotify(title, data, key):
         'totale_casi' : 'orangered'
     }
 
-    # create a new figure
-    plt.figure()
-
     dates = list()
     values = list()
 
@@ -146,45 +167,10 @@ def plotify(title, data, key):
         dates.append(f"{d['data']:%d-%b}")
         values.append(int(d[key]))
 
+    return charts.line_chart(title, dates, values, color=color_map[key], preset=preset)
 
 
-    # Add title and axes names
-    plt.title(title)
-    # plt.xlabel('data')
-    # plt.ylabel(key)
-
-
-    plt.plot(dates, values, marker='o', color=color_map[key], linewidth=3)
-    plt.xticks(rotation=45)
-    bottom, top = plt.ylim()
-    plt.ylim(bottom=bottom, top=top)
-    plt.grid()
-    
-    # prettify y values
-    current_values = plt.gca().get_yticks()
-    plt.gca().set_yticklabels(['{:n}'.format(int(x)) for x in current_values])
-
-    # responsive layout
-    plt.tight_layout()
-
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-
-    ### Release memory
-    # Clear the current axes.
-    plt.cla() 
-    # Clear the current figure.
-    plt.clf() 
-    # Closes all the figure windows.
-    plt.close('all')   
-    # plt.close(fig)
-    gc.collect()
-
-    return buf
-
-def plotify_bar(title, data):
+def plotify_bar(title, data, preset=DEFAULT_PRESET):
     """Return a bar chart (in raw bytes)"""
 
     x, y, z, labels = [], [], [], []
@@ -195,50 +181,23 @@ def plotify_bar(title, data):
         z.append("lightgrey" if d['giorni'] < 7 else 'green' if d['delta'] <= 0 else 'red' )
         labels.append(human_format(d['nuovi_positivi']) if d['giorni'] == 7 else f"{human_format(d['nuovi_positivi'])}\n(in corso)" )
 
-    x_pos = np.arange(len(x))
-
-    # create a new figure
-    plt.figure()
-
-    plt.title(title)
-
-    # Create bars with different colors
-    plt.bar(x_pos, y, color=z)
-
-    # Create names on the x-axis
-    plt.xticks(x_pos, x, rotation=40)
-
-
-    # Text on the top of each bar
-    x_ticks = plt.gca().get_xticks()
-    for i in range(len(y)):
-        text = data[i]
-        plt.text(x = x_ticks[i], y = y[i]+5, s = labels[i], size = 9, horizontalalignment='center', verticalalignment='bottom')
-
-    # prettify y values
-    current_values = plt.gca().get_yticks()
-    plt.gca().set_yticklabels(['{:n}'.format(int(x)) for x in current_values])
-
-    # responsive layout
-    plt.tight_layout()
+    return charts.bar_chart(title, x, y, colors=z, texts=labels, preset=preset)
 
 
+def plotify_multi(title, data, preset=DEFAULT_PRESET):
+    """
+    Return a chart comparing several series (in raw bytes)
+    `data` is a dict with `dates` and `series`, i.e., a list of (name, values)
+    """
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
+    dates = [f"{d:%d-%b}" for d in data['dates']]
+    return charts.multi_line_chart(title, dates, data['series'], preset=preset)
 
-    ### Release memory
-    # Clear the current axes.
-    plt.cla() 
-    # Clear the current figure.
-    plt.clf() 
-    # Closes all the figure windows.
-    plt.close('all')   
-    # plt.close(fig)
-    gc.collect()
 
-    return buf
+def chart_key(chart, title, **kwargs):
+    """Return a key identifying a chart (i.e., its renderer, title and options)"""
+    options = ','.join(f'{k}={v}' for k, v in sorted(kwargs.items()))
+    return f'{chart}|{title}|{options}'
 
 
 def human_format(num, signed=False):
@@ -283,3 +242,30 @@ def get_icons(delta, delta_delta):
         
         if delta_delta < 0:
             return ('🟢', '⬇️')
+
+
+def parse_range(text):
+    """
+    Return the number of days of a time range, e.g., 30g (days), 8s (weeks), 6m (months), 1a (years) or tutto.
+    Return None if `text` is not a range
+    """
+    text = text.strip().lower()
+    if text == 'tutto':
+        return RANGE_MAX
+    match = re.fullmatch(r'(\d+)\s*([gsma])', text)
+    if not match:
+        return None
+    return min(int(match.group(1)) * RANGE_UNITS[match.group(2)], RANGE_MAX) or None
+
+
+def get_bucket(days):
+    """
+    Return the bucket to downsample a series of `days` to (None, 'week' or 'month'),
+    so that long ranges are charted with a bounded number of points: at most 31 daily,
+    ~29 weekly or, up to RANGE_MAX, ~120 monthly ones
+    """
+    if days <= 31:
+        return None
+    if days <= 200:
+        return 'week'
+    return 'month'
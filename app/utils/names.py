@@ -0,0 +1,137 @@
+"""
+In-memory index of area names (regions and provinces) with fuzzy matching
+"""
+
+import re
+import unicodedata
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+
+# minimum trigram similarity to accept a fuzzy match
+THRESHOLD = 0.3
+
+
+def normalize(text):
+    """Lowercase `text`, strip accents and punctuation"""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def trigrams(text):
+    """Return the set of trigrams of a normalized text"""
+    text = f'  {text} '
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+
+class NameIndex(object):
+    """Resolve free text to canonical area names"""
+
+
+    def __init__(self, keyboards):
+        """
+        Build the index from `keyboards`, i.e., a dict {region: [provinces]}
+        """
+        self.names = dict()               # normalized name -> [(level, canonical name)]
+        self.trigrams = defaultdict(set)  # trigram -> normalized names
+
+        for region, provinces in keyboards.items():
+            self._add('regions', region)
+            for province in provinces:
+                if province.lower() == 'in fase di definizione/aggiornamento':
+                    continue
+                self._add('provinces', province)
+
+
+    def _add(self, level, name):
+        """Add a name to the index"""
+        key = normalize(name)
+        if (level, name) in self.names.get(key, []):
+            return
+        self.names.setdefault(key, []).append((level, name))
+        for t in trigrams(key):
+            self.trigrams[t].add(key)
+
+
+    def areas(self):
+        """Return all the indexed areas as a list of (level, canonical name)"""
+        return [area for entries in self.names.values() for area in entries]
+
+
+    def _filter(self, key, level):
+        """Return the first canonical name of `key` at a given `level` (any level if None)"""
+        for l, name in self.names[key]:
+            if level is None or l == level:
+                return (l, name)
+        return None
+
+
+    def resolve(self, text, level=None):
+        """
+        Return the (level, canonical name) closest to `text`, or None if nothing is close enough.
+        Use `level` ('regions' or 'provinces') to restrict the search
+        """
+
+        key = normalize(text)
+        if not key:
+            return None
+
+        # exact match
+        if key in self.names:
+            match = self._filter(key, level)
+            if match:
+                return match
+
+        best, best_score = None, THRESHOLD
+        for candidate, score in self._score(key).items():
+            match = self._filter(candidate, level)
+            if match and score > best_score:
+                best, best_score = match, score
+
+        return best
+
+
+    def search(self, text, level=None, limit=5):
+        """
+        Return up to `limit` (level, canonical name) matching `text`, best first.
+        Names starting with `text` come first, so partial names (e.g., as you type) match too
+        """
+
+        key = normalize(text)
+        if not key:
+            return []
+
+        scores = self._score(key)
+        for candidate in self.names:
+            if candidate.startswith(key):
+                scores[candidate] = scores.get(candidate, 0) + 1
+
+        matches = list()
+        for candidate, score in sorted(scores.items(), key=lambda item: -item[1]):
+            if score < THRESHOLD:
+                break
+            matches += [(l, name) for l, name in self.names[candidate] if level is None or l == level]
+            if len(matches) >= limit:
+                break
+
+        return matches[:limit]
+
+
+    def _score(self, key):
+        """Return the similarity to `key` of indexed names sharing at least one trigram, as {normalized name: score}"""
+
+        query = trigrams(key)
+        counts = defaultdict(int)
+        for t in query:
+            for candidate in self.trigrams.get(t, ()):
+                counts[candidate] += 1
+
+        scores = dict()
+        for candidate, shared in counts.items():
+            # Jaccard similarity of trigrams, edit-distance ratio to break ties
+            scores[candidate] = shared / (len(query) + len(trigrams(candidate)) - shared)
+            scores[candidate] += SequenceMatcher(None, key, candidate).ratio() / 100
+
+        return scores
@@ -0,0 +1,67 @@
+"""
+Resident population of every area (ISTAT, 1 January 2020) and per-capita rates
+
+The table is bundled with the bot (see population.csv), so rates are computed
+offline, at refresh time, and stored next to the absolute values.
+Province figures are the source of truth: region and nation rows are their
+sums, so rates are consistent across levels
+"""
+
+import os
+import csv
+from functools import lru_cache
+from . import settings
+
+
+# Path for the population table
+POPULATION_PATH = os.path.dirname(__file__)+'/population.csv'
+
+# rates are expressed per PER inhabitants
+PER = 100000
+
+# metrics with a per-capita rate (i.e., `<metric>_100k`) per level
+METRICS = {
+    'nation' : ['totale_positivi', 'variazione_totale_positivi', 'nuovi_positivi', 'totale_casi', 'deceduti', 'terapia_intensiva'],
+    'regions' : ['totale_positivi', 'variazione_totale_positivi', 'nuovi_positivi', 'totale_casi', 'deceduti', 'terapia_intensiva'],
+    'provinces' : ['totale_casi'],
+}
+
+
+def rate_key(metric):
+    """Return the name of the per-capita rate of a `metric`"""
+    return f'{metric}_100k'
+
+
+@lru_cache(maxsize=None)
+def get_population():
+    """Return the population table as a dict {(level, name): population}"""
+    with open(POPULATION_PATH, newline='', encoding='utf-8') as f:
+        return {(row['level'], row['name']): int(row['population']) for row in csv.DictReader(f)}
+
+
+def get(level, name):
+    """Return the population of an area (None if unknown)"""
+    return get_population().get((level, name))
+
+
+def rate(value, population):
+    """Return `value` per PER inhabitants"""
+    return value * PER / population
+
+
+def add_rates(data):
+    """
+    Add per-capita rates to the documents of `data` (as returned by `Data.get_json_data`), in place.
+    Areas without population (e.g., 'In fase di definizione/aggiornamento') get no rate
+    """
+
+    for level, metrics in METRICS.items():
+        field = settings.DATA[level]['area']
+        for d in data[level]:
+            population = get(level, d[field] if field else settings.NATION)
+            if not population:
+                continue
+            for metric in metrics:
+                if d.get(metric) is not None:
+                    d[rate_key(metric)] = round(rate(d[metric], population), 2)
+    return data
@@ -1,13 +1,24 @@
 from collections import OrderedDict
 import datetime
+import io
 import json
 import time
+import logging
+import numpy as np
 from . import settings
 from . import misc
-
-from telegram import ReplyKeyboardRemove, ParseMode
+from . import snapshot
+from . import population
+from . import alerts
+from . import storage
+from . import instrument
+from . import cluster
+
+from telegram import ReplyKeyboardRemove, ParseMode, Bot
 from telegram.ext import Updater, PicklePersistence
 
+logger = logging.getLogger(__name__)
+
 class Data(object):
     """Basic data class."""
 
@@ -48,12 +59,36 @@ class Data(object):
 
 
 
+def _rates(level, metrics):
+    """Return the per-capita rates of `metrics` available for a `level`"""
+    return [population.rate_key(m) for m in metrics if m in population.METRICS[level]]
+
+
+# fields returned by each getter of daily documents (i.e., its projection)
+FIELDS = {
+    'get_national_total_cases' : ['data'] + settings.DATA['nation']['metrics'] + _rates('nation', settings.DATA['nation']['metrics']),
+    'get_region_cases' : ['data', 'denominazione_regione'] + settings.DATA['regions']['metrics'] + _rates('regions', settings.DATA['regions']['metrics']),
+    'get_province_cases' : ['data', 'denominazione_provincia'] + settings.DATA['provinces']['metrics'] + _rates('provinces', settings.DATA['provinces']['metrics']),
+    'get_regional_positive_cases' : ['data', 'denominazione_regione', 'totale_positivi', 'variazione_totale_positivi'] + _rates('regions', ['totale_positivi', 'variazione_totale_positivi']),
+}
+
+
+
 class Report(object):
     """The report class."""
 
 
-    def refresh(self):
-        """download new data and save into mongo if they are fresher"""
+    def __init__(self, storage_kind=None):
+        """Create a report on a storage (see storage.get_storage)"""
+        self.storage = storage.get_storage(storage_kind)
+
+
+    def refresh(self, notify=True, bot=None, chats=None):
+        """
+        download new data and save into the storage if they are fresher
+        Set `notify` to False to skip notifications (e.g., when the bot loads the in-memory storage at start),
+        pass a `bot` and its `chats` to notify users through them (e.g., from the running bot, see notify_users)
+        """
         d = Data()
 
         # get data status
@@ -85,44 +120,42 @@ class Report(object):
                 print("Cannot get locking info (probably it's a first run)")
 
             # set metadata
-            self._set_meta(md5, d.get_date())
+            self.storage.set_meta(md5, d.get_date())
 
             # preprocess data
-            data = d.get_json_data()
-
-  
-            # save into temporary mongodb collections
-            for report in settings.DATA.keys():
+            with instrument.timed('refresh_stage', name='load'):
+                data = d.get_json_data()
 
-                collection = settings.MONGO_DB[f'{report}_temp']
+            # drop upstream fields unused by the bot
+            if settings.SLIM_INGEST:
+                with instrument.timed('refresh_stage', name='slim'):
+                    for report, info in settings.DATA.items():
+                        data[report] = misc.slim(data[report], ['data'] + info['labels'] + info['metrics'])
 
-                # drop collection and relative indexes
-                collection.drop()
+            # add per-capita rates (stored and indexed like absolute values)
+            with instrument.timed('refresh_stage', name='rates'):
+                population.add_rates(data)
 
-                # update data
-                collection.insert_many(data[report])
 
-                # create indexes
-                print('Creating indexes...')  # Move this print to the logger
-                indexes = settings.DATA[report]['indexes']
-                collection.create_indexes(indexes)
+            # store series, keyboards and weekly aggregates
+            self.storage.ingest(data, d.get_date())
 
-            # rename temporary collections
-            for report in settings.DATA.keys():
-                print('Renaming collections...')  # Move this print to the logger
-                settings.MONGO_DB[f'{report}_temp'].rename(report, dropTarget=True)
+            # uploaded charts are stale now (before bots see the new version)
+            self.storage.drop_file_ids()
 
-            # set keyboards options according to new values
-            self._set_keyboards()
+            # write the binary snapshot read by the bot
+            print('Writing snapshot...') # Move this print to the logger
+            with instrument.timed('refresh_stage', name='snapshot'):
+                snapshot.write(data, md5)
 
-            # Compute weekly aggregates
-            self._compute_aggregates()
-
-            # remove lock
-            self._unlock_collection()
+            # remove lock, the new version is ready
+            self.storage.unlock()
 
             print('Data Updatated!')
 
+            if not notify:
+                return
+
             days = 15
             data = self.get_national_total_cases(days)
 
@@ -136,30 +169,66 @@ class Report(object):
 
             msg += "\n\n_Digita_ /help _per i dettagli_"
 
-            self.notify_users(msg, aggregation_detail=True)
+            self.notify_users(msg, aggregation_detail=True, bot=bot, chats=chats)
 
+            # send regional/provincial updates to their subscribers
+            self.notify_subscribers(bot=bot)
 
-    def notify_users(self, msg, aggregation_detail=False):
-        """Notify Bot Users"""
+            # send alerts whose conditions started to hold
+            self.notify_alerts(bot=bot)
 
-        # users file
-        pp = PicklePersistence(filename='_data/conversationbot')
+            # the same numbers are exposed by the metrics endpoint (see instrument.serve)
+            logger.debug(instrument.REGISTRY.summary())
 
-        updater = Updater(misc.get_env_variable('API_KEY'), persistence=pp)
+
+    @instrument.timed('refresh_stage')
+    def notify_users(self, msg, aggregation_detail=False, bot=None, chats=None, merge=True):
+        """
+        Notify Bot Users
+        With `aggregation_detail`, `msg` is the caption of the weekly chart (one call per user) if it fits,
+        set `merge` to False to send them as two messages.
+        Pass a `bot` and its `chats` to override the Telegram bot and its users (e.g., in benchmarks)
+        """
+
+        if bot is None:
+            # users file
+            if settings.CLUSTER:
+                # users of all the instances are stored in MongoDB (see cluster.py)
+                pp = cluster.MongoPersistence()
+            else:
+                pp = PicklePersistence(filename='_data/conversationbot')
+
+            updater = Updater(misc.get_env_variable('API_KEY'), persistence=pp)
+            bot = updater.bot
+            chats = pp.get_chat_ids() if settings.CLUSTER else updater.dispatcher.chat_data.keys()
 
         # get aggregated national data
-        data = self.get_weekly_cases(area="Italia 🇮🇹", limit=10)
-        plot = misc.plotify_bar(title=f'Trend nuovi casi per settimana (Italia)', data = data)
+        title = 'Trend nuovi casi per settimana (Italia)'
+        version = self.get_meta()['md5']
+        key = misc.chart_key('plotify_bar', title, preset=misc.BROADCAST_PRESET)
+
+        # upload the chart once (with the broadcast preset), then send it by file_id
+        file_id = self.get_file_id(key, version) if aggregation_detail else None
+        if aggregation_detail and not file_id:
+            data = self.get_weekly_cases(area="Italia 🇮🇹", limit=10)
+            plot = misc.plotify_bar(title=title, data = data, preset=misc.BROADCAST_PRESET)
 
-        i = 0
+        calls = 0
         sent = 0
-        for i, chat in enumerate(updater.dispatcher.chat_data.keys(), start=1):
-            if i != 0 and i % 30 == 0:
+        for chat in chats:
+            if calls >= 30:
                 time.sleep(1) # avoids the bot ban :)
+                calls = 0
             try:
-                updater.bot.send_message(chat_id=chat, text=msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
                 if aggregation_detail:
-                    updater.bot.send_photo(chat_id=chat, caption=f'Trend settimanale nuovi casi (Italia)', photo=plot, reply_markup=ReplyKeyboardRemove())
+                    message, n = self._send_update(bot, chat, msg, file_id or io.BytesIO(plot.getvalue()), 'Trend settimanale nuovi casi (Italia)', merge)
+                    calls += n
+                    if not file_id:
+                        file_id = message.photo[-1].file_id
+                        self.set_file_id(key, version, file_id)
+                else:
+                    bot.send_message(chat_id=chat, text=msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+                    calls += 1
                 sent += 1
                 print(sent) #TODO: remove asap
             except Exception as e:
@@ -168,10 +237,158 @@ class Report(object):
 
         # Send reports
         report = f'{sent} notification(s) sent 👍'
-        updater.bot.send_message(chat_id=misc.get_env_variable('DEV'), text=report, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        bot.send_message(chat_id=misc.get_env_variable('DEV'), text=report, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        print(report)
+
+
+    @instrument.timed('refresh_stage')
+    def notify_subscribers(self, bot=None, subscribers=None):
+        """
+        Send the update of each area to its subscribers.
+        Recipients are grouped by area, so each message and chart is rendered (and uploaded) once per area,
+        then sent to all the subscribers of the area (charts by file_id).
+        Pass a `bot` and its `subscribers` ({(level, name): [chats]}) to override the Telegram bot and the subscriptions
+        """
+
+        if subscribers is None:
+            subscribers = self.get_subscribers()
+
+        if not subscribers:
+            return
+
+        if bot is None:
+            bot = Bot(misc.get_env_variable('API_KEY'))
+
+        from bot import render_area_update # fix circular import, the ugly way
+
+        version = self.get_meta()['md5']
+
+        calls = 0
+        sent = 0
+        for (level, name), chats in subscribers.items():
+            update = render_area_update(level, name)
+            if not update:
+                continue
+            msg, title, data, key = update
+            msg += "\n\n_Digita_ /disiscrivi _per gestire le iscrizioni_"
+
+            # upload the chart once (with the broadcast preset), then send it by file_id
+            chart = misc.chart_key('plotify', title, key=key, preset=misc.BROADCAST_PRESET)
+            file_id = self.get_file_id(chart, version)
+            plot = None
+            if not file_id:
+                plot = misc.plotify(title=title, data=data, key=key, preset=misc.BROADCAST_PRESET)
+
+            for chat in chats:
+                if calls >= 30:
+                    time.sleep(1) # avoids the bot ban :)
+                    calls = 0
+                try:
+                    message, n = self._send_update(bot, chat, msg, file_id or io.BytesIO(plot.getvalue()), title)
+                    calls += n
+                    if not file_id:
+                        file_id = message.photo[-1].file_id
+                        self.set_file_id(chart, version, file_id)
+                    sent += 1
+                except Exception as e:
+                    print(e)
+                    pass
+
+        report = f'{sent} area notification(s) sent to subscribers of {len(subscribers)} area(s) 👍'
+        bot.send_message(chat_id=misc.get_env_variable('DEV'), text=report, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        print(report)
+
+
+    @instrument.timed('refresh_stage')
+    def notify_alerts(self, bot=None, rules=None):
+        """
+        Evaluate all the alert rules against the last complete weeks (once per week) and notify matching chats,
+        one message per chat.
+        Pass a `bot` and the `rules` to override the Telegram bot and the rules stored in MongoDB
+        """
+
+        weeks = self.get_last_weeks(alerts.WEEKS)
+        if not weeks:
+            return
+
+        # evaluate rules just once per complete week
+        latest = max(w[-1]['week'] for w in weeks.values())
+        if self.storage.get_alerts_week() == latest:
+            return
+
+        if rules is None:
+            rules = self.get_alerts()
+
+        if not rules:
+            self.storage.set_alerts_week(latest)
+            return
+
+        with instrument.timed('refresh_stage', name='alerts_evaluation'):
+            areas, values = alerts.get_values(weeks)
+            match = alerts.evaluate(values, *alerts.compile_rules(rules, areas))
+
+        # group matching rules per chat
+        triggered = dict()
+        for i in np.flatnonzero(match):
+            triggered.setdefault(rules[i]['chat'], []).append(rules[i])
+
+        if not triggered:
+            self.storage.set_alerts_week(latest)
+            return
+
+        if bot is None:
+            bot = Bot(misc.get_env_variable('API_KEY'))
+
+        week = weeks[settings.NATION][-1] if settings.NATION in weeks else next(iter(weeks.values()))[-1]
+
+        calls = 0
+        sent = 0
+        for chat, chat_rules in triggered.items():
+            if calls >= 30:
+                time.sleep(1) # avoids the bot ban :)
+                calls = 0
+            msg = f'*Allerta*\n_Settimana: {week["settimana_del"]:%d-%b} - {week["settimana_fino_al"]:%d-%b}_\n'
+            for rule in chat_rules:
+                w = weeks[rule['area']]
+                icons = misc.get_icons(*self._get_deltas(w))
+                msg += f'\n{icons[0]} {icons[1]} {alerts.describe(rule)}'
+            msg += '\n\n_Digita_ /allerta _per gestire le allerte_'
+            try:
+                bot.send_message(chat_id=chat, text=msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+                calls += 1
+                sent += 1
+            except Exception as e:
+                print(e)
+                pass
+
+        # the week is marked as evaluated once the alerts have been sent (a crash above retries it)
+        self.storage.set_alerts_week(latest)
+
+        report = f'{sent} alert(s) sent, {int(match.sum())} rule(s) matched out of {len(rules)} 👍'
+        bot.send_message(chat_id=misc.get_env_variable('DEV'), text=report, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
         print(report)
 
 
+    def _get_deltas(self, weeks):
+        """Return delta and delta_delta of the last of `weeks` (oldest first), as in get_weekly_cases"""
+        cases = [0] * (3 - len(weeks)) + [w['nuovi_positivi'] for w in weeks[-3:]]
+        return cases[2] - cases[1], cases[2] - 2 * cases[1] + cases[0]
+
+
+    def _send_update(self, bot, chat, msg, photo, caption, merge=True):
+        """
+        Send a Markdown `msg` and a `photo` to a `chat`: a single photo captioned with `msg` if it fits the caption limit
+        otherwise (or if `merge` is False) a message and a photo with a short `caption`.
+        Return the photo message and the number of API calls
+        """
+
+        if merge and len(msg) <= misc.CAPTION_LIMIT:
+            return bot.send_photo(chat_id=chat, caption=msg, parse_mode=ParseMode.MARKDOWN, photo=photo, reply_markup=ReplyKeyboardRemove()), 1
+
+        bot.send_message(chat_id=chat, text=msg, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        return bot.send_photo(chat_id=chat, caption=caption, photo=photo, reply_markup=ReplyKeyboardRemove()), 2
+
+
     def notify_weekly(self):
         """New cases per week, notification"""
         data = self.get_weekly_summary()
@@ -193,173 +410,139 @@ class Report(object):
         self.notify_users(msg)
 
 
+    @instrument.timed('report_query')
     def get_meta(self):
         """Get report Metadata"""
-        return settings.MONGO_DB.meta.find_one()
+        return self.storage.get_meta()
 
 
-    def _set_meta(self, md5, date):
-        """Set report metadata"""
+    @instrument.timed('report_query')
+    def get_file_ids(self, version):
+        """Return the Telegram file_ids of all the charts uploaded for a data `version`, as {key: file_id}"""
+        return self.storage.get_file_ids(version)
 
-        # drop the meta collection
-        settings.MONGO_DB.meta.drop()
 
-        # insert new meta
-        settings.MONGO_DB.meta.insert_one({
-            'timestamp' : datetime.datetime.now(),
-            'md5' : md5,
-            'reportDate' : date,
-            'locked' : True,
-        })
+    @instrument.timed('report_query')
+    def get_file_id(self, key, version):
+        """Return the Telegram file_id of a chart (by `key`) uploaded for a data `version` (None if missing)"""
+        return self.storage.get_file_id(key, version)
 
 
-    def _unlock_collection(self):
-        """Release the lock on the collection to allow further updates"""
-        settings.MONGO_DB.meta.update_one({}, {"$set": {'locked': False}})
+    def set_file_id(self, key, version, file_id):
+        """Store the Telegram file_id of a chart (by `key`) uploaded for a data `version`"""
+        self.storage.set_file_id(key, version, file_id)
 
-    def get_keyboard(self, keyboard_name):
-        """Return a list of keyboard options according to its name"""
-        try:
-            return settings.MONGO_DB['keyboards'].find_one({"keyboard_name" : keyboard_name})['values']
-        except TypeError: # no match with keyboard_name
-            return None
 
+    @instrument.timed('report_query')
+    def get_subscriptions(self, chat):
+        """Return the areas a `chat` is subscribed to, as a list of (level, name)"""
+        return self.storage.get_subscriptions(chat)
 
-    def _set_keyboards(self):
-        """Set keyboards values (distinct values for queries)"""
 
-        print('Setting keyboards...') # Move this print to the logger
+    def subscribe(self, chat, level, name):
+        """Subscribe a `chat` to the updates of an area"""
+        self.storage.subscribe(chat, level, name)
 
-        # drop existing collection
-        settings.MONGO_DB['keyboards'].drop()
 
-        # setting regions keyboard
-        values = settings.MONGO_DB['regions'].distinct('denominazione_regione')
+    def unsubscribe(self, chat, level, name):
+        """Unsubscribe a `chat` from the updates of an area"""
+        self.storage.unsubscribe(chat, level, name)
 
-        # sort values before storing
-        values.sort()
 
-        settings.MONGO_DB['keyboards'].insert_one({
-            'keyboard_name' : 'italy',
-            'values' : values
-        })
+    @instrument.timed('report_query')
+    def get_subscribers(self):
+        """Return the subscribers grouped by area, i.e., {(level, name): [chats]}"""
+        return self.storage.get_subscribers()
 
-        # setting provinces keyboards
-        provs_per_reg = settings.MONGO_DB['provinces'].aggregate([{"$group": { "_id": { 'denominazione_regione': "$denominazione_regione", 'denominazione_provincia': "$denominazione_provincia" } } }])
 
-        provinces_keyboards = []
+    @instrument.timed('report_query')
+    def get_alerts(self, chat=None):
+        """Return the alert rules of a `chat` (of every chat if None)"""
+        return self.storage.get_alerts(chat)
 
-        for item in provs_per_reg:
-            reg = item['_id']['denominazione_regione']
-            prov = item['_id']['denominazione_provincia']
 
-            # check if the keyboard is already in the list and update values accordingly
-            r = next((region for region in provinces_keyboards if region['keyboard_name'] == reg), None)
-            if r:
-                r['values'].append(prov)
-            else:
-                provinces_keyboards.append({
-                    'keyboard_name' : reg,
-                    'values' : [prov]
-                })
-
-        # sort data
-        for item in provinces_keyboards:
-            item['values'].sort()
-
-        # add to mongo
-        settings.MONGO_DB['keyboards'].insert_many(provinces_keyboards)
-
-        # create the index on keyboard name
-        settings.MONGO_DB['keyboards'].create_index('keyboard_name')
-
-    
-    def _compute_aggregates(self):
-        """ Compute week aggregates """
-
-        print('Computing aggregates...') # Move this print to the logger
-
-        collection = settings.MONGO_DB['week_temp']
-
-        # compute national cases
-        settings.MONGO_DB['nation'].aggregate([
-                    {
-                        "$group":
-                        {
-                            "_id": { 
-                                "area"  : "Italia 🇮🇹",
-                                "isoYear": {"$isoWeekYear": "$data" },
-                                "isoWeek" : {"$isoWeek": "$data" },
-                            
-                            },
-                            "nuovi_positivi": { "$sum": "$nuovi_positivi" },
-                            "giorni": {"$sum": 1},
-                            "settimana_del" : {"$min" : "$data"},
-                            "settimana_fino_al" : {"$max" : "$data"},
-                        }
-                    },
-                    {"$merge": "week_temp"}
-                    ])
-
-        # compute regional cases
-        settings.MONGO_DB['regions'].aggregate([
-                    {
-                        "$group":
-                        {
-                            "_id": { 
-                                "area"  : "$denominazione_regione",
-                                "isoYear": {"$isoWeekYear": "$data" },
-                                "isoWeek" : {"$isoWeek": "$data" },
-                            
-                            },
-                            "nuovi_positivi": { "$sum": "$nuovi_positivi" },
-                            "giorni": {"$sum": 1},
-                            "settimana_del" : {"$min" : "$data"},
-                            "settimana_fino_al" : {"$max" : "$data"},
-                        }
-                    },
-                    {"$merge": "week_temp"}
-                    ])
-
-
-        # create indexes
-        print('Creating indexes...')  # Move this print to the logger
-        indexes = settings.AGGREGATIONS['week']['indexes']
-        collection.create_indexes(indexes)
-
-        settings.MONGO_DB[f'week_temp'].rename('week', dropTarget=True)
+    def add_alert(self, chat, area, metric, condition, threshold=None):
+        """Add an alert rule to a `chat` (replacing the threshold of the same rule, if any)"""
+        self.storage.add_alert(chat, area, metric, condition, threshold)
+
+
+    def remove_alerts(self, chat):
+        """Remove all the alert rules of a `chat`"""
+        self.storage.remove_alerts(chat)
+
 
+    @instrument.timed('report_query')
+    def get_last_weeks(self, weeks):
+        """Return the last complete `weeks` of every area (Italia and regions), as {area: [documents, oldest first]}"""
+        return self.storage.get_last_weeks(weeks)
 
 
+    @instrument.timed('report_query')
+    def get_keyboard(self, keyboard_name):
+        """Return a list of keyboard options according to its name"""
+        return self.storage.get_keyboard(keyboard_name)
+
+
+    @instrument.timed('report_query')
+    def get_keyboards(self):
+        """Return all the keyboards as a dict {keyboard_name: options}"""
+        return self.storage.get_keyboards()
+
+
+    @instrument.timed('report_query')
     def get_national_total_cases(self, days):
         """ Get national cases of last `days` """
-        data = list()
-        for d in settings.MONGO_DB['nation'].find().sort([('data',-1)]).limit(days):
-            data.append(d)
-        data.reverse()
-        return data
+        return self.storage.get_window('nation', settings.NATION, days, FIELDS['get_national_total_cases'])
 
 
+    @instrument.timed('report_query')
     def get_region_cases(self, region, days):
         """ Get cases of a `region` of last `days` """
-        data = list()
-        for d in settings.MONGO_DB['regions'].find({'denominazione_regione': region}).sort([('data',-1)]).limit(days):
-            data.append(d)
-        data.reverse()
-        return data
+        return self.storage.get_window('regions', region, days, FIELDS['get_region_cases'])
 
 
-    def get_total_cases(self, region=None, offset=None, limit=None):
+    @instrument.timed('report_query')
+    def get_cases_range(self, level, name, days, bucket=None):
+        """
+        Get cases of an area (`level` is 'nation', 'regions' or 'provinces') of last `days`,
+        downsampled server-side to `bucket` ('week' or 'month', i.e., the last report of each bucket).
+        Set `bucket` to None to get daily values
+        """
+
+        date = self.get_meta()['reportDate']
+        # lower bound date for the query (i.e., from midnight `days` ago)
+        since = datetime.datetime.strptime(f'{(date - datetime.timedelta(days=days - 1)).date()}', '%Y-%m-%d')
+
+        return self.storage.get_range(level, name, since, bucket)
+
+
+    def iter_cases(self, level, name=None, days=None, fields=None):
+        """
+        Yield the cases of an area (of all the areas of a `level` if `name` is None) of last `days`
+        (all the history if None) sorted by date, with just `fields`, streamed from the storage
+        """
+
+        since = None
+        if days:
+            date = self.get_meta()['reportDate']
+            # lower bound date for the query (i.e., from midnight `days` ago)
+            since = datetime.datetime.strptime(f'{(date - datetime.timedelta(days=days - 1)).date()}', '%Y-%m-%d')
+
+        return self.storage.iter_documents(level, name, since, fields)
+
+
+    @instrument.timed('report_query')
+    def get_total_cases(self, region=None, offset=None, limit=None, per_capita=False):
         """
         Get today's total cases and differentials:
         - region=None      for all the regions
         - region='all'     for all the provinces
         - region='foo'     for all the provinces of the region foo
         
-        Use `limit` to limit the resultset
+        Use `limit` to limit the resultset.
+        Set `per_capita` to True to get (and rank by) values per 100k inhabitants
         """
 
-        #TODO: use the aggreagation framework instead
         date = self.get_meta()['reportDate']
 
 
@@ -367,103 +550,15 @@ class Report(object):
         # lower bound date for the query (i.e., from yesterday at midnight)
         yesterday = datetime.datetime.strptime(f'{yesterday.date()}', '%Y-%m-%d')
 
-
-        query = [{ 
-                    "$match" : { 
-                        # "denominazione_regione" : region
-                        "data" : {
-                            "$gte" : yesterday
-                        }
-                    }
-                },
-                {
-                    "$sort": { 
-                        "data" : 1 
-                    } 
-                },
-                {
-                    "$group": {
-                        "data": {
-                            "$last": "$data"
-                        },
-                        "yesterday": {
-                            "$first": "$totale_casi"
-                        },
-                        "today": {
-                            "$last": "$totale_casi"
-                        },
-                    }
-                },
-                { 
-                    "$project": {
-                        "_id": 1,
-                        "data" : 1,
-                        "totale_casi" : "$today",
-                        "diff": { "$subtract": [ "$today", "$yesterday" ] },
-                    }
-                },
-                {
-                    "$sort": { 
-                        "diff" : -1
-                    } 
-                },
-        ]
-
-        # customize query
-        if region == None:
-            # get regional data
-            collection = 'regions'
-            query[2]['$group']['_id'] = "$denominazione_regione"
-        elif region == 'all':
-            # all the provinces
-            collection = 'provinces'
-            # remove In fase di definizione/aggiornamento from this output
-            query[0]['$match']["denominazione_provincia"] = {'$ne' : 'In fase di definizione/aggiornamento'}
-            query[2]['$group']['_id'] = "$denominazione_provincia"
-        else:
-            # get provinces data for a region
-            collection = 'provinces'
-            query[0]['$match']["denominazione_regione"] = region
-            query[2]['$group']['_id'] = "$denominazione_provincia"
-
-        if offset:
-            query.append(
-                {'$skip' : offset}
-            )
-
-        if limit:
-            query.append(
-                {'$limit' : limit}
-            )
-
-
-        resultset = settings.MONGO_DB[collection].aggregate(query)
-        
-        data = list()
-
-        for d in resultset:
-            data.append(d)
-        return data
+        return self.storage.get_totals(region, yesterday, offset=offset, limit=limit, per_capita=per_capita)
 
 
+    @instrument.timed('report_query')
     def get_weekly_cases(self, area=None, limit=None, current=True):
         """
         Get weekly cases
         """
-        query = [
-                    { "$match" : {"_id.area": area}},
-                    { "$project" : {"_id" : 0 , "isoYear" : "$_id.isoYear", "isoWeek" : "$_id.isoWeek", "isoWeek" : "$_id.isoWeek", "giorni":1, "nuovi_positivi":1, "settimana_del":1,"settimana_fino_al":1}},
-                    { "$sort" : { "isoYear" : -1, "isoWeek": -1} },
-                    { "$limit": limit}
-                ]
-
-        if not current:
-            query[0]["$match"]['giorni'] = {"$eq" : 7} 
-
-
-        resultset = settings.MONGO_DB["week"].aggregate(query)
-
-        rawData = list(resultset)
+        rawData = self.storage.get_weeks(area, limit=limit, complete=not current)
 
 
         data = []
@@ -482,6 +577,7 @@ class Report(object):
         return data
 
 
+    @instrument.timed('report_query')
     def get_weekly_summary(self, current=False):
         """
         Get weekly summary
@@ -504,20 +600,18 @@ class Report(object):
         return data
         
 
+    @instrument.timed('report_query')
     def get_province_cases(self, province, days):
         """ Get cases of a `province` of last `days` """
-        data = list()
-        for d in settings.MONGO_DB['provinces'].find({'denominazione_provincia': province}).sort([('data',-1)]).limit(days):
-            data.append(d)
-        data.reverse()
-        return data
+        return self.storage.get_window('provinces', province, days, FIELDS['get_province_cases'])
 
 
-    def get_regional_positive_cases(self):
-        """Rank new cases per region"""
-        #TODO: use the aggreagation framework instead
+    @instrument.timed('report_query')
+    def get_regional_positive_cases(self, per_capita=False):
+        """
+        Rank new cases per region
+        Set `per_capita` to True to rank by positive cases per 100k inhabitants
+        """
         date = self.get_meta()['reportDate']
-        data = list()
-        for d in settings.MONGO_DB['regions'].find({'data': date}).sort([('totale_positivi',-1)]):
-            data.append(d)
-        return data
\ No newline at end of file
+        key = population.rate_key('totale_positivi') if per_capita else 'totale_positivi'
+        return self.storage.get_ranking('regions', date, key, FIELDS['get_regional_positive_cases'])
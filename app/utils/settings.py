@@ -4,29 +4,49 @@ Just a collection of settings and basic stuff
 
 import pymongo
 from . import misc
+from . import instrument
 import os
 
 
-# data collection and related info
+# counters reported for nation and regions (provinces only report `totale_casi`)
+COUNTERS = [
+    'totale_positivi', 'variazione_totale_positivi', 'nuovi_positivi', 'dimessi_guariti', 'deceduti',
+    'totale_casi', 'tamponi', 'totale_ospedalizzati', 'terapia_intensiva',
+]
+
+# data collection and related info:
+# - `labels` and `metrics` are the fields used by the bot (besides `data`), see SLIM_INGEST
 DATA = {
     'nation' : {
         'file_name' : misc.get_env_variable('NATION'),
+        'area' : None, # a single area, see NATION
+        'labels' : [],
+        'metrics' : COUNTERS,
         'indexes' : [
             pymongo.IndexModel([("data", pymongo.DESCENDING)])
         ],
     }, 
     'regions' : {
         'file_name' : misc.get_env_variable('REGIONS'),
+        'area' : 'denominazione_regione',
+        'labels' : ['denominazione_regione'],
+        'metrics' : COUNTERS,
         'indexes' : [
             pymongo.IndexModel([("data", pymongo.DESCENDING), ("variazione_totale_positivi", pymongo.DESCENDING)]),
-            pymongo.IndexModel([("denominazione_regione", pymongo.TEXT)]),
+            pymongo.IndexModel([("data", pymongo.DESCENDING), ("totale_positivi", pymongo.DESCENDING)]),
+            pymongo.IndexModel([("data", pymongo.DESCENDING), ("totale_positivi_100k", pymongo.DESCENDING)]),
+            pymongo.IndexModel([("denominazione_regione", pymongo.ASCENDING), ("data", pymongo.DESCENDING)]),
         ]
     },
     'provinces' : {
         'file_name' : misc.get_env_variable('PROVINCES'),
+        'area' : 'denominazione_provincia',
+        'labels' : ['denominazione_regione', 'denominazione_provincia'],
+        'metrics' : ['totale_casi'],
         'indexes' : [
             pymongo.IndexModel([("data", pymongo.DESCENDING), ("totale_casi", pymongo.DESCENDING)]),
-            pymongo.IndexModel([("denominazione_provincia", pymongo.TEXT)]),
+            pymongo.IndexModel([("data", pymongo.DESCENDING), ("totale_casi_100k", pymongo.DESCENDING)]),
+            pymongo.IndexModel([("denominazione_provincia", pymongo.ASCENDING), ("data", pymongo.DESCENDING)]),
         ]
     }
 }
@@ -41,11 +61,40 @@ AGGREGATIONS = {
 }
 
 
+# also store every level as monthly buckets (see buckets.py) and read windows from them
+BUCKETED = os.environ.get('BUCKETED', '0') == '1'
+
+
+# drop upstream fields unused by the bot (notes, codes, coordinates, ...) at ingest
+SLIM_INGEST = os.environ.get('SLIM_INGEST', '0') == '1'
+
+
+# label of the national area (as used by aggregates)
+NATION = "Italia 🇮🇹"
+
+
 # Path for downloaded files (in the repository)
 DATA_PATH = os.path.dirname(os.path.dirname(__file__))+'/_data/repo/dati-json'
 
+# Path for the binary snapshot of all the series (see snapshot.py)
+SNAPSHOT_PATH = os.path.dirname(os.path.dirname(__file__))+'/_data/snapshot.bin'
+
+
+# storage of the report data: 'mongo' or 'memory' (see storage.py)
+STORAGE = os.environ.get('STORAGE', 'mongo')
+
+# multi-instance mode: bot instances share updates, conversations and caches through MongoDB (see cluster.py)
+CLUSTER = os.environ.get('CLUSTER', '0') == '1'
+
+# partitions of the shared update queue (the same for all the instances, at least as many as instances)
+PARTITIONS = int(os.environ.get('PARTITIONS', 16))
+
+# Path for CSV exports, one directory per data version (see export.py)
+EXPORT_PATH = os.path.dirname(os.path.dirname(__file__))+'/_data/exports'
+
 
-# MongoDB details
-MONGO_CLIENT = pymongo.MongoClient('mongodb://mongo:27017/')
-MONGO_DB = MONGO_CLIENT.covid19
+# MongoDB details (override them to run against another instance, e.g., benchmarks)
+# connect on first use, so that the in-memory storage never touches it
+MONGO_CLIENT = pymongo.MongoClient(os.environ.get('MONGO_URI', 'mongodb://mongo:27017/'), connect=False, event_listeners=[instrument.MongoListener()])
+MONGO_DB = MONGO_CLIENT[os.environ.get('MONGO_DB', 'covid19')]
 
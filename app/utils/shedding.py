@@ -0,0 +1,75 @@
+"""
+Load shedding: switch charts to a cheap fallback (e.g., ASCII) when renders pile up or get slow
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from . import instrument
+
+
+class LoadShedder(object):
+    """
+    Track the render backlog (waiting and running renders) and their latency (moving average).
+    Shed load when the backlog reaches `high_backlog` or the latency `high_latency` (seconds),
+    stop once the backlog has stayed at most `low_backlog` for `hold` seconds
+    """
+
+
+    def __init__(self, high_backlog=4, low_backlog=1, high_latency=2, hold=30, alpha=0.3):
+        self.high_backlog = high_backlog
+        self.low_backlog = low_backlog
+        self.high_latency = high_latency
+        self.hold = hold
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.backlog = 0
+        self.latency = 0
+        self.shedding = False
+        # since when the backlog is at most low_backlog (None if above)
+        self.low_since = None
+
+
+    def _check_backlog(self, now):
+        """Record when the backlog falls to `low_backlog` (holding the lock), forget it when it rises again"""
+        if self.backlog > self.low_backlog:
+            self.low_since = None
+        elif self.low_since is None:
+            self.low_since = now
+
+
+    @contextmanager
+    def track(self):
+        """Track a render (from the time it is started, i.e., including its wait for the renderer, see charts.RENDER_LOCK)"""
+        start = time.monotonic()
+        with self.lock:
+            self.backlog += 1
+            self._check_backlog(start)
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.backlog -= 1
+                self.latency = self.alpha * elapsed + (1 - self.alpha) * self.latency
+                self._check_backlog(start + elapsed)
+
+
+    def overloaded(self):
+        """Return True if load must be shed"""
+        now = time.monotonic()
+        with self.lock:
+            self._check_backlog(now)
+            if not self.shedding:
+                if self.backlog >= self.high_backlog or self.latency >= self.high_latency:
+                    self.shedding = True
+                    # hold from now at least (e.g., shedding on latency, with a low backlog)
+                    if self.low_since is not None:
+                        self.low_since = now
+                    instrument.inc('load_shedding', state='on')
+            elif self.low_since is not None and now - self.low_since >= self.hold:
+                # no renders while shedding, so restart the latency estimate
+                self.shedding = False
+                self.latency = 0
+                instrument.inc('load_shedding', state='off')
+            return self.shedding
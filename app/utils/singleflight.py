@@ -0,0 +1,60 @@
+"""
+Request coalescing: concurrent calls with the same key share a single computation
+"""
+
+import threading
+from . import instrument
+
+
+class _Call(object):
+    """An in-flight computation"""
+
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+
+class SingleFlight(object):
+    """Run a function once per key at a time, other callers wait for its result"""
+
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict() # (name, key) -> _Call
+
+
+    def do(self, name, key, func, *args, **kwargs):
+        """
+        Return `func(*args, **kwargs)`, or wait for the result of the in-flight call with the same `name` and `key`.
+        Requests and actual computations are counted per `name` in the metrics
+        """
+
+        instrument.inc('singleflight_requests', name=name)
+
+        with self.lock:
+            call = self.calls.get((name, key))
+            leader = call is None
+            if leader:
+                call = self.calls[(name, key)] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        instrument.inc('singleflight_computations', name=name)
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[(name, key)]
+            call.event.set()
+
+        return call.result
@@ -0,0 +1,324 @@
+"""
+Binary snapshot of all the series (metric x area x day)
+
+The snapshot is written by `Report.refresh` and memory-mapped by the bot, so
+reads do not touch MongoDB and every bot process shares the same pages.
+
+File layout (little endian):
+- header (see HEADER)
+- area index: a json list of metrics and areas, padded to 8 bytes
+- days: int64[days], the report timestamp of each day (0 if missing)
+- cube: float64[metrics][areas][days], NaN if missing (stored, per-capita and derived metrics)
+"""
+
+import os
+import mmap
+import json
+import struct
+import datetime
+import numpy as np
+from . import settings
+from . import derived
+from . import population
+
+
+MAGIC = b'CVSN'
+FORMAT_VERSION = 1
+
+# magic, format version, md5 of data files, #metrics, #areas, #days, first day (ordinal), index size
+HEADER = struct.Struct('<4sH32sIIIII')
+
+# stored metrics (provinces only report `totale_casi`)
+METRICS = [
+    'totale_positivi',
+    'variazione_totale_positivi',
+    'nuovi_positivi',
+    'dimessi_guariti',
+    'deceduti',
+    'totale_casi',
+    'tamponi',
+    'totale_ospedalizzati',
+    'terapia_intensiva',
+]
+
+# per-capita rates (see population.add_rates)
+RATES = [population.rate_key(m) for m in population.METRICS['regions']]
+
+
+def _align(n, size=8):
+    """Round `n` up to a multiple of `size`"""
+    return (n + size - 1) // size * size
+
+
+def _get_areas(data):
+    """
+    Return the list of areas [level, name, parent] in `data`.
+    Province names shared by several regions (e.g., 'In fase di definizione/aggiornamento')
+    are not areas, so they are skipped.
+    """
+    areas = [['nation', settings.NATION, None]]
+
+    regions = sorted({d[settings.DATA['regions']['area']] for d in data['regions']})
+    areas += [['regions', r, settings.NATION] for r in regions]
+
+    parents = dict()
+    for d in data['provinces']:
+        parents.setdefault(d[settings.DATA['provinces']['area']], set()).add(d['denominazione_regione'])
+
+    areas += [['provinces', p, parents[p].pop()] for p in sorted(parents) if len(parents[p]) == 1]
+
+    return areas
+
+
+def write(data, md5, path=None):
+    """
+    Write the snapshot of `data` (as returned by `Data.get_json_data`) to `path` (default: settings.SNAPSHOT_PATH).
+    The file is replaced atomically, readers keep the old mapping until they reload.
+    """
+
+    path = path or settings.SNAPSHOT_PATH
+
+    areas = _get_areas(data)
+    area_idx = {(level, name): i for i, (level, name, _) in enumerate(areas)}
+
+    first = min(d['data'] for d in data['nation']).date().toordinal()
+    last = max(d['data'] for d in data['nation']).date().toordinal()
+    n_days = last - first + 1
+
+    stored = METRICS + RATES
+    days = np.zeros(n_days, dtype='<i8')
+    cube = np.full((len(stored), len(areas), n_days), np.nan, dtype='<f8')
+
+    for level in settings.DATA.keys():
+        field = settings.DATA[level]['area']
+        for d in data[level]:
+            name = d[field] if field else settings.NATION
+            try:
+                a = area_idx[(level, name)]
+            except KeyError: # skipped area
+                continue
+            t = d['data'].date().toordinal() - first
+            if not 0 <= t < n_days:
+                continue
+            if level == 'nation':
+                days[t] = int(d['data'].timestamp())
+            for m, metric in enumerate(stored):
+                value = d.get(metric)
+                if value is not None:
+                    cube[m, a, t] = value
+
+    # append derived metrics
+    cube = np.concatenate([cube, derived.compute(cube, stored)])
+    metrics = stored + derived.METRICS
+
+    index = json.dumps({'metrics' : metrics, 'areas' : areas}).encode('utf-8')
+    index += b' ' * (_align(HEADER.size + len(index)) - HEADER.size - len(index))
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, md5.encode('ascii'), len(metrics), len(areas), n_days, first, len(index))
+
+    # write a temporary file and then rename it
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(index)
+        f.write(days.tobytes())
+        f.write(cube.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+
+class SnapshotData(object):
+    """
+    The data of a mapped snapshot file (zero-copy views on the map, empty without a file).
+    Never changed once built, so readers holding it always see a single version
+    """
+
+
+    def __init__(self, mm=None, stat=None):
+        self.stat = stat
+        self.version = None
+        self.metrics = dict()
+        self.areas = dict()
+        self.parents = dict()
+        self.days = np.zeros(0, dtype='<i8')
+        self.cube = None
+        self.first = 0
+        self._mm = mm
+
+        if mm is None:
+            return
+
+        magic, fmt, md5, n_metrics, n_areas, n_days, first, index_size = HEADER.unpack_from(mm)
+
+        index = json.loads(bytes(mm[HEADER.size:HEADER.size + index_size]))
+        offset = HEADER.size + index_size
+
+        # numpy views on the mapped file (no copies)
+        self.days = np.frombuffer(mm, dtype='<i8', count=n_days, offset=offset)
+        offset += self.days.nbytes
+        self.cube = np.frombuffer(mm, dtype='<f8', count=n_metrics * n_areas * n_days, offset=offset).reshape(n_metrics, n_areas, n_days)
+
+        self.metrics = {m: i for i, m in enumerate(index['metrics'])}
+        self.areas = {(level, name): i for i, (level, name, _) in enumerate(index['areas'])}
+        self.parents = {(level, name): parent for level, name, parent in index['areas']}
+        self.first = first
+        self.version = md5.decode('ascii')
+
+
+    def get_names(self, level):
+        """Return the names of the areas of a `level`"""
+        return [name for l, name in self.areas if l == level]
+
+
+    def _get_date(self, t):
+        """Return the date of the day `t` (its report timestamp, or midnight if missing)"""
+        return datetime.datetime.fromtimestamp(self.days[t]) if self.days[t] else datetime.datetime.fromordinal(self.first + t)
+
+
+    def get_dates(self, days=None):
+        """Return the dates of the snapshot, optionally limited to the last `days`"""
+        t = range(len(self.days))
+        return [self._get_date(i) for i in (t[-days:] if days else t)]
+
+
+    def get_series(self, level, name, metric, days=None):
+        """Return the (zero-copy) series of a `metric` for an area, optionally limited to the last `days`"""
+        values = self.cube[self.metrics[metric], self.areas[(level, name)]]
+        return values[-days:] if days else values
+
+
+    def get_documents(self, level, name, days):
+        """
+        Return the last `days` of an area as a list of documents shaped like the MongoDB ones.
+        Return None if the area is unknown or if no snapshot is available
+        """
+
+        if self._mm is None or (level, name) not in self.areas:
+            return None
+
+        return self._get_documents(level, name, range(max(len(self.days) - days, 0), len(self.days)))
+
+
+    def get_range(self, level, name, days, bucket=None):
+        """
+        Return the last `days` of an area downsampled to `bucket` ('week' or 'month', None for daily values),
+        i.e., the last reported day of each bucket. Return None if the area is unknown or if no snapshot is available
+        """
+
+        if not bucket:
+            return self.get_documents(level, name, days)
+
+        if self._mm is None or (level, name) not in self.areas:
+            return None
+
+        # the last day with data of each bucket (a missing last day must not drop its bucket)
+        start = max(len(self.days) - days, 0)
+        reported = ~np.isnan(self.cube[:, self.areas[(level, name)], start:]).all(axis=0)
+        last = dict()
+        for t in range(start, len(self.days)):
+            if not reported[t - start]:
+                continue
+            date = datetime.date.fromordinal(self.first + t)
+            last[date.isocalendar()[:2] if bucket == 'week' else (date.year, date.month)] = t
+
+        return self._get_documents(level, name, last.values())
+
+
+    def _get_documents(self, level, name, days):
+        """Return the documents of an area for a list of `days` (indexes), skipping missing ones"""
+
+        a = self.areas[(level, name)]
+        data = list()
+        for t in days:
+            values = self.cube[:, a, t]
+            if np.isnan(values).all():
+                continue
+            d = {
+                'data' : self._get_date(t),
+                settings.DATA[level]['area'] or 'area' : name,
+            }
+            for metric, m in self.metrics.items():
+                if not np.isnan(values[m]):
+                    d[metric] = int(values[m]) if metric in METRICS else float(values[m])
+            data.append(d)
+        return data
+
+
+
+class Snapshot(object):
+    """
+    A read-only, memory-mapped snapshot. A new file is mapped as a new SnapshotData and swapped
+    with a single assignment, so concurrent readers never mix two versions (use `get` for several reads)
+    """
+
+
+    def __init__(self, path=None):
+        """create a Snapshot object, data are mapped on `refresh`"""
+        self.path = path or settings.SNAPSHOT_PATH
+        self.data = SnapshotData()
+
+
+    def refresh(self):
+        """
+        (Re)map the file if it changed since the last call.
+        Return True if new data have been mapped
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+
+        stat = (stat.st_ino, stat.st_mtime_ns)
+        if self.data.stat == stat:
+            return False
+
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, fmt = HEADER.unpack_from(mm)[:2]
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            mm.close()
+            return False
+
+        # the old map (if any) is released once no view points to it anymore
+        self.data = SnapshotData(mm, stat)
+        return True
+
+
+    def get(self):
+        """Refresh, then return the current data (a single version for several reads)"""
+        self.refresh()
+        return self.data
+
+
+    @property
+    def version(self):
+        return self.data.version
+
+
+    @property
+    def areas(self):
+        return self.data.areas
+
+
+    def get_names(self, level):
+        return self.data.get_names(level)
+
+
+    def get_dates(self, days=None):
+        return self.data.get_dates(days)
+
+
+    def get_series(self, level, name, metric, days=None):
+        return self.data.get_series(level, name, metric, days)
+
+
+    def get_documents(self, level, name, days):
+        return self.data.get_documents(level, name, days)
+
+
+    def get_range(self, level, name, days, bucket=None):
+        return self.data.get_range(level, name, days, bucket)
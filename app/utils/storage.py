@@ -0,0 +1,972 @@
+"""
+Storage backends of the report data (series, keyboards, weekly aggregates, metadata and chart file_ids)
+and of the users' subscriptions and alert rules
+
+- MongoStorage: the MongoDB database (see settings.MONGO_DB), shared by the bot and the downloader
+- MemoryStorage: plain dicts and NumPy arrays in the bot process, for single-node deployments without a database.
+  The bot refreshes it by itself (see bot.py). Subscriptions and alerts are saved to a file (see USERS_PATH)
+
+Pick one with the STORAGE environment variable ('mongo' or 'memory') and get it with `get_storage`
+"""
+
+import os
+import heapq
+import pickle
+import datetime
+import threading
+from functools import lru_cache
+import numpy as np
+from . import settings
+from . import buckets
+from . import population
+from . import instrument
+
+
+# areas excluded from rankings of all the provinces
+PENDING_AREA = 'In fase di definizione/aggiornamento'
+
+# file of subscriptions and alerts of the in-memory storage (next to the bot persistence)
+USERS_PATH = '_data/users'
+
+
+@lru_cache(maxsize=None)
+def get_storage(kind=None):
+    """Return the (shared) storage of a `kind` ('mongo' or 'memory', default settings.STORAGE)"""
+    kind = kind or settings.STORAGE
+    if kind == 'mongo':
+        return MongoStorage()
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'Unknown storage: {kind}')
+
+
+def _project(doc, fields):
+    """Return the `fields` of a `doc` (all of them if `fields` is None)"""
+    if fields is None:
+        return doc
+    return {f: doc[f] for f in fields if f in doc}
+
+
+def _bucket_key(date, bucket):
+    """Return the key of the `bucket` ('week' or 'month') of a `date`"""
+    if bucket == 'week':
+        return date.isocalendar()[:2]
+    return (date.year, date.month)
+
+
+
+class Storage(object):
+    """
+    The storage interface. Documents are shaped as in MongoDB (see Data.get_json_data), and so are results of
+    rankings (_id, data, totale_casi, diff), weekly aggregates and keyboards
+    """
+
+
+    def get_meta(self):
+        """
+        Return the metadata (md5, reportDate, timestamp, locked, ready), None if never refreshed.
+        `ready` is the last version completely stored (`md5` is set when its refresh starts)
+        """
+        raise NotImplementedError
+
+
+    def set_meta(self, md5, date):
+        """Replace metadata for the data version `md5` reported on `date`, locking the storage (keeping the ready version)"""
+        raise NotImplementedError
+
+
+    def unlock(self):
+        """Release the lock to allow further updates, the version being stored is ready"""
+        raise NotImplementedError
+
+
+    def ingest(self, data, date):
+        """Replace all the series with `data` ({level: documents}) reported on `date`, then keyboards and weekly aggregates"""
+        raise NotImplementedError
+
+
+    def get_window(self, level, name, days, fields=None):
+        """Return the last `days` documents of an area (oldest first), with just `fields` (all if None)"""
+        raise NotImplementedError
+
+
+    def get_range(self, level, name, since, bucket=None):
+        """Return the documents of an area from `since` (oldest first), the last one per `bucket` ('week' or 'month')"""
+        raise NotImplementedError
+
+
+    def iter_documents(self, level, name=None, since=None, fields=None):
+        """
+        Yield the documents of an area (of all the areas of a `level` if `name` is None) from `since`
+        (from the first day if None), sorted by date, with just `fields`. Documents are streamed, not loaded at once
+        """
+        raise NotImplementedError
+
+
+    def get_totals(self, region, since, offset=None, limit=None, per_capita=False):
+        """Return the ranking of total cases from `since` and their differentials (see Report.get_total_cases)"""
+        raise NotImplementedError
+
+
+    def get_ranking(self, level, date, key, fields=None):
+        """Return the documents of a `level` reported on `date`, sorted by `key` (descending)"""
+        raise NotImplementedError
+
+
+    def get_weeks(self, area, limit=None, complete=False):
+        """Return the weekly aggregates of an `area`, latest first (just the `complete` ones, i.e., of 7 days)"""
+        raise NotImplementedError
+
+
+    def get_last_weeks(self, weeks):
+        """Return the last complete `weeks` of every area (Italia and regions), as {area: [documents, oldest first]}"""
+        raise NotImplementedError
+
+
+    def get_keyboards(self):
+        """Return all the keyboards as a dict {keyboard_name: options}"""
+        raise NotImplementedError
+
+
+    def get_keyboard(self, keyboard_name):
+        """Return a list of keyboard options according to its name (None if missing)"""
+        return self.get_keyboards().get(keyboard_name)
+
+
+    def get_file_ids(self, version):
+        """Return the Telegram file_ids of all the charts uploaded for a data `version`, as {key: file_id}"""
+        raise NotImplementedError
+
+
+    def get_file_id(self, key, version):
+        """Return the Telegram file_id of a chart (by `key`) uploaded for a data `version` (None if missing)"""
+        return self.get_file_ids(version).get(key)
+
+
+    def set_file_id(self, key, version, file_id):
+        """Store the Telegram file_id of a chart (by `key`) uploaded for a data `version`"""
+        raise NotImplementedError
+
+
+    def drop_file_ids(self):
+        """Drop all the file_ids (i.e., stale charts)"""
+        raise NotImplementedError
+
+
+    def get_subscriptions(self, chat):
+        """Return the areas a `chat` is subscribed to, as a list of (level, name)"""
+        raise NotImplementedError
+
+
+    def subscribe(self, chat, level, name):
+        """Subscribe a `chat` to the updates of an area"""
+        raise NotImplementedError
+
+
+    def unsubscribe(self, chat, level, name):
+        """Unsubscribe a `chat` from the updates of an area"""
+        raise NotImplementedError
+
+
+    def get_subscribers(self):
+        """Return the subscribers grouped by area, i.e., {(level, name): [chats]}"""
+        raise NotImplementedError
+
+
+    def get_alerts(self, chat=None):
+        """Return the alert rules (chat, area, metric, condition, threshold) of a `chat` (of every chat if None)"""
+        raise NotImplementedError
+
+
+    def add_alert(self, chat, area, metric, condition, threshold=None):
+        """Add an alert rule to a `chat` (replacing the threshold of the same rule, if any)"""
+        raise NotImplementedError
+
+
+    def remove_alerts(self, chat):
+        """Remove all the alert rules of a `chat`"""
+        raise NotImplementedError
+
+
+    def get_alerts_week(self):
+        """Return the last week alert rules were evaluated against (None if never)"""
+        raise NotImplementedError
+
+
+    def set_alerts_week(self, week):
+        """Record that alert rules were evaluated against `week`"""
+        raise NotImplementedError
+
+
+
+class MongoStorage(Storage):
+    """The MongoDB storage (see settings.MONGO_DB)"""
+
+    # apply projections of `fields` (disable them to compare, e.g., in benchmarks)
+    projections = True
+
+
+    def get_meta(self):
+        return settings.MONGO_DB.meta.find_one()
+
+
+    def set_meta(self, md5, date):
+
+        # data of the previous version are still served until ingested
+        meta = self.get_meta() or dict()
+
+        # drop the meta collection
+        settings.MONGO_DB.meta.drop()
+
+        # insert new meta
+        settings.MONGO_DB.meta.insert_one({
+            'timestamp' : datetime.datetime.now(),
+            'md5' : md5,
+            'reportDate' : date,
+            'locked' : True,
+            'ready' : meta.get('ready'),
+        })
+
+
+    def unlock(self):
+        meta = self.get_meta()
+        if meta:
+            settings.MONGO_DB.meta.update_one({}, {"$set": {'locked': False, 'ready': meta['md5']}})
+
+
+    def ingest(self, data, date):
+
+        # save into temporary mongodb collections
+        for report in settings.DATA.keys():
+
+            collection = settings.MONGO_DB[f'{report}_temp']
+
+            # drop collection and relative indexes
+            collection.drop()
+
+            # update data
+            with instrument.timed('refresh_stage', name=f'insert_{report}'):
+                collection.insert_many(data[report])
+
+            # create indexes
+            print('Creating indexes...')  # Move this print to the logger
+            indexes = settings.DATA[report]['indexes']
+            with instrument.timed('refresh_stage', name=f'index_{report}'):
+                collection.create_indexes(indexes)
+
+            # same data as monthly buckets
+            if settings.BUCKETED:
+                self._set_buckets(report, data[report])
+
+        # rename temporary collections
+        for report in settings.DATA.keys():
+            print('Renaming collections...')  # Move this print to the logger
+            settings.MONGO_DB[f'{report}_temp'].rename(report, dropTarget=True)
+            if settings.BUCKETED:
+                name = buckets.collection_name(report)
+                settings.MONGO_DB[f'{name}_temp'].rename(name, dropTarget=True)
+
+        # set keyboards options according to new values
+        self._set_keyboards(date)
+
+        # Compute weekly aggregates
+        self._compute_aggregates()
+
+
+    @instrument.timed('refresh_stage')
+    def _set_keyboards(self, date):
+        """Set keyboards values (distinct values for queries)"""
+
+        print('Setting keyboards...') # Move this print to the logger
+
+        # lower bound date for the query (i.e., the last report from midnight)
+        today = datetime.datetime.strptime(f'{date.date()}', '%Y-%m-%d')
+
+        # build all keyboards in a single pipeline, into a temporary collection
+        settings.MONGO_DB['provinces'].aggregate([
+            { "$match" : { "data" : { "$gte" : today } } },
+            # distinct province/region pairs
+            { "$group" : { "_id" : { 'denominazione_regione': "$denominazione_regione", 'denominazione_provincia': "$denominazione_provincia" } } },
+            { "$sort" : { "_id.denominazione_provincia" : 1 } },
+            # one provinces keyboard per region (sorted values)
+            { "$group" : { "_id" : "$_id.denominazione_regione", "values" : { "$push" : "$_id.denominazione_provincia" } } },
+            { "$sort" : { "_id" : 1 } },
+            { "$facet" : {
+                # regions keyboard
+                "italy" : [
+                    { "$group" : { "_id" : None, "values" : { "$push" : "$_id" } } },
+                    { "$project" : { "_id" : 0, "keyboard_name" : { "$literal" : "italy" }, "values" : 1 } },
+                ],
+                "regions" : [
+                    { "$project" : { "_id" : 0, "keyboard_name" : "$_id", "values" : 1 } },
+                ],
+            }},
+            { "$project" : { "keyboards" : { "$concatArrays" : [ "$italy", "$regions" ] } } },
+            { "$unwind" : "$keyboards" },
+            { "$replaceRoot" : { "newRoot" : "$keyboards" } },
+            { "$out" : "keyboards_temp" },
+        ])
+
+        # create the index on keyboard name
+        settings.MONGO_DB['keyboards_temp'].create_index('keyboard_name')
+
+        # replace keyboards at once
+        settings.MONGO_DB['keyboards_temp'].rename('keyboards', dropTarget=True)
+
+
+    @instrument.timed('refresh_stage')
+    def _compute_aggregates(self):
+        """ Compute week aggregates """
+
+        print('Computing aggregates...') # Move this print to the logger
+
+        collection = settings.MONGO_DB['week_temp']
+
+        # compute national cases
+        settings.MONGO_DB['nation'].aggregate([
+                    {
+                        "$group":
+                        {
+                            "_id": {
+                                "area"  : "Italia 🇮🇹",
+                                "isoYear": {"$isoWeekYear": "$data" },
+                                "isoWeek" : {"$isoWeek": "$data" },
+
+                            },
+                            "nuovi_positivi": { "$sum": "$nuovi_positivi" },
+                            "giorni": {"$sum": 1},
+                            "settimana_del" : {"$min" : "$data"},
+                            "settimana_fino_al" : {"$max" : "$data"},
+                        }
+                    },
+                    {"$merge": "week_temp"}
+                    ])
+
+        # compute regional cases
+        settings.MONGO_DB['regions'].aggregate([
+                    {
+                        "$group":
+                        {
+                            "_id": {
+                                "area"  : "$denominazione_regione",
+                                "isoYear": {"$isoWeekYear": "$data" },
+                                "isoWeek" : {"$isoWeek": "$data" },
+
+                            },
+                            "nuovi_positivi": { "$sum": "$nuovi_positivi" },
+                            "giorni": {"$sum": 1},
+                            "settimana_del" : {"$min" : "$data"},
+                            "settimana_fino_al" : {"$max" : "$data"},
+                        }
+                    },
+                    {"$merge": "week_temp"}
+                    ])
+
+
+        # create indexes
+        print('Creating indexes...')  # Move this print to the logger
+        indexes = settings.AGGREGATIONS['week']['indexes']
+        collection.create_indexes(indexes)
+
+        settings.MONGO_DB[f'week_temp'].rename('week', dropTarget=True)
+
+
+    def _set_buckets(self, report, data):
+        """Store `data` of a `report` (a level) as monthly buckets in a temporary collection"""
+
+        collection = settings.MONGO_DB[f'{buckets.collection_name(report)}_temp']
+        collection.drop()
+
+        with instrument.timed('refresh_stage', name=f'buckets_{report}'):
+            buckets.ingest(collection, report, data)
+            collection.create_indexes(buckets.INDEXES)
+
+
+    def _get_bucketed_window(self, level, name, days, fields=None):
+        """
+        Get the last `days` of an area from monthly buckets (i.e., one or two documents for short windows),
+        with just `fields` (all if None)
+        """
+
+        projection = self._projection(fields)
+        if projection is not None:
+            # just the arrays of `fields`, plus the keys of the buckets
+            projection.update({'area' : 1, 'month' : 1, 'data' : 1})
+
+        # a month holds at least 28 days, plus the current (partial) one
+        limit = -(-days // 28) + 1
+        cursor = settings.MONGO_DB[buckets.collection_name(level)].find({'area' : name}, projection).sort([('month', -1)]).limit(limit)
+        data = buckets.to_documents(list(cursor), level, days)
+        return data if projection is None else [_project(d, fields) for d in data]
+
+
+    def _projection(self, fields):
+        """Return the projection of `fields`, None if disabled"""
+        if fields is None or not self.projections:
+            return None
+        return dict({f: 1 for f in fields}, _id=0)
+
+
+    def get_window(self, level, name, days, fields=None):
+        if settings.BUCKETED:
+            return self._get_bucketed_window(level, name, days, fields)
+
+        field = settings.DATA[level]['area']
+        query = {field : name} if field else {}
+        data = list()
+        for d in settings.MONGO_DB[level].find(query, self._projection(fields)).sort([('data',-1)]).limit(days):
+            data.append(d)
+        data.reverse()
+        return data
+
+
+    def get_range(self, level, name, since, bucket=None):
+
+        match = {'data' : {'$gte' : since}}
+        field = settings.DATA[level]['area']
+        if field:
+            match[field] = name
+
+        query = [
+            { "$match" : match },
+            { "$sort" : { "data" : 1 } },
+        ]
+
+        if bucket:
+            if bucket == 'week':
+                _id = { "year" : { "$isoWeekYear" : "$data" }, "week" : { "$isoWeek" : "$data" } }
+            else:
+                _id = { "year" : { "$year" : "$data" }, "month" : { "$month" : "$data" } }
+
+            query += [
+                { "$group" : { "_id" : _id, "doc" : { "$last" : "$$ROOT" } } },
+                { "$replaceRoot" : { "newRoot" : "$doc" } },
+                { "$sort" : { "data" : 1 } },
+            ]
+
+        return list(settings.MONGO_DB[level].aggregate(query))
+
+
+    def iter_documents(self, level, name=None, since=None, fields=None):
+
+        query = dict()
+        field = settings.DATA[level]['area']
+        if field and name is not None:
+            query[field] = name
+        if since:
+            query['data'] = {'$gte' : since}
+
+        # sorted by the date index, fetched in batches
+        cursor = settings.MONGO_DB[level].find(query, dict({f: 1 for f in fields}, _id=0) if fields else None)
+        return cursor.sort([('data', 1)]).batch_size(1000)
+
+
+    def get_totals(self, region, since, offset=None, limit=None, per_capita=False):
+
+        query = [{
+                    "$match" : {
+                        # "denominazione_regione" : region
+                        "data" : {
+                            "$gte" : since
+                        }
+                    }
+                },
+                {
+                    "$sort": {
+                        "data" : 1
+                    }
+                },
+                {
+                    "$group": {
+                        "data": {
+                            "$last": "$data"
+                        },
+                        "yesterday": {
+                            "$first": "$totale_casi"
+                        },
+                        "today": {
+                            "$last": "$totale_casi"
+                        },
+                    }
+                },
+                {
+                    "$project": {
+                        "_id": 1,
+                        "data" : 1,
+                        "totale_casi" : "$today",
+                        "diff": { "$subtract": [ "$today", "$yesterday" ] },
+                    }
+                },
+                {
+                    "$sort": {
+                        "diff" : -1
+                    }
+                },
+        ]
+
+        if per_capita:
+            field = population.rate_key('totale_casi')
+            query[2]['$group']['yesterday'] = {"$first": f"${field}"}
+            query[2]['$group']['today'] = {"$last": f"${field}"}
+            # areas without population have no rate
+            query[0]['$match'][field] = {'$ne' : None}
+
+        # customize query
+        if region == None:
+            # get regional data
+            collection = 'regions'
+            query[2]['$group']['_id'] = "$denominazione_regione"
+        elif region == 'all':
+            # all the provinces
+            collection = 'provinces'
+            # remove In fase di definizione/aggiornamento from this output
+            query[0]['$match']["denominazione_provincia"] = {'$ne' : PENDING_AREA}
+            query[2]['$group']['_id'] = "$denominazione_provincia"
+        else:
+            # get provinces data for a region
+            collection = 'provinces'
+            query[0]['$match']["denominazione_regione"] = region
+            query[2]['$group']['_id'] = "$denominazione_provincia"
+
+        if offset:
+            query.append(
+                {'$skip' : offset}
+            )
+
+        if limit:
+            query.append(
+                {'$limit' : limit}
+            )
+
+        return list(settings.MONGO_DB[collection].aggregate(query))
+
+
+    def get_ranking(self, level, date, key, fields=None):
+        return list(settings.MONGO_DB[level].find({'data': date}, self._projection(fields)).sort([(key,-1)]))
+
+
+    def get_weeks(self, area, limit=None, complete=False):
+        query = [
+                    { "$match" : {"_id.area": area}},
+                    { "$project" : {"_id" : 0 , "isoYear" : "$_id.isoYear", "isoWeek" : "$_id.isoWeek", "isoWeek" : "$_id.isoWeek", "giorni":1, "nuovi_positivi":1, "settimana_del":1,"settimana_fino_al":1}},
+                    { "$sort" : { "isoYear" : -1, "isoWeek": -1} },
+                    { "$limit": limit}
+                ]
+
+        if complete:
+            query[0]["$match"]['giorni'] = {"$eq" : 7}
+
+        return list(settings.MONGO_DB["week"].aggregate(query))
+
+
+    def get_last_weeks(self, weeks):
+        resultset = settings.MONGO_DB['week'].aggregate([
+            { "$match" : { "giorni" : 7 } },
+            { "$sort" : { "_id.area" : 1, "_id.isoYear" : -1, "_id.isoWeek" : -1 } },
+            { "$group" : {
+                "_id" : "$_id.area",
+                "weeks" : { "$push" : {
+                    "week" : ["$_id.isoYear", "$_id.isoWeek"],
+                    "nuovi_positivi" : "$nuovi_positivi",
+                    "settimana_del" : "$settimana_del",
+                    "settimana_fino_al" : "$settimana_fino_al",
+                } },
+            } },
+            { "$project" : { "weeks" : { "$slice" : ["$weeks", weeks] } } },
+        ])
+        return {d['_id']: list(reversed(d['weeks'])) for d in resultset}
+
+
+    def get_keyboards(self):
+        return {k['keyboard_name']: k['values'] for k in settings.MONGO_DB['keyboards'].find({}, {'_id': 0})}
+
+
+    def get_keyboard(self, keyboard_name):
+        try:
+            return settings.MONGO_DB['keyboards'].find_one({"keyboard_name" : keyboard_name})['values']
+        except TypeError: # no match with keyboard_name
+            return None
+
+
+    def get_file_ids(self, version):
+        return {d['_id']: d['file_id'] for d in settings.MONGO_DB['file_ids'].find({'version': version})}
+
+
+    def get_file_id(self, key, version):
+        doc = settings.MONGO_DB['file_ids'].find_one({'_id': key, 'version': version})
+        return doc['file_id'] if doc else None
+
+
+    def set_file_id(self, key, version, file_id):
+        settings.MONGO_DB['file_ids'].update_one({'_id': key}, {'$set': {'version': version, 'file_id': file_id}}, upsert=True)
+
+
+    def drop_file_ids(self):
+        settings.MONGO_DB['file_ids'].drop()
+
+
+    def get_subscriptions(self, chat):
+        doc = settings.MONGO_DB['subscriptions'].find_one({'_id': chat})
+        return [tuple(a) for a in doc['areas']] if doc else []
+
+
+    def subscribe(self, chat, level, name):
+        settings.MONGO_DB['subscriptions'].update_one({'_id': chat}, {'$addToSet': {'areas': [level, name]}}, upsert=True)
+
+
+    def unsubscribe(self, chat, level, name):
+        settings.MONGO_DB['subscriptions'].update_one({'_id': chat}, {'$pull': {'areas': [level, name]}})
+
+
+    def get_subscribers(self):
+        resultset = settings.MONGO_DB['subscriptions'].aggregate([
+            { "$unwind" : "$areas" },
+            { "$group" : { "_id" : "$areas", "chats" : { "$push" : "$_id" } } },
+        ])
+        return {tuple(d['_id']): d['chats'] for d in resultset}
+
+
+    def get_alerts(self, chat=None):
+        query = {} if chat is None else {'chat' : chat}
+        return list(settings.MONGO_DB['alerts'].find(query, {'_id' : 0}))
+
+
+    def add_alert(self, chat, area, metric, condition, threshold=None):
+        settings.MONGO_DB['alerts'].create_index('chat')
+        settings.MONGO_DB['alerts'].update_one(
+            {'chat' : chat, 'area' : area, 'metric' : metric, 'condition' : condition},
+            {'$set' : {'threshold' : threshold}},
+            upsert=True
+        )
+
+
+    def remove_alerts(self, chat):
+        settings.MONGO_DB['alerts'].delete_many({'chat' : chat})
+
+
+    def get_alerts_week(self):
+        state = settings.MONGO_DB['alerts_state'].find_one({'_id' : 'week'})
+        return state['week'] if state else None
+
+
+    def set_alerts_week(self, week):
+        settings.MONGO_DB['alerts_state'].update_one({'_id' : 'week'}, {'$set' : {'week' : week}}, upsert=True)
+
+
+
+class Series(object):
+    """The documents of an area (sorted by date) and their dates, as a NumPy array for range lookups"""
+
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.dates = np.array([d['data'] for d in docs], dtype='datetime64[us]')
+
+
+    def since(self, date):
+        """Return the documents from `date`"""
+        return self.docs[int(np.searchsorted(self.dates, np.datetime64(date, 'us'))):]
+
+
+
+class MemoryState(object):
+    """
+    The in-memory data of a version, never changed once built: series per level and key (the area,
+    (region, province) for provinces, since names are not unique, see PENDING_AREA),
+    series per area name, keyboards and weekly aggregates
+    """
+
+
+    def __init__(self, series=None, keyboards=None, weeks=None):
+        self.series = series or {level: dict() for level in settings.DATA}
+        self.names = dict()
+        for level, areas in self.series.items():
+            self.names[level] = dict()
+            for key, s in areas.items():
+                self.names[level].setdefault(key[1] if level == 'provinces' else key, []).append(s)
+        self.keyboards = keyboards or dict()
+        self.weeks = weeks or dict() # area -> weekly aggregates, latest first
+
+
+    def get_documents(self, level, name, since=None):
+        """Return the documents of an area `name` (merged by date, if more than one area has that name)"""
+        areas = self.names[level].get(name, [])
+        if len(areas) == 1:
+            return areas[0].since(since) if since else areas[0].docs
+        return list(heapq.merge(*[s.since(since) if since else s.docs for s in areas], key=lambda d: d['data']))
+
+
+
+class MemoryStorage(Storage):
+    """
+    The in-memory storage. Ingest builds a new state (see MemoryState) and swaps it
+    with a single assignment, so readers (reading `self.state` once) never see partial data.
+    Subscriptions and alerts are saved to `users_path` on every change (None to keep them in memory only)
+    """
+
+
+    def __init__(self, users_path=USERS_PATH):
+        self.meta = None
+        self.file_ids = dict() # key -> (version, file_id)
+        self.state = MemoryState()
+        self.users_path = users_path
+        self.users_lock = threading.Lock()
+        self.users = self._load_users()
+
+
+    def _load_users(self):
+        """Return the subscriptions and alerts saved to `users_path` (none if missing)"""
+        # subscriptions are stored as {chat: [(level, name)]}, alerts as a list of rules
+        users = {'subscriptions' : dict(), 'alerts' : list(), 'alerts_week' : None}
+        if self.users_path and os.path.exists(self.users_path):
+            with open(self.users_path, 'rb') as f:
+                users.update(pickle.load(f))
+        return users
+
+
+    def _save_users(self):
+        """Save subscriptions and alerts to `users_path` (holding the lock), replacing the file at once"""
+        if not self.users_path:
+            return
+        os.makedirs(os.path.dirname(self.users_path) or '.', exist_ok=True)
+        with open(f'{self.users_path}.tmp', 'wb') as f:
+            pickle.dump(self.users, f)
+        os.replace(f'{self.users_path}.tmp', self.users_path)
+
+
+    def get_meta(self):
+        return dict(self.meta) if self.meta else None
+
+
+    def set_meta(self, md5, date):
+        self.meta = {
+            'timestamp' : datetime.datetime.now(),
+            'md5' : md5,
+            'reportDate' : date,
+            'locked' : True,
+            'ready' : self.meta['ready'] if self.meta else None,
+        }
+
+
+    def unlock(self):
+        if self.meta:
+            self.meta = dict(self.meta, locked=False, ready=self.meta['md5'])
+
+
+    def ingest(self, data, date):
+
+        series = dict()
+        with instrument.timed('refresh_stage', name='memory_series'):
+            for level in settings.DATA:
+                field = settings.DATA[level]['area']
+                areas = dict()
+                for d in sorted(data[level], key=lambda d: d['data']):
+                    if level == 'provinces':
+                        key = (d['denominazione_regione'], d['denominazione_provincia'])
+                    else:
+                        key = d[field] if field else settings.NATION
+                    areas.setdefault(key, []).append(d)
+                series[level] = {key: Series(docs) for key, docs in areas.items()}
+
+        # provinces reported today, per region
+        today = datetime.datetime.strptime(f'{date.date()}', '%Y-%m-%d')
+        options = dict()
+        for (region, province), s in series['provinces'].items():
+            if s.docs[-1]['data'] >= today:
+                options.setdefault(region, []).append(province)
+        keyboards = {region: sorted(provinces) for region, provinces in options.items()}
+        keyboards['italy'] = sorted(options)
+
+        with instrument.timed('refresh_stage', name='memory_aggregates'):
+            weeks = {
+                area: self._aggregate(s.docs)
+                for level in ('nation', 'regions')
+                for area, s in series[level].items()
+            }
+
+        self.state = MemoryState(series, keyboards, weeks)
+
+
+    def _aggregate(self, docs):
+        """Return weekly aggregates of `docs` (sorted by date), latest first"""
+        weeks = dict()
+        for d in docs:
+            year, week = d['data'].isocalendar()[:2]
+            w = weeks.setdefault((year, week), {
+                'isoYear' : year, 'isoWeek' : week, 'giorni' : 0, 'nuovi_positivi' : 0,
+                'settimana_del' : d['data'], 'settimana_fino_al' : d['data'],
+            })
+            w['giorni'] += 1
+            w['nuovi_positivi'] += d.get('nuovi_positivi') or 0
+            w['settimana_fino_al'] = d['data']
+        return [weeks[k] for k in sorted(weeks, reverse=True)]
+
+
+    def get_window(self, level, name, days, fields=None):
+        return [_project(d, fields) for d in self.state.get_documents(level, name)[-days:]]
+
+
+    def get_range(self, level, name, since, bucket=None):
+        docs = self.state.get_documents(level, name, since)
+        if not bucket:
+            return list(docs)
+
+        # the last document per bucket (documents are sorted by date)
+        last = dict()
+        for d in docs:
+            last[_bucket_key(d['data'], bucket)] = d
+        return list(last.values())
+
+
+    def iter_documents(self, level, name=None, since=None, fields=None):
+
+        state = self.state
+        if name is not None:
+            docs = state.get_documents(level, name, since)
+        else:
+            # merge the (sorted) series of the areas lazily
+            areas = state.series[level].values()
+            docs = heapq.merge(*[s.since(since) if since else s.docs for s in areas], key=lambda d: d['data'])
+        return (_project(d, fields) for d in docs)
+
+
+    def get_totals(self, region, since, offset=None, limit=None, per_capita=False):
+
+        state = self.state
+        if region is None:
+            areas = list(state.series['regions'].items())
+        elif region == 'all':
+            areas = [(p, s) for (r, p), s in state.series['provinces'].items() if p != PENDING_AREA]
+        else:
+            areas = [(p, s) for (r, p), s in state.series['provinces'].items() if r == region]
+
+        field = population.rate_key('totale_casi') if per_capita else 'totale_casi'
+
+        data = list()
+        for area, s in areas:
+            docs = s.since(since)
+            if per_capita:
+                # areas without population have no rate
+                docs = [d for d in docs if d.get(field) is not None]
+            if not docs:
+                continue
+            today, yesterday = docs[-1].get(field), docs[0].get(field)
+            data.append({
+                '_id' : area,
+                'data' : docs[-1]['data'],
+                'totale_casi' : today,
+                'diff' : today - yesterday if today is not None and yesterday is not None else None,
+            })
+
+        data.sort(key=lambda d: (d['diff'] is not None, d['diff'] or 0), reverse=True)
+        start = offset or 0
+        return data[start:start + limit] if limit else data[start:]
+
+
+    def get_ranking(self, level, date, key, fields=None):
+        data = [
+            _project(s.docs[-1], fields)
+            for s in self.state.series[level].values()
+            if s.docs[-1]['data'] == date
+        ]
+        data.sort(key=lambda d: (d.get(key) is not None, d.get(key) or 0), reverse=True)
+        return data
+
+
+    def get_weeks(self, area, limit=None, complete=False):
+        weeks = self.state.weeks.get(area, [])
+        if complete:
+            weeks = [w for w in weeks if w['giorni'] == 7]
+        return [dict(w) for w in weeks[:limit]]
+
+
+    def get_last_weeks(self, weeks):
+        data = dict()
+        for area, aggregates in self.state.weeks.items():
+            complete = [w for w in aggregates if w['giorni'] == 7][:weeks]
+            if complete:
+                data[area] = [{
+                    'week' : [w['isoYear'], w['isoWeek']],
+                    'nuovi_positivi' : w['nuovi_positivi'],
+                    'settimana_del' : w['settimana_del'],
+                    'settimana_fino_al' : w['settimana_fino_al'],
+                } for w in reversed(complete)]
+        return data
+
+
+    def get_keyboards(self):
+        return dict(self.state.keyboards)
+
+
+    def get_file_ids(self, version):
+        return {key: file_id for key, (v, file_id) in list(self.file_ids.items()) if v == version}
+
+
+    def set_file_id(self, key, version, file_id):
+        self.file_ids[key] = (version, file_id)
+
+
+    def drop_file_ids(self):
+        self.file_ids = dict()
+
+
+    def get_subscriptions(self, chat):
+        return list(self.users['subscriptions'].get(chat, []))
+
+
+    def subscribe(self, chat, level, name):
+        with self.users_lock:
+            areas = self.users['subscriptions'].setdefault(chat, [])
+            if (level, name) not in areas:
+                areas.append((level, name))
+                self._save_users()
+
+
+    def unsubscribe(self, chat, level, name):
+        with self.users_lock:
+            areas = self.users['subscriptions'].get(chat, [])
+            if (level, name) in areas:
+                areas.remove((level, name))
+                self._save_users()
+
+
+    def get_subscribers(self):
+        subscribers = dict()
+        with self.users_lock:
+            for chat, areas in self.users['subscriptions'].items():
+                for area in areas:
+                    subscribers.setdefault(area, []).append(chat)
+        return subscribers
+
+
+    def get_alerts(self, chat=None):
+        with self.users_lock:
+            return [dict(r) for r in self.users['alerts'] if chat is None or r['chat'] == chat]
+
+
+    def add_alert(self, chat, area, metric, condition, threshold=None):
+        rule = {'chat' : chat, 'area' : area, 'metric' : metric, 'condition' : condition}
+        with self.users_lock:
+            for r in self.users['alerts']:
+                if all(r[k] == v for k, v in rule.items()):
+                    r['threshold'] = threshold
+                    break
+            else:
+                self.users['alerts'].append(dict(rule, threshold=threshold))
+            self._save_users()
+
+
+    def remove_alerts(self, chat):
+        with self.users_lock:
+            self.users['alerts'] = [r for r in self.users['alerts'] if r['chat'] != chat]
+            self._save_users()
+
+
+    def get_alerts_week(self):
+        return self.users['alerts_week']
+
+
+    def set_alerts_week(self, week):
+        with self.users_lock:
+            self.users['alerts_week'] = week
+            self._save_users()
@@ -0,0 +1,76 @@
+"""
+Per-chat rate limiting (token bucket) and deduplication of repeated requests
+"""
+
+import time
+import threading
+
+
+class RateLimiter(object):
+    """A token bucket per chat: `burst` requests at most, refilled at `rate` requests per second"""
+
+
+    def __init__(self, rate=1/3, burst=5, max_chats=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self.lock = threading.Lock()
+        self.buckets = dict() # chat -> [tokens, last update, warned]
+
+
+    def allow(self, chat):
+        """
+        Consume a token of `chat`. Return:
+        - True if the request is allowed
+        - False if it is not (the first time since the bucket emptied)
+        - None if it is not and the chat has already been warned
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            if len(self.buckets) > self.max_chats:
+                self._prune(now)
+
+            tokens, last, warned = self.buckets.get(chat, (self.burst, now, False))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens >= 1:
+                self.buckets[chat] = (tokens - 1, now, False)
+                return True
+
+            self.buckets[chat] = (tokens, now, True)
+            return None if warned else False
+
+
+    def _prune(self, now):
+        """Forget chats whose bucket is full again"""
+        full = self.burst / self.rate
+        self.buckets = {c: b for c, b in self.buckets.items() if now - b[1] < full}
+
+
+
+class Deduplicator(object):
+    """Drop a request of a chat identical to the one it made less than `window` seconds ago"""
+
+
+    def __init__(self, window=30, max_chats=10000):
+        self.window = window
+        self.max_chats = max_chats
+        self.lock = threading.Lock()
+        self.last = dict() # chat -> (key, time)
+
+
+    def is_duplicate(self, chat, key):
+        """Return True if `key` (e.g., command + area + data version) has just been requested by `chat`"""
+
+        now = time.monotonic()
+        with self.lock:
+            if len(self.last) > self.max_chats:
+                self.last = {c: v for c, v in self.last.items() if now - v[1] < self.window}
+
+            previous = self.last.get(chat)
+            if previous and previous[0] == key and now - previous[1] < self.window:
+                return True
+
+            self.last[chat] = (key, now)
+            return False
@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 
 
+from utils import settings
 from utils.report import Report
 
 def main():
     """Refresh data"""
+    if settings.STORAGE == 'memory':
+        print('In-memory storage: weekly notifications are not supported') # Move this print to the logger
+        return
     r = Report()
     r.notify_weekly()
 